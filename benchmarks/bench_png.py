@@ -0,0 +1,204 @@
+"""rio-rgbify PNG encoding benchmark.
+
+Re-encodes a sample of tiles with each png encoder, compression level
+and filter, and reports encode time against bytes per tile:
+
+    python benchmarks/bench_png.py tiles.mbtiles --output png.json
+    python benchmarks/bench_png.py dem.tif --zoom 12
+    python benchmarks/bench_png.py  # tiles of a synthetic DEM
+"""
+from __future__ import division
+
+import os
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+from functools import partial
+from io import BytesIO
+
+import click
+import numpy as np
+from PIL import Image
+from rasterio import transform
+
+from rio_rgbify.mbtiler import RGBTiler, _encode_as_png
+from rio_rgbify.png import PNG_FILTERS, encode_png
+
+from bench_rgbify import measure, summarize, environment, write_dem
+
+LEVELS = (1, 3, 6, 9)
+
+
+def sample_tiles(path, sample, seed=0):
+    """
+    Decode a random sample of the tiles of an mbtiles file
+    into (3, size, size) uint8 RGB arrays
+    """
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT tile_data FROM tiles;").fetchall()
+    conn.close()
+
+    random.Random(seed).shuffle(rows)
+
+    tiles = []
+    for (data,) in rows[:sample]:
+        rgb = np.array(Image.open(BytesIO(bytes(data))).convert("RGB"))
+        tiles.append(np.ascontiguousarray(np.rollaxis(rgb, 2, 0)))
+
+    return tiles
+
+
+def make_tiles(path, zoom, tmpdir, interval, base_val):
+    """
+    Tile one zoom of a DEM into an mbtiles file to sample from
+    """
+    outpath = os.path.join(tmpdir, "sample.mbtiles")
+
+    with RGBTiler(path, outpath, zoom, zoom, interval=interval, base_val=base_val) as tiler:
+        tiler.run(1)
+
+    return outpath
+
+
+def _encoders():
+    """
+    Yield (params, func) of each png encoder setting to time
+    """
+    for level in LEVELS:
+        yield {"encoder": "gdal", "level": level}, partial(_encode_gdal, level=level)
+
+        for png_filter in PNG_FILTERS:
+            params = {"encoder": "zlib", "level": level, "filter": png_filter}
+
+            yield params, partial(encode_png, level=level, png_filter=png_filter)
+
+
+def _encode_gdal(rgb, level):
+    """
+    Encode with `_encode_as_png` at a zlib level
+    """
+    _, height, width = rgb.shape
+    profile = {
+        "driver": "PNG",
+        "dtype": "uint8",
+        "height": height,
+        "width": width,
+        "count": 3,
+        "crs": "EPSG:3857",
+        "zlevel": level,
+    }
+
+    return _encode_as_png(rgb, profile, transform.from_origin(0, 0, 1, 1))
+
+
+def bench_png(tiles, repeat):
+    """
+    Time each png encoder setting over `tiles`
+    """
+    results = []
+
+    for params, func in _encoders():
+        nbytes = [len(func(rgb)) for rgb in tiles]
+        times = measure(lambda: [func(rgb) for rgb in tiles], repeat)
+        times = [seconds / len(tiles) for seconds in times]
+
+        results.append(
+            summarize(
+                "encode_png",
+                params,
+                times,
+                bytes_per_tile=float(np.mean(nbytes)),
+                tiles_per_sec=1 / min(times),
+            )
+        )
+
+    baseline = [r for r in results if r["params"] == {"encoder": "gdal", "level": 6}][0]
+
+    for record in results:
+        record["relative_time"] = record["min"] / baseline["min"]
+        record["relative_bytes"] = record["bytes_per_tile"] / baseline["bytes_per_tile"]
+
+    return results
+
+
+@click.command()
+@click.argument("src_path", type=click.Path(exists=True), required=False)
+@click.option(
+    "--output", "-o", type=click.Path(), default=None, help="Write results to this JSON file"
+)
+@click.option("--sample", type=int, default=32, help="Number of tiles to encode [DEFAULT=32]")
+@click.option(
+    "--repeat", type=int, default=3, help="Repeats of each encoder setting [DEFAULT=3]"
+)
+@click.option("--zoom", type=int, default=12, help="Zoom to tile a DEM SRC_PATH at [DEFAULT=12]")
+@click.option(
+    "--interval", type=float, default=0.1, help="Interval to tile a DEM at [DEFAULT=0.1]"
+)
+@click.option(
+    "--base-val",
+    type=float,
+    default=-10000,
+    help="Base value to tile a DEM at [DEFAULT=-10000]",
+)
+def main(src_path, output, sample, repeat, zoom, interval, base_val):
+    """Time png encoding against size of tiles from an .mbtiles file or a DEM.
+
+    Reports seconds and bytes per tile of each encoder, level and filter,
+    relative to GDAL at level 6. Without SRC_PATH, a synthetic DEM is tiled.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="rgbify-bench-png-")
+
+    try:
+        if src_path is None:
+            src_path = write_dem(os.path.join(tmpdir, "dem.tif"), 4096, "float32")
+
+        if not src_path.lower().endswith(".mbtiles"):
+            src_path = make_tiles(src_path, zoom, tmpdir, interval, base_val)
+
+        tiles = sample_tiles(src_path, sample)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if not tiles:
+        raise click.BadParameter("no tiles to sample", param_hint="SRC_PATH")
+
+    results = bench_png(tiles, repeat)
+
+    click.echo(
+        "{0:<8} {1:>5} {2:<10} {3:>10} {4:>12} {5:>8} {6:>8}".format(
+            "encoder", "level", "filter", "ms/tile", "bytes/tile", "time", "bytes"
+        ),
+        err=True,
+    )
+    for record in results:
+        click.echo(
+            "{0:<8} {1:>5} {2:<10} {3:>10.2f} {4:>12.0f} {5:>8.2f} {6:>8.3f}".format(
+                record["params"]["encoder"],
+                record["params"]["level"],
+                record["params"].get("filter", "-"),
+                record["min"] * 1000,
+                record["bytes_per_tile"],
+                record["relative_time"],
+                record["relative_bytes"],
+            ),
+            err=True,
+        )
+
+    report = {
+        "environment": environment(),
+        "tiles": len(tiles),
+        "tile_size": int(tiles[0].shape[1]),
+        "results": results,
+    }
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
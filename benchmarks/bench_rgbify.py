@@ -0,0 +1,386 @@
+"""rio-rgbify benchmarks.
+
+Runs offline against synthetic DEMs, and writes results as JSON:
+
+    python benchmarks/bench_rgbify.py --output results.json
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import multiprocessing
+from timeit import default_timer as timer
+
+import click
+import mercantile
+import numpy as np
+import rasterio
+from rasterio import transform
+from click.testing import CliRunner
+
+import rio_rgbify
+from rio_rgbify import mbtiler
+from rio_rgbify.encoders import data_to_rgb, _decode
+from rio_rgbify.mbtiler import (
+    RGBTiler,
+    _encode_as_png,
+    _encode_as_zlib_png,
+    _encode_as_webp,
+    _main_worker,
+    _metatile_worker,
+    _overview_levels,
+)
+from rio_rgbify.scripts.cli import rgbify
+
+# EPSG:3857 upper left corner of the synthetic DEMs (Mount Rainier)
+ORIGIN = (-13548000.0, 5950000.0)
+
+# source pixel size of the synthetic DEMs in meters
+PIXEL_SIZE = 10.0
+
+# zooms of the tile worker benchmarks
+TILE_WORKER_ZOOMS = (12, 14)
+
+
+def synthetic_dem(size, dtype):
+    """
+    Make a (size x size) DEM of smooth terrain plus noise
+    """
+    rows, cols = np.indices((size, size), dtype=np.float64) / size
+    rng = np.random.RandomState(size)
+
+    dem = (
+        1500
+        + 1200 * np.sin(rows * 7.0) * np.cos(cols * 5.0)
+        + 300 * np.sin(rows * 31.0 + cols * 17.0)
+        + rng.normal(0, 2, (size, size))
+    )
+
+    return dem.astype(dtype)
+
+
+def write_dem(path, size, dtype):
+    """
+    Write a synthetic DEM to a tiled GeoTIFF in EPSG:3857
+    """
+    profile = {
+        "driver": "GTiff",
+        "dtype": dtype,
+        "width": size,
+        "height": size,
+        "count": 1,
+        "crs": "EPSG:3857",
+        "transform": transform.from_origin(ORIGIN[0], ORIGIN[1], PIXEL_SIZE, PIXEL_SIZE),
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "compress": "deflate",
+    }
+
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(synthetic_dem(size, dtype), 1)
+
+    return path
+
+
+def measure(func, repeat, number=1):
+    """
+    Time `func`, returning per-call seconds of each repeat
+    """
+    times = []
+
+    for _ in range(repeat):
+        start = timer()
+
+        for _ in range(number):
+            func()
+
+        times.append((timer() - start) / number)
+
+    return times
+
+
+def summarize(name, params, times, **extra):
+    """
+    Make a result record from a list of per-call seconds
+    """
+    record = {
+        "name": name,
+        "params": params,
+        "runs": len(times),
+        "min": min(times),
+        "median": float(np.median(times)),
+        "mean": float(np.mean(times)),
+        "max": max(times),
+    }
+    record.update(extra)
+
+    return record
+
+
+def bench_encoders(sizes, dtypes, repeat):
+    """
+    Benchmark `data_to_rgb` and `_decode`
+    """
+    results = []
+
+    for size in sizes:
+        for dtype in dtypes:
+            data = synthetic_dem(size, dtype)
+            out = np.empty((3, size, size), dtype=np.uint8)
+
+            for interval in (1, 0.1):
+                params = {"size": size, "dtype": dtype, "interval": interval}
+
+                times = measure(lambda: data_to_rgb(data, -10000, interval), repeat)
+                results.append(
+                    summarize("data_to_rgb", params, times, pixels_per_sec=size * size / min(times))
+                )
+
+                times = measure(lambda: data_to_rgb(data, -10000, interval, out=out), repeat)
+                results.append(
+                    summarize("data_to_rgb_out", params, times, pixels_per_sec=size * size / min(times))
+                )
+
+            rgb = data_to_rgb(data, -10000, 0.1)
+            times = measure(lambda: _decode(rgb, -10000, 0.1), repeat)
+            results.append(
+                summarize(
+                    "decode",
+                    {"size": size, "dtype": dtype},
+                    times,
+                    pixels_per_sec=size * size / min(times),
+                )
+            )
+
+    return results
+
+
+def bench_image_encoders(repeat):
+    """
+    Benchmark `_encode_as_png` and `_encode_as_zlib_png` against
+    `_encode_as_webp` on one 512 x 512 tile
+    """
+    rgb = data_to_rgb(synthetic_dem(512, "float32"), -10000, 0.1)
+    profile = {
+        "driver": "PNG",
+        "dtype": "uint8",
+        "height": 512,
+        "width": 512,
+        "count": 3,
+        "crs": "EPSG:3857",
+    }
+    affine = transform.from_origin(ORIGIN[0], ORIGIN[1], PIXEL_SIZE, PIXEL_SIZE)
+
+    results = []
+
+    for name, func in (
+        ("encode_png", lambda: _encode_as_png(rgb, profile.copy(), affine)),
+        ("encode_zlib_png", lambda: _encode_as_zlib_png(rgb, {"zlevel": 6, "png_filter": "sub"})),
+        ("encode_webp", lambda: _encode_as_webp(rgb)),
+    ):
+        times = measure(func, repeat)
+        results.append(summarize(name, {"size": 512}, times, bytes=len(func())))
+
+    return results
+
+
+def bench_tile_worker(path, repeat, zooms=TILE_WORKER_ZOOMS):
+    """
+    Benchmark a single warp + encode of one tile, and of a 4 x 4 metatile
+    """
+    # the worker encodes only the zooms of its tiler
+    with RGBTiler(path, os.devnull, min(zooms), max(zooms), interval=0.1) as tiler:
+        global_args = tiler.global_args
+
+    global_args["overviews"] = _overview_levels(path)
+    _main_worker(path, _metatile_worker, global_args)
+
+    with rasterio.open(path) as src:
+        bounds = src.bounds
+
+    results = []
+
+    try:
+        for z in zooms:
+            # tiles near the center of the source
+            x, y = _center_tile(bounds, z)
+
+            for metatile_size in (1, 4):
+                tiles = [
+                    [x + dx, y + dy, z]
+                    for dx in range(metatile_size)
+                    for dy in range(metatile_size)
+                ]
+                times = measure(lambda: _metatile_worker(tiles), repeat)
+                results.append(
+                    summarize(
+                        "tile_worker",
+                        {"z": z, "metatile_size": metatile_size},
+                        times,
+                        tiles_per_sec=len(tiles) / min(times),
+                    )
+                )
+    finally:
+        mbtiler._close_worker()
+
+    return results
+
+
+def _center_tile(bounds, z):
+    """
+    Tile at the center of EPSG:3857 bounds
+    """
+    lng, lat = mercantile.lnglat(
+        (bounds.left + bounds.right) / 2, (bounds.bottom + bounds.top) / 2
+    )
+    tile = mercantile.tile(lng, lat, z)
+
+    return tile.x, tile.y
+
+
+def bench_tiler(path, workers, min_z, max_z, tmpdir):
+    """
+    Benchmark end to end `RGBTiler.run` at several worker counts,
+    with worker processes and worker threads
+    """
+    results = []
+
+    for processes in workers:
+        for options in ({}, {"metatile_size": 4}, {"executor": "threads"}):
+            outpath = os.path.join(tmpdir, "bench.mbtiles")
+
+            with RGBTiler(path, outpath, min_z, max_z, interval=0.1, stats=True, **options) as tiler:
+                start = timer()
+                tiler.run(processes)
+                seconds = timer() - start
+
+            stats = tiler.stats.to_dict()
+            params = {"processes": processes, "min_z": min_z, "max_z": max_z}
+            params.update(options)
+
+            results.append(
+                summarize(
+                    "tiler_run",
+                    params,
+                    [seconds],
+                    tiles=stats["tiles"],
+                    tiles_per_sec=stats["tiles"] / seconds,
+                    latency=stats["latency"],
+                    stages=stats["stages"],
+                    bytes=os.path.getsize(outpath),
+                )
+            )
+
+    return results
+
+
+def bench_geotiff(path, workers, tmpdir):
+    """
+    Benchmark end to end `rio rgbify` GeoTIFF output at several worker counts
+    """
+    results = []
+    runner = CliRunner()
+
+    with rasterio.open(path) as src:
+        pixels = src.width * src.height
+
+    for processes in workers:
+        outpath = os.path.join(tmpdir, "bench-rgb.tif")
+
+        start = timer()
+        result = runner.invoke(
+            rgbify,
+            [path, outpath, "--interval", 0.1, "--base-val", -10000, "-j", processes],
+        )
+        seconds = timer() - start
+
+        if result.exit_code != 0:
+            raise RuntimeError(result.output)
+
+        results.append(
+            summarize(
+                "rgbify_geotiff",
+                {"processes": processes},
+                [seconds],
+                pixels_per_sec=pixels / seconds,
+            )
+        )
+
+    return results
+
+
+def environment():
+    """
+    Describe the machine and library versions results were made with
+    """
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "rio_rgbify": rio_rgbify.__version__,
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+    }
+
+
+@click.command()
+@click.option(
+    "--output", "-o", type=click.Path(), default=None, help="Write results to this JSON file"
+)
+@click.option("--repeat", type=int, default=5, help="Repeats of each micro benchmark [DEFAULT=5]")
+@click.option(
+    "--workers",
+    "-j",
+    type=int,
+    multiple=True,
+    default=[1, 2, 4],
+    help="Worker counts of end to end benchmarks [DEFAULT=1, 2, 4]",
+)
+@click.option("--quick", is_flag=True, default=False, help="Use small inputs only")
+def main(output, repeat, workers, quick):
+    """Run rio-rgbify benchmarks."""
+    sizes = [256, 1024] if quick else [256, 1024, 4096]
+    dtypes = ["int16", "float32", "float64"]
+    tile_source = 2048 if quick else 8192
+
+    tmpdir = tempfile.mkdtemp(prefix="rgbify-bench-")
+
+    try:
+        path = write_dem(os.path.join(tmpdir, "dem.tif"), tile_source, "float32")
+
+        results = []
+        results.extend(bench_encoders(sizes, dtypes, repeat))
+        results.extend(bench_image_encoders(repeat))
+        results.extend(bench_tile_worker(path, repeat))
+        results.extend(bench_tiler(path, workers, 10, 13 if quick else 14, tmpdir))
+        results.extend(bench_geotiff(path, workers, tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = {"environment": environment(), "results": results}
+
+    for record in results:
+        click.echo(
+            "{0:<16} {1:<60} {2:10.4f}s".format(
+                record["name"], json.dumps(record["params"], sort_keys=True), record["min"]
+            ),
+            err=True,
+        )
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
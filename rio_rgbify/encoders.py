@@ -1,8 +1,14 @@
 from __future__ import division
 import numpy as np
 
+# number of elements encoded at a time; keeps scratch arrays in cache
+BLOCK_SIZE = 2 ** 16
 
-def data_to_rgb(data, baseval, interval, round_digits=0):
+# most less significant bits that can be rounded away of 3 base 256 digits
+MAX_ROUND_DIGITS = 23
+
+
+def data_to_rgb(data, baseval, interval, round_digits=0, out=None):
     """
     Given an arbitrary (rows x cols) ndarray,
     encode the data into uint8 RGB from an arbitrary
@@ -19,6 +25,10 @@ def data_to_rgb(data, baseval, interval, round_digits=0):
         the interval at which to encode
     round_digits: int
         erased less significant digits
+    out: ndarray
+        optional C-contiguous uint8 (3 x rows x cols) ndarray to
+        write the encoded data into. Its contents are undefined
+        if a ValueError is raised.
 
     Returns
     --------
@@ -26,34 +36,139 @@ def data_to_rgb(data, baseval, interval, round_digits=0):
         a uint8 (3 x rows x cols) ndarray with the
         data encoded
     """
-    data = data.astype(np.float64)
-    data -= baseval
-    data /= interval
+    data = np.asarray(data)
+    shape = (3,) + data.shape
+
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError(
+            "Output of {0} {1} must be a C-contiguous uint8 {2} array".format(
+                out.shape, out.dtype, shape
+            )
+        )
+
+    values = data.reshape(-1)
+    red, green, blue = (band.reshape(-1) for band in out)
+
+    # integers can be quantized exactly without a float round trip
+    integral = (
+        values.dtype.kind in "iu"
+        and values.dtype.itemsize <= 4
+        and interval == 1
+        and round_digits == 0
+        and baseval == int(baseval)
+    )
+
+    size = min(values.size, BLOCK_SIZE)
+    quantized = np.empty(size, dtype=np.int64)
+    channel = np.empty(size, dtype=np.int64)
+    scratch = None if integral else np.empty(size, dtype=np.float64)
+    scale = 2 ** round_digits
+
+    datamin = datamax = None
+
+    for start in range(0, values.size, BLOCK_SIZE):
+        block = values[start : start + BLOCK_SIZE]
+        n = block.size
+        q = quantized[:n]
+        c = channel[:n]
 
-    data = np.around(data / 2**round_digits) * 2**round_digits
+        if integral:
+            np.subtract(block, int(baseval), out=q, dtype=np.int64)
+            blockmin, blockmax = q.min(), q.max()
+        else:
+            f = scratch[:n]
+            np.subtract(block, baseval, out=f, dtype=np.float64)
+            f /= interval
 
-    rows, cols = data.shape
+            if round_digits != 0:
+                f /= scale
+                np.rint(f, out=f)
+                f *= scale
+            else:
+                np.rint(f, out=f)
 
-    datarange = data.max() - data.min()
+            blockmin, blockmax = f.min(), f.max()
+            np.copyto(q, f, casting="unsafe")
+
+        # NaN propagates through both, and passes the range check like before
+        if datamin is None:
+            datamin, datamax = blockmin, blockmax
+        else:
+            datamin = np.minimum(datamin, blockmin)
+            datamax = np.maximum(datamax, blockmax)
+
+        # base 256 digits; an arithmetic shift floors negative values
+        np.bitwise_and(q, 0xFF, out=c)
+        np.copyto(blue[start : start + n], c, casting="unsafe")
+        np.right_shift(q, 8, out=q)
+        np.bitwise_and(q, 0xFF, out=c)
+        np.copyto(green[start : start + n], c, casting="unsafe")
+        np.right_shift(q, 8, out=q)
+        np.bitwise_and(q, 0xFF, out=c)
+        np.copyto(red[start : start + n], c, casting="unsafe")
+
+    if datamin is None:
+        raise ValueError("Data of size 0 cannot be encoded")
+
+    datarange = datamax - datamin
 
     if _range_check(datarange):
         raise ValueError("Data of {} larger than 256 ** 3".format(datarange))
 
-    rgb = np.zeros((3, rows, cols), dtype=np.uint8)
+    return out
 
-    rgb[2] = ((data / 256) - (data // 256)) * 256
-    rgb[1] = (((data // 256) / 256) - ((data // 256) // 256)) * 256
-    rgb[0] = ((((data // 256) // 256) / 256) - (((data // 256) // 256) // 256)) * 256
 
-    return rgb
+def decode(rgb, base_val, interval, dtype=np.float64, out=None):
+    """
+    Decode RGB encoded data back into values: the inverse of `data_to_rgb`
+
+    Parameters
+    -----------
+    rgb: ndarray
+        (3 x rows x cols) ndarray of encoded data
+    base_val: float
+        the base value the data was encoded from
+    interval: float
+        the interval the data was encoded at
+    dtype: str or numpy dtype
+        float dtype of the decoded values
+        Default=float64
+    out: ndarray
+        optional (rows x cols) ndarray to write the decoded values into,
+        instead of a new array of `dtype`
+
+    Returns
+    --------
+    ndarray
+        (rows x cols) ndarray of decoded values
+    """
+    rgb = np.asarray(rgb)
+
+    if out is None:
+        out = np.empty(rgb.shape[1:], dtype=dtype)
+    elif out.shape != rgb.shape[1:]:
+        raise ValueError(
+            "Output of {0} must be a {1} array".format(out.shape, rgb.shape[1:])
+        )
+
+    # the 24 bit integers are exact in float32, before scaling
+    values = np.left_shift(rgb[0], 16, dtype=np.uint32)
+    values |= np.left_shift(rgb[1], 8, dtype=np.uint32)
+    values |= rgb[2]
+
+    np.multiply(values, interval, out=out, casting="unsafe")
+    out += base_val
+
+    return out
 
 
 def _decode(data, base, interval):
     """
-    Utility to decode RGB encoded data
+    Utility to decode RGB encoded data into float64 values; see `decode`
     """
-    data = data.astype(np.float64)
-    return base + (((data[0] * 256 * 256) + (data[1] * 256) + data[2]) * interval)
+    return decode(data, base, interval)
 
 
 def _range_check(datarange):
@@ -63,3 +178,80 @@ def _range_check(datarange):
     maxrange = 256 ** 3
 
     return datarange > maxrange
+
+
+def _rounding_error(data, baseval, interval, round_digits):
+    """
+    Absolute error of each value of data encoded with `data_to_rgb`,
+    then decoded with `_decode`
+
+    Parameters
+    -----------
+    data: ndarray
+        (rows x cols) ndarray of data to encode
+    baseval, interval, round_digits:
+        see `data_to_rgb`
+
+    Returns
+    --------
+    ndarray
+        (rows x cols) float64 ndarray of absolute errors
+    """
+    data = np.asarray(data, dtype=np.float64)
+    scale = 2 ** round_digits
+
+    quantized = np.rint((data - baseval) / interval / scale) * scale
+    quantized *= interval
+    quantized += baseval
+    quantized -= data
+
+    return np.abs(quantized, out=quantized)
+
+
+def _coarsest_round_digits(data, baseval, interval, max_error):
+    """
+    Pick the most less significant bits that can be rounded away
+    while keeping the error of every value within a budget
+
+    Rounding away `round_digits` bits has an error of at most
+    `interval * 2 ** round_digits / 2`, so the search starts from the
+    largest `round_digits` within that bound, then measures the error
+    of coarser roundings of the data itself.
+
+    Parameters
+    -----------
+    data: ndarray
+        (rows x cols) ndarray of data to encode
+    baseval, interval:
+        see `data_to_rgb`
+    max_error: float
+        largest absolute error allowed, in data units
+
+    Returns
+    --------
+    round_digits, error, squared_error
+        round_digits to encode the data with, and the largest and summed
+        squared absolute errors of the data encoded with it. If no rounding
+        is within the budget, round_digits is 0.
+    """
+    bound = 2 * max_error / interval
+    round_digits = int(np.floor(np.log2(bound))) if bound >= 1 else 0
+    round_digits = min(max(round_digits, 0), MAX_ROUND_DIGITS)
+
+    error = _rounding_error(data, baseval, interval, round_digits)
+
+    # the bound is exact, but floating point error is not
+    while round_digits > 0 and error.max() > max_error:
+        round_digits -= 1
+        error = _rounding_error(data, baseval, interval, round_digits)
+
+    while round_digits < MAX_ROUND_DIGITS:
+        coarser = _rounding_error(data, baseval, interval, round_digits + 1)
+
+        if coarser.max() > max_error:
+            break
+
+        round_digits += 1
+        error = coarser
+
+    return round_digits, float(error.max()), float(np.dot(error.ravel(), error.ravel()))
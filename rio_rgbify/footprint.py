@@ -0,0 +1,304 @@
+"""Footprints of sources: which tiles of a zoom can hold data, or have changed"""
+from __future__ import division
+
+import json
+import math
+
+import numpy as np
+import rasterio
+from rasterio import transform
+from rasterio.enums import Resampling
+from rasterio.features import bounds as geometry_bounds, rasterize
+from rasterio.warp import reproject, transform_bounds, transform_geom
+
+from rio_rgbify.sources import MERCATOR_EXTENT
+
+# cells across the longer side of a coverage grid
+COVERAGE_SIZE = 2048
+
+# fraction of a cell that blocks of tiles may overlap it by from rounding errors
+CELL_TOLERANCE = 1e-6
+
+# pixels of each zoom that extents are grown by: the reach of the resampling
+# kernels that warp tiles and build lower zooms of a pyramid
+PIXEL_PADDING = 2
+
+
+def _coverage_grid(bounds, size=COVERAGE_SIZE, resolution=0):
+    """
+    Grid of square cells over EPSG:3857 bounds, `size` cells across
+    their longer side, or fewer cells of `resolution` meters
+
+    Returns
+    --------
+    transform, width, height
+        affine transform and size of the grid
+    """
+    w, s, e, n = bounds
+    cell = max(max(e - w, n - s) / size, resolution)
+
+    if not cell > 0:
+        raise ValueError("Footprint bounds of {0} are empty".format(list(bounds)))
+
+    width = max(1, int(math.ceil((e - w) / cell)))
+    height = max(1, int(math.ceil((n - s) / cell)))
+
+    return transform.from_origin(w, n, cell, cell), width, height
+
+
+def _dilate(covered):
+    """
+    Grow a boolean grid by one cell in all eight directions
+    """
+    rows = covered.copy()
+    rows[1:] |= covered[:-1]
+    rows[:-1] |= covered[1:]
+
+    grown = rows.copy()
+    grown[:, 1:] |= rows[:, :-1]
+    grown[:, :-1] |= rows[:, 1:]
+
+    return grown
+
+
+def _geometries(geojson):
+    """
+    Geometries of a GeoJSON geometry, Feature or FeatureCollection
+    """
+    kind = geojson.get("type")
+
+    if kind == "FeatureCollection":
+        return [feature["geometry"] for feature in geojson["features"] if feature["geometry"]]
+
+    if kind == "Feature":
+        return [geojson["geometry"]] if geojson["geometry"] else []
+
+    if kind == "GeometryCollection":
+        return list(geojson["geometries"])
+
+    if kind is not None and "coordinates" in geojson:
+        return [geojson]
+
+    raise ValueError("{0} is not a supported GeoJSON type!".format(kind))
+
+
+class Footprint(object):
+    """
+    Coverage of sources on a coarse EPSG:3857 grid, grown by one cell so
+    that no tile with data is missed, with its integral image to test any
+    block of tiles in constant time. Picklable.
+
+    Parameters
+    -----------
+    covered: ndarray
+        (rows x cols) boolean array of cells with data
+    grid_transform: Affine
+        transform of the grid in EPSG:3857
+    """
+
+    def __init__(self, covered, grid_transform):
+        covered = _dilate(np.asarray(covered, dtype=bool))
+
+        rows, cols = covered.shape
+        self.transform = grid_transform
+        self.shape = covered.shape
+
+        # integral[r, c] counts the covered cells above and left of cell (r, c)
+        self.integral = np.zeros((rows + 1, cols + 1), dtype=np.int32)
+        np.cumsum(np.cumsum(covered, axis=0), axis=1, out=self.integral[1:, 1:])
+
+    @classmethod
+    def from_levels(cls, levels, bounds, size=COVERAGE_SIZE):
+        """
+        Coverage of the valid data of band 1 of a source, warped from the
+        coarsest of its levels at least as fine as the grid, and no finer
+        than the source. A cell is covered if any valid source pixel
+        falls in it.
+
+        Parameters
+        -----------
+        levels: list
+            (resolution, path, open kwargs) of the source and its
+            overviews, from finest to coarsest
+        bounds: list
+            [w, s, e, n] EPSG:3857 bounds of the source
+        size: int
+            cells across the longer side of the grid
+            Default=COVERAGE_SIZE
+
+        Returns
+        --------
+        Footprint
+        """
+        grid_transform, width, height = _coverage_grid(bounds, size, levels[0][0])
+
+        level = levels[0]
+        for candidate in levels:
+            if candidate[0] <= grid_transform.a:
+                level = candidate
+
+        _, path, kwargs = level
+        grid = np.empty((height, width), dtype=np.float32)
+
+        with rasterio.open(path, **kwargs) as src:
+            reproject(
+                rasterio.band(src, 1),
+                grid,
+                dst_transform=grid_transform,
+                dst_crs="EPSG:3857",
+                dst_nodata=np.nan,
+                init_dest_nodata=True,
+                resampling=Resampling.max,
+            )
+
+        return cls(~np.isnan(grid), grid_transform)
+
+    @classmethod
+    def from_geojson(cls, geojson, size=COVERAGE_SIZE):
+        """
+        Coverage of the polygons of a GeoJSON geometry, Feature or
+        FeatureCollection in EPSG:4326. A cell is covered if any polygon
+        touches it.
+
+        Parameters
+        -----------
+        geojson: string or dict
+            filepath of a GeoJSON file, or a GeoJSON object
+        size: int
+            cells across the longer side of the grid
+            Default=COVERAGE_SIZE
+
+        Returns
+        --------
+        Footprint
+        """
+        if not isinstance(geojson, dict):
+            with open(geojson) as f:
+                geojson = json.load(f)
+
+        geometries = [
+            transform_geom("EPSG:4326", "EPSG:3857", geometry)
+            for geometry in _geometries(geojson)
+        ]
+
+        if not geometries:
+            raise ValueError("Footprint has no geometries")
+
+        boxes = np.array([geometry_bounds(geometry) for geometry in geometries])
+        bounds = np.clip(
+            [boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()],
+            -MERCATOR_EXTENT,
+            MERCATOR_EXTENT,
+        )
+
+        grid_transform, width, height = _coverage_grid(bounds, size)
+
+        covered = rasterize(
+            [(geometry, 1) for geometry in geometries],
+            out_shape=(height, width),
+            transform=grid_transform,
+            all_touched=True,
+            dtype=np.uint8,
+        )
+
+        return cls(covered > 0, grid_transform)
+
+    def covers(self, min_x, min_y, max_x, max_y, z):
+        """
+        Whether any tile of a block of tiles of a zoom touches a covered cell
+
+        Parameters
+        -----------
+        min_x, min_y, max_x, max_y: int
+            indices of the upper left and lower right tiles of the block
+        z: int
+            zoom of the tiles
+
+        Returns
+        --------
+        bool
+        """
+        tile = 2 * MERCATOR_EXTENT / 2 ** z
+        cell = self.transform.a
+        rows, cols = self.shape
+
+        west = -MERCATOR_EXTENT + min_x * tile - self.transform.c
+        east = -MERCATOR_EXTENT + (max_x + 1) * tile - self.transform.c
+        north = self.transform.f - (MERCATOR_EXTENT - min_y * tile)
+        south = self.transform.f - (MERCATOR_EXTENT - (max_y + 1) * tile)
+
+        # cells the block overlaps; blocks that only touch a cell do not
+        col0 = min(max(int(math.floor(west / cell + CELL_TOLERANCE)), 0), cols)
+        col1 = min(max(int(math.ceil(east / cell - CELL_TOLERANCE)), 0), cols)
+        row0 = min(max(int(math.floor(north / cell + CELL_TOLERANCE)), 0), rows)
+        row1 = min(max(int(math.ceil(south / cell - CELL_TOLERANCE)), 0), rows)
+
+        if col0 >= col1 or row0 >= row1:
+            return False
+
+        integral = self.integral
+        count = (
+            integral[row1, col1] - integral[row0, col1] - integral[row1, col0] + integral[row0, col0]
+        )
+
+        return bool(count > 0)
+
+
+class Extents(object):
+    """
+    Boxes in EPSG:4326, such as the extents of changed source data,
+    tested against blocks of tiles exactly rather than on a grid. Each
+    box is grown by `padding` meters, and by `PIXEL_PADDING` pixels of
+    the tiles of each zoom, so tiles that resample pixels within a box
+    are included. Tests like a `Footprint`. Picklable.
+
+    Parameters
+    -----------
+    bounds: list
+        [w, s, e, n] boxes in EPSG:4326
+    padding: float
+        EPSG:3857 meters to grow each box by, such as a source pixel
+        Default=0
+    tile_size: int
+        width and height of tiles in pixels
+        Default=512
+    """
+
+    def __init__(self, bounds, padding=0, tile_size=512):
+        boxes = [
+            transform_bounds("EPSG:4326", "EPSG:3857", *box, densify_pts=21)
+            for box in bounds
+        ]
+
+        if not boxes:
+            raise ValueError("At least one extent is needed")
+
+        self.boxes = np.clip(
+            np.array(boxes, dtype=np.float64), -MERCATOR_EXTENT, MERCATOR_EXTENT
+        )
+        self.padding = padding
+        self.tile_size = tile_size
+
+    def covers(self, min_x, min_y, max_x, max_y, z):
+        """
+        Whether any tile of a block of tiles of a zoom overlaps a grown
+        box; see `Footprint.covers`
+        """
+        tile = 2 * MERCATOR_EXTENT / 2 ** z
+        pad = self.padding + PIXEL_PADDING * tile / self.tile_size
+
+        west = -MERCATOR_EXTENT + min_x * tile
+        east = -MERCATOR_EXTENT + (max_x + 1) * tile
+        north = MERCATOR_EXTENT - min_y * tile
+        south = MERCATOR_EXTENT - (max_y + 1) * tile
+
+        boxes = self.boxes
+
+        return bool(
+            np.any(
+                (boxes[:, 0] - pad < east)
+                & (boxes[:, 2] + pad > west)
+                & (boxes[:, 1] - pad < north)
+                & (boxes[:, 3] + pad > south)
+            )
+        )
@@ -0,0 +1,310 @@
+"""Encode a source raster into an RGB GeoTIFF, and decode one back"""
+from __future__ import division
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from rio_rgbify.encoders import data_to_rgb, decode
+
+# MB of source and rgb windows held in memory at once by default
+MEMORY_BUDGET = 256
+
+# windows read, encoded or waiting to be written per thread, at most
+WINDOWS_PER_THREAD = 2
+
+# creation options of decoded GeoTIFFs, unless overridden
+DECODED_OPTIONS = {
+    "tiled": True,
+    "blockxsize": 256,
+    "blockysize": 256,
+    "compress": "deflate",
+    "predictor": 3,
+}
+
+
+def _window_shape(height, width, block_shapes, pixels):
+    """
+    Shape of windows aligned to the blocks of both the source and the
+    destination: full width strips as tall as fit in `pixels`, or for
+    very wide rasters, the narrowest aligned strips cut into columns.
+    Windows are never smaller than one aligned block, whatever `pixels`.
+
+    Parameters
+    -----------
+    height, width: int
+        size of the raster
+    block_shapes: list
+        (rows, cols) block shapes of the source and the destination
+    pixels: int
+        pixels each window may hold at most
+
+    Returns
+    --------
+    rows, cols: int
+        size of each window, except at the right and bottom edges
+    """
+    row_step = int(np.lcm.reduce([rows for rows, _ in block_shapes]))
+    col_step = int(np.lcm.reduce([cols for _, cols in block_shapes]))
+
+    if row_step * width <= pixels:
+        rows = max(row_step, pixels // width // row_step * row_step)
+        return min(rows, height), width
+
+    cols = max(col_step, pixels // row_step // col_step * col_step)
+
+    return min(row_step, height), min(cols, width)
+
+
+def _windows(height, width, rows, cols):
+    """
+    Windows of `rows` x `cols` covering a raster in row major order
+    """
+    for row in range(0, height, rows):
+        for col in range(0, width, cols):
+            yield Window(col, row, min(cols, width - col), min(rows, height - row))
+
+
+def _map_window(readers, window, indexes, func, args):
+    """
+    Read bands `indexes` of a window with a free source handle,
+    and map `func(data, *args)` over them
+    """
+    src = readers.get()
+
+    try:
+        data = src.read(indexes, window=window)
+    finally:
+        readers.put(src)
+
+    return func(data, *args)
+
+
+def _decode_window(rgb, base_val, interval):
+    """
+    Decode a window of RGB data into a (1 x rows x cols) float32 array
+    """
+    return decode(rgb, base_val, interval, np.float32)[np.newaxis]
+
+
+def _map_windows(inpath, outpath, indexes, profile, func, args, threads, memory_budget, itemsize):
+    """
+    Map a function over windows of a source into a new raster. Windows
+    aligned to the blocks of the source and the output are read and
+    mapped by a pool of threads, each reading through its own source
+    handle, and written in order as they finish.
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the source
+    outpath: string
+        filepath of the output
+    indexes: int or list
+        band or bands of the source to read
+    profile: dict
+        profile of the output
+    func: callable
+        called with the data of a window and `args`, returning its output data
+    args: tuple
+        further arguments of `func`
+    threads: int
+        threads reading and mapping windows
+    memory_budget: int
+        MB of windows held in memory at once, or None
+    itemsize: int
+        bytes a pixel of a window and its output take together
+
+    Returns
+    --------
+    None
+    """
+    if threads < 1:
+        raise ValueError("{0} threads is not a supported number of threads!".format(threads))
+
+    if memory_budget is None:
+        memory_budget = MEMORY_BUDGET
+    elif memory_budget < 1:
+        raise ValueError("Memory budget of {0} MB is not supported!".format(memory_budget))
+
+    with rasterio.open(inpath) as src:
+        first = indexes if isinstance(indexes, int) else indexes[0]
+        block_shape = src.block_shapes[first - 1]
+
+    readers = Queue()
+    in_flight = WINDOWS_PER_THREAD * threads
+    pixels = memory_budget * 1024 * 1024 // (in_flight * itemsize)
+
+    pool = ThreadPool(threads)
+
+    try:
+        for _ in range(threads):
+            readers.put(rasterio.open(inpath))
+
+        with rasterio.open(outpath, "w", **profile) as dst:
+            rows, cols = _window_shape(
+                dst.height, dst.width, [block_shape, dst.block_shapes[0]], pixels
+            )
+
+            pending = deque()
+
+            for window in _windows(dst.height, dst.width, rows, cols):
+                pending.append(
+                    (
+                        window,
+                        pool.apply_async(_map_window, (readers, window, indexes, func, args)),
+                    )
+                )
+
+                # write in order, holding at most `in_flight` windows
+                if len(pending) >= in_flight:
+                    window, result = pending.popleft()
+                    dst.write(result.get(), window=window)
+
+            while pending:
+                window, result = pending.popleft()
+                dst.write(result.get(), window=window)
+    finally:
+        pool.terminate()
+        pool.join()
+
+        while not readers.empty():
+            readers.get().close()
+
+
+def encode_geotiff(
+    inpath,
+    outpath,
+    base_val=0,
+    interval=1,
+    round_digits=0,
+    bidx=1,
+    options=None,
+    threads=4,
+    memory_budget=None,
+):
+    """
+    Encode a band of a source raster into a 3 band uint8 RGB GeoTIFF.
+    Windows aligned to the blocks of the source and the output are read
+    and encoded by a pool of threads, each reading through its own source
+    handle, and written in order as they finish.
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the source file to read and encode
+    outpath: string
+        filepath of the output GeoTIFF
+    base_val: float
+        the base value of the RGB numbering system
+    interval: float
+        the interval at which to encode
+    round_digits: int
+        erased less significant digits
+    bidx: int
+        band of the source to encode
+        Default=1
+    options: dict
+        creation options of the output, on top of the source profile
+    threads: int
+        threads reading and encoding windows
+        Default=4
+    memory_budget: int
+        MB of windows held in memory at once
+        Default=MEMORY_BUDGET
+
+    Returns
+    --------
+    None
+    """
+    with rasterio.open(inpath) as src:
+        if not 1 <= bidx <= src.count:
+            raise ValueError("Band {0} is not a band of {1}!".format(bidx, inpath))
+
+        profile = src.profile.copy()
+        itemsize = np.dtype(src.dtypes[bidx - 1]).itemsize
+
+    profile.update(count=3, dtype=np.uint8)
+    profile.update(options or {})
+
+    # each pixel in flight holds a source value and three encoded bytes
+    _map_windows(
+        inpath,
+        outpath,
+        bidx,
+        profile,
+        data_to_rgb,
+        (base_val, interval, round_digits),
+        threads,
+        memory_budget,
+        itemsize + 3,
+    )
+
+
+def decode_geotiff(
+    inpath,
+    outpath,
+    base_val=0,
+    interval=1,
+    options=None,
+    threads=4,
+    memory_budget=None,
+):
+    """
+    Decode an RGB GeoTIFF, such as written by `encode_geotiff`, back into
+    a 1 band float32 GeoTIFF, tiled and compressed unless `options` say
+    otherwise. Windows are read, decoded and written as by `encode_geotiff`.
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the RGB GeoTIFF to decode
+    outpath: string
+        filepath of the output GeoTIFF
+    base_val: float
+        the base value the GeoTIFF was encoded from
+    interval: float
+        the interval the GeoTIFF was encoded at
+    options: dict
+        creation options of the output, on top of `DECODED_OPTIONS`
+    threads: int
+        threads reading and decoding windows
+        Default=4
+    memory_budget: int
+        MB of windows held in memory at once
+        Default=MEMORY_BUDGET
+
+    Returns
+    --------
+    None
+    """
+    with rasterio.open(inpath) as src:
+        if src.count < 3:
+            raise ValueError("{0} is not an RGB GeoTIFF".format(inpath))
+
+        profile = src.profile.copy()
+
+    profile.update(DECODED_OPTIONS)
+    profile.update(count=1, dtype=np.float32, nodata=None)
+    profile.update(options or {})
+
+    # each pixel in flight holds three encoded bytes and a decoded value
+    _map_windows(
+        inpath,
+        outpath,
+        [1, 2, 3],
+        profile,
+        _decode_window,
+        (base_val, interval),
+        threads,
+        memory_budget,
+        3 + 4,
+    )
@@ -2,214 +2,1783 @@ from __future__ import with_statement
 from __future__ import division
 
 import os
-import sys
+import json
 import math
+import copy
+import shutil
+import hashlib
+import tempfile
+import threading
 import traceback
 import itertools
+import functools
+import uuid
+from timeit import default_timer as timer
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
+
+try:
+    from concurrent.futures import Executor, ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    Executor = ThreadPoolExecutor = None
 
 import mercantile
 import rasterio
 import numpy as np
-import sqlite3
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 from rasterio._io import virtual_file_to_buffer
 from riomucho.single_process_pool import MockTub
 
-from io import BytesIO
-from PIL import Image
+from io import BytesIO
+from PIL import Image
+
+from rasterio import transform, Affine
+from rasterio.windows import Window
+from rasterio.warp import reproject, transform_bounds
+from rasterio.transform import array_bounds
+
+from rasterio.enums import Resampling
+
+from rio_rgbify.encoders import data_to_rgb, _decode, _coarsest_round_digits
+from rio_rgbify.footprint import PIXEL_PADDING, Extents, Footprint
+from rio_rgbify.png import PNG_FILTERS, encode_png
+from rio_rgbify.profiling import (
+    dump_profiles,
+    merge_profiles,
+    profiled,
+    reset_profiles,
+    sampled,
+    worker_profile_path,
+)
+from rio_rgbify.sources import SourceIndex, SourceCache
+from rio_rgbify.stats import TilerStats, _stamp
+from rio_rgbify.writers import (
+    WRITERS,
+    DURABILITY_LEVELS,
+    _make_writer,
+    _writer_for,
+    _tile_id,
+)
+
+# supported tile widths and heights in pixels
+TILE_SIZES = (256, 512, 1024)
+
+# png encoders: numpy + zlib, or a GDAL dataset written to /vsimem
+PNG_ENCODERS = ("zlib", "gdal")
+
+# metadata recording the measured precision of tiles encoded with a `max_error`
+PRECISION_METADATA = "rgbify_precision"
+
+# number of rgb tile hashes each worker remembers for deduplication
+SEEN_TILES_MAX = 4096
+
+# resampling methods for building lower zooms in pyramid mode
+PYRAMID_RESAMPLING = (
+    "nearest",
+    "bilinear",
+    "cubic",
+    "cubic_spline",
+    "lanczos",
+    "average",
+    "mode",
+)
+
+# ways of using source overviews for lower zooms
+OVERVIEW_MODES = ("auto", "none", "build")
+
+# width of the world in EPSG:3857 meters
+WORLD_SIZE = 2 * math.pi * 6378137
+
+# tiles submitted to workers but not yet queued for writing, at most
+MAX_IN_FLIGHT = 1024
+
+# batches of tiles waiting for the writer thread, at most
+WRITE_QUEUE_SIZE = 4
+
+# largest automatically picked number of jobs per worker task
+MAX_CHUNKSIZE = 16
+
+# orders to make the tiles of each zoom in
+ORDERINGS = ("hilbert", "zorder", "columns")
+
+# ways of finding the tiles to make, besides the polygons of a GeoJSON footprint
+FOOTPRINT_MODES = ("mask", "none")
+
+# pools of workers to make tiles with, besides a concurrent.futures.Executor
+EXECUTORS = ("processes", "threads")
+
+# shares of a worker's memory budget given to the GDAL block cache and to
+# warp buffers; the rest is left for tile arrays and encoding
+BUDGET_CACHE_SHARE = 0.5
+BUDGET_WARP_SHARE = 0.25
+
+# squares of this many tiles across are walked with a precomputed curve
+CURVE_LEAF_SIZE = 16
+
+# local (u, v) tiles of a square of CURVE_LEAF_SIZE, in Hilbert and Z-order
+_CURVE_LEAVES = {
+    True: sorted(
+        itertools.product(range(CURVE_LEAF_SIZE), repeat=2),
+        key=lambda uv: _tile_id(4, uv[0], uv[1]),
+    ),
+    False: sorted(
+        itertools.product(range(CURVE_LEAF_SIZE), repeat=2),
+        key=lambda uv: sum(
+            ((uv[0] >> i) & 1) << (2 * i) | ((uv[1] >> i) & 1) << (2 * i + 1)
+            for i in range(4)
+        ),
+    ),
+}
+
+
+class _WorkerState(threading.local):
+    """
+    State of a tile worker: of the worker process, or of each thread
+    of a worker thread pool
+    """
+
+    def __init__(self):
+        self.run_id = None
+        self.work_func = None
+        self.global_args = None
+        self.src = None
+        self.reader = None
+        self.seen_tiles = {}
+        self.rgb_buffer = None
+        self.sources = {}
+        self.gdal_env = None
+        self.source_cache = None
+        self.source_levels = {}
+
+
+_worker = _WorkerState()
+
+
+def _main_worker(inpath, g_work_func, g_args):
+    """
+    Util for setting worker state w/ a Pool
+    """
+    _worker.work_func = g_work_func
+    _worker.global_args = g_args
+    _worker.seen_tiles = {}
+    _worker.rgb_buffer = None
+    _worker.sources = {}
+    _worker.source_levels = {}
+
+    # readers connect on their first read, so each thread needs its own
+    if g_args.get("reader") is not None:
+        _worker.reader = copy.copy(g_args["reader"])
+
+    # GDAL options for the lifetime of the worker
+    _worker.gdal_env = rasterio.Env(**g_args.get("env", {}))
+    _worker.gdal_env.__enter__()
+
+    # worker processes dump their profiles when they exit
+    if g_args.get("profile_dir") is not None and os.getpid() != g_args["profile_pid"]:
+        reset_profiles()
+        Finalize(
+            None,
+            dump_profiles,
+            args=(worker_profile_path(g_args["profile_dir"]),),
+            exitpriority=10,
+        )
+
+    # mosaics open their sources as tiles need them
+    if g_args.get("mosaic") is not None:
+        _worker.source_cache = SourceCache()
+    else:
+        _worker.src = rasterio.open(inpath)
+
+
+def _close_worker():
+    """
+    Util for closing the datasets and connections a worker has opened
+    """
+    for dataset in _worker.sources.values():
+        dataset.close()
+    _worker.sources.clear()
+
+    if _worker.source_cache is not None:
+        _worker.source_cache.close()
+        _worker.source_cache = None
+
+    if _worker.reader is not None:
+        _worker.reader.close()
+        _worker.reader = None
+
+    if _worker.src is not None:
+        _worker.src.close()
+        _worker.src = None
+
+    if _worker.gdal_env is not None:
+        _worker.gdal_env.__exit__()
+        _worker.gdal_env = None
+
+    _worker.run_id = None
+
+
+def _close_thread_workers(pool, threads):
+    """
+    Close the worker state of each thread of a `ThreadPool`, which lives
+    in a thread local, so only its own thread can close it. One task is
+    sent per thread, and each waits until all have closed their state,
+    so that no thread takes two of them.
+
+    Parameters
+    -----------
+    pool: multiprocessing.pool.ThreadPool
+        pool of worker threads
+    threads: int
+        number of threads of the pool
+    """
+    closed = [0]
+    condition = threading.Condition()
+
+    def close(_):
+        _close_worker()
+
+        with condition:
+            closed[0] += 1
+            condition.notify_all()
+
+            while closed[0] < threads:
+                condition.wait()
+
+    pool.map(close, range(threads), chunksize=1)
+
+
+def _executor_task(func, jobs, run_id, inpath, g_work_func, g_args):
+    """
+    Run `func` over jobs in a worker of a `concurrent.futures.Executor`,
+    setting up its state the first time it runs a job of run `run_id`
+
+    Returns
+    --------
+    list
+        the result of each job
+    """
+    if _worker.run_id != run_id:
+        _close_worker()
+        _main_worker(inpath, g_work_func, g_args)
+        _worker.run_id = run_id
+
+    return [func(job) for job in jobs]
+
+
+class _ExecutorPool(object):
+    """
+    Adapts a `concurrent.futures.Executor` to the `imap_unordered` of a
+    `multiprocessing.Pool`. Jobs are submitted in chunks from a feeder
+    thread, so a throttled job iterator only blocks the feeder. Each worker
+    sets itself up on its first chunk of a run, and keeps its datasets open
+    until it runs a chunk of another run. The executor is not shut down.
+
+    Parameters
+    -----------
+    executor: concurrent.futures.Executor
+        executor to submit jobs to
+    inpath: string or list
+        source of the run
+    work_func: function
+        worker function of the run
+    g_args: dict
+        global args of the run
+    """
+
+    def __init__(self, executor, inpath, work_func, g_args):
+        self.executor = executor
+        self.initargs = (uuid.uuid4().hex, inpath, work_func, g_args)
+
+    def imap_unordered(self, func, jobs, chunksize=1):
+        """
+        Map `func` over jobs, yielding results as chunks finish
+        """
+        done = Queue()
+        thread = threading.Thread(target=self._feed, args=(func, jobs, chunksize, done))
+        thread.daemon = True
+        thread.start()
+
+        received = 0
+        submitted = None
+
+        while submitted is None or received < submitted:
+            future = done.get()
+
+            # the feeder ends with the number of chunks it submitted, or its error
+            if isinstance(future, Exception):
+                raise future
+
+            if isinstance(future, int):
+                submitted = future
+                continue
+
+            received += 1
+
+            for result in future.result():
+                yield result
+
+    def _feed(self, func, jobs, chunksize, done):
+        """
+        Submit chunks of jobs, putting each future on `done` once it finishes
+        """
+        submitted = 0
+
+        try:
+            chunk = []
+
+            for job in jobs:
+                chunk.append(job)
+
+                if len(chunk) >= chunksize:
+                    self._submit(func, chunk, done)
+                    submitted += 1
+                    chunk = []
+
+            if chunk:
+                self._submit(func, chunk, done)
+                submitted += 1
+        except Exception as e:
+            done.put(e)
+        else:
+            done.put(submitted)
+
+    def _submit(self, func, chunk, done):
+        future = self.executor.submit(_executor_task, func, chunk, *self.initargs)
+        future.add_done_callback(done.put)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+def _make_pool(executor, processes, inpath, work_func, g_args):
+    """
+    Pool of workers to make tiles with
+
+    Parameters
+    -----------
+    executor: str or concurrent.futures.Executor
+        worker processes (processes), worker threads in this process
+        (threads), or an executor to submit jobs to
+    processes: int
+        number of worker processes or threads; one runs jobs in this
+        thread, with a `MockTub`, for profiling / debugging
+    inpath, work_func, g_args:
+        arguments of `_main_worker`
+
+    Returns
+    --------
+    pool
+        with the `imap_unordered`, `close`, `join` and `terminate` of a
+        `multiprocessing.Pool`
+    """
+    initargs = (inpath, work_func, g_args)
+
+    if executor not in EXECUTORS:
+        return _ExecutorPool(executor, *initargs)
+
+    if processes == 1:
+        return MockTub(_main_worker, initargs)
+
+    if executor == "threads":
+        return ThreadPool(processes, _main_worker, initargs)
+
+    return Pool(processes, _main_worker, initargs)
+
+
+def _shares_cache(executor):
+    """
+    Whether workers of an executor share one GDAL block cache: threads do,
+    processes each have their own
+    """
+    return executor == "threads" or (
+        ThreadPoolExecutor is not None and isinstance(executor, ThreadPoolExecutor)
+    )
+
+
+def _encode_as_webp(data, profile=None, affine=None):
+    """
+    Uses BytesIO + PIL to encode a (3, size, size)
+    array into a webp bytearray.
+
+    Parameters
+    -----------
+    data: ndarray
+        (3 x size x size) uint8 RGB array
+    profile: None
+        ignored
+    affine: None
+        ignored
+
+    Returns
+    --------
+    contents: bytearray
+        webp-encoded bytearray of the provided input data
+    """
+    with BytesIO() as f:
+        im = Image.fromarray(np.rollaxis(data, 0, 3))
+        im.save(f, format="webp", lossless=True)
+
+        return f.getvalue()
+
+
+def _encode_as_png(data, profile, dst_transform):
+    """
+    Uses rasterio's virtual file system to encode a (3, size, size)
+    array as a png-encoded bytearray.
+
+    Parameters
+    -----------
+    data: ndarray
+        (3 x size x size) uint8 RGB array
+    profile: dictionary
+        dictionary of kwargs for png writing
+    affine: Affine
+        affine transform for output tile
+
+    Returns
+    --------
+    contents: bytearray
+        png-encoded bytearray of the provided input data
+    """
+    profile["affine"] = dst_transform
+
+    # one in-memory file per thread, so worker threads do not share it
+    path = "/vsimem/tileimg-{0}".format(threading.current_thread().ident)
+
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+
+    contents = bytearray(virtual_file_to_buffer(path))
+
+    return contents
+
+
+def _encode_as_zlib_png(data, profile, affine=None):
+    """
+    Uses numpy + zlib to encode a (3, size, size) array
+    as a png-encoded bytearray, without a GDAL dataset.
+
+    Parameters
+    -----------
+    data: ndarray
+        (3 x size x size) uint8 RGB array
+    profile: dictionary
+        `zlevel` compression level and `png_filter` of png encoding
+    affine: None
+        ignored
+
+    Returns
+    --------
+    contents: bytearray
+        png-encoded bytearray of the provided input data
+    """
+    return encode_png(data, profile["zlevel"], profile["png_filter"])
+
+
+def _tile_affine(x, y, z, size=512):
+    """
+    Affine transform of a (size x size) mercator tile
+
+    Parameters
+    -----------
+    x, y, z: int
+        tile indices
+    size: int
+        width and height of the tile in pixels
+
+    Returns
+    --------
+    Affine
+        transform of the tile in EPSG:3857
+    """
+    bounds = [
+        c
+        for i in (
+            mercantile.xy(*mercantile.ul(x, y + 1, z)),
+            mercantile.xy(*mercantile.ul(x + 1, y, z)),
+        )
+        for c in i
+    ]
+
+    return transform.from_bounds(*bounds + [size, size])
+
+
+def _encode_tile(tile, data, toaffine, timings=None):
+    """
+    Encode warped tile data into RGB, then into the image format
+    of the `writer_func`, deduplicating if `global_args["dedupe"]`
+
+    Parameters
+    -----------
+    tile: list
+        [x, y, z] indices of tile
+    data: ndarray
+        (tile_size x tile_size) array of data to encode
+    toaffine: Affine
+        affine transform of the tile
+    timings: dict
+        seconds per stage to add the `rgb` and `encode` stages to,
+        or None to skip timing
+
+    Returns
+    --------
+    tile, buffer, tile_id, timings, precision
+        see `_tile_worker`; None if all data is nodata (NaN)
+    """
+    global_args = _worker.global_args
+
+    start = timer()
+
+    # drop empty tiles, and fill partially empty ones
+    empty = np.isnan(data)
+
+    if empty.all():
+        return None
+
+    if empty.any():
+        data = np.where(empty, global_args["nodata_fill"], data)
+
+    # reuse this worker's rgb array; it is encoded before the next tile
+    if _worker.rgb_buffer is None or _worker.rgb_buffer.shape[1:] != data.shape:
+        _worker.rgb_buffer = np.empty((3,) + data.shape, dtype=np.uint8)
+
+    interval, round_digits, max_error = global_args["precision"][tile[2]]
+
+    if max_error is None:
+        precision = None
+    else:
+        round_digits, error, squared_error = _coarsest_round_digits(
+            data, global_args["base_val"], interval, max_error
+        )
+        precision = (round_digits, error, squared_error, data.size)
+
+    rgb = data_to_rgb(
+        data, global_args["base_val"], interval, round_digits, out=_worker.rgb_buffer
+    )
+
+    encoded = timer()
+
+    if timings is not None:
+        timings["rgb"] = timings.get("rgb", 0.0) + encoded - start
+
+    if not global_args["dedupe"]:
+        contents = global_args["writer_func"](rgb, global_args["kwargs"].copy(), toaffine)
+        tile_id = None
+    else:
+        # skip encoding rgb data this worker has already encoded and returned
+        rgb_hash = hashlib.md5(rgb.tobytes()).digest()
+
+        if rgb_hash in _worker.seen_tiles:
+            contents = None
+            tile_id = _worker.seen_tiles[rgb_hash]
+        else:
+            contents = global_args["writer_func"](rgb, global_args["kwargs"].copy(), toaffine)
+            tile_id = hashlib.md5(contents).hexdigest()
+
+            if len(_worker.seen_tiles) >= SEEN_TILES_MAX:
+                _worker.seen_tiles.clear()
+
+            _worker.seen_tiles[rgb_hash] = tile_id
+
+    if timings is not None:
+        timings["encode"] = timings.get("encode", 0.0) + timer() - encoded
+
+    return tile, contents, tile_id, timings, precision
+
+
+def _tile_worker(tile):
+    """
+    For each tile, and given an open rasterio src, plus a`global_args` dictionary
+    with attributes of `base_val`, a per-zoom `precision` and a `writer_func`,
+    warp a continous single band raster to a square mercator tile of
+    `global_args["tile_size"]` pixels,
+    then encode this tile into RGB.
+
+    Parameters
+    -----------
+    tile: list
+        [x, y, z] indices of tile
+
+    Returns
+    --------
+    tile, buffer, tile_id, timings, precision
+        tuple with the input tile, a bytearray with the data encoded into
+        the format created in the `writer_func`, a hash of that bytearray
+        (None unless `global_args["dedupe"]`), a dictionary of seconds
+        spent in each stage (None unless `global_args["stats"]`), and the
+        (round_digits, max error, summed squared error, pixels) the tile
+        was encoded with (None unless its zoom has a `max_error`).
+        When deduplicating, buffer is None if this worker has already
+        returned a tile with identical RGB data.
+        None if the tile does not contain any valid source data.
+
+    """
+    global_args = _worker.global_args
+
+    x, y, z = tile
+
+    timings = {} if global_args["stats"] else None
+    start = timer()
+
+    size = global_args["tile_size"]
+    toaffine = _tile_affine(x, y, z, size)
+    out = _warp(toaffine, size, size, z)
+
+    if timings is not None:
+        timings["warp"] = timer() - start
+
+    return _encode_tile(tile, out, toaffine, timings)
+
+
+def _level_source(z):
+    """
+    Pick the coarsest source level (the source or one of its overviews)
+    that is at least as fine as tiles of a zoom, opening it once per worker
+
+    Parameters
+    -----------
+    z: int
+        zoom of the tiles to warp
+
+    Returns
+    --------
+    dataset
+        open rasterio dataset
+    """
+    global_args = _worker.global_args
+
+    index = _pick_level(global_args["overviews"], z)
+
+    if index == 0:
+        return _worker.src
+
+    if index not in _worker.sources:
+        _, path, kwargs = global_args["overviews"][index]
+        _worker.sources[index] = rasterio.open(path, **kwargs)
+
+    return _worker.sources[index]
+
+
+def _pick_level(levels, z):
+    """
+    Index of the coarsest of (resolution, path, open kwargs) levels
+    that is at least as fine as tiles of a zoom
+    """
+    global_args = _worker.global_args
+
+    target = _tile_resolution(z, global_args["tile_size"])
+    index = 0
+
+    for i, (resolution, _, _) in enumerate(levels):
+        if resolution <= target:
+            index = i
+
+    return index
+
+
+def _mosaic_source(i, z):
+    """
+    Open source `i` of the mosaic at the level picked for a zoom, finding
+    its levels once per worker, and reusing recently opened datasets
+
+    Parameters
+    -----------
+    i: int
+        index of the source in the mosaic
+    z: int
+        zoom of the tiles to warp
+
+    Returns
+    --------
+    dataset
+        open rasterio dataset
+    """
+    global_args = _worker.global_args
+
+    path = global_args["mosaic"].paths[i]
+    levels = _worker.source_levels.get(path)
+
+    if levels is None:
+        levels = _overview_levels(path)
+
+        if not global_args["source_overviews"]:
+            levels = levels[:1]
+
+        _worker.source_levels[path] = levels
+
+    _, level_path, kwargs = levels[_pick_level(levels, z)]
+
+    return _worker.source_cache.get(level_path, **kwargs)
+
+
+def _warp_mosaic(dst_transform, width, height, z):
+    """
+    Warp band 1 of the mosaic sources that overlap a mercator grid, in
+    priority order: each source only fills pixels that sources before it
+    left without valid data. See `_warp`.
+    """
+    global_args = _worker.global_args
+
+    mosaic = global_args["mosaic"]
+
+    out = np.full((height, width), np.nan, dtype=mosaic.dtype)
+    scratch = None
+
+    for i in mosaic.query(array_bounds(height, width, dst_transform)):
+        if scratch is None:
+            dst = out
+            scratch = np.empty_like(out)
+        else:
+            empty = np.isnan(out)
+
+            if not empty.any():
+                break
+
+            dst = scratch
+
+        reproject(
+            rasterio.band(_mosaic_source(i, z), 1),
+            dst,
+            dst_transform=dst_transform,
+            dst_crs="EPSG:3857",
+            dst_nodata=np.nan,
+            init_dest_nodata=True,
+            resampling=Resampling.bilinear,
+            num_threads=global_args.get("warp_threads", 1),
+            warp_mem_limit=global_args.get("warp_mem_limit", 0),
+        )
+
+        if dst is scratch:
+            np.copyto(out, scratch, where=empty)
+
+    return out
+
+
+def _warp(dst_transform, width, height, z):
+    """
+    Warp band 1 of the source to a mercator grid, honouring its nodata
+    value and mask, and reading from the source level picked for the zoom
+
+    Parameters
+    -----------
+    dst_transform: Affine
+        transform of the output grid in EPSG:3857
+    width, height: int
+        size of the output grid
+    z: int
+        zoom of the output grid
+
+    Returns
+    --------
+    ndarray
+        (height x width) float array; NaN where there is no valid source data
+    """
+    global_args = _worker.global_args
+
+    if global_args.get("mosaic") is not None:
+        return _warp_mosaic(dst_transform, width, height, z)
+
+    dtype = np.float64 if _worker.src.meta["dtype"] == "float64" else np.float32
+
+    out = np.empty((height, width), dtype=dtype)
+
+    reproject(
+        rasterio.band(_level_source(z), 1),
+        out,
+        dst_transform=dst_transform,
+        dst_crs="EPSG:3857",
+        dst_nodata=np.nan,
+        init_dest_nodata=True,
+        resampling=Resampling.bilinear,
+        num_threads=global_args.get("warp_threads", 1),
+        warp_mem_limit=global_args.get("warp_mem_limit", 0),
+    )
+
+    return out
+
+
+def _read_tile(x, y, z):
+    """
+    Read and decode a tile already written to the output
+
+    Parameters
+    -----------
+    x, y, z: int
+        tile indices
+
+    Returns
+    --------
+    ndarray or None
+        (rows x cols) float64 array of decoded data, or None
+        if the tile does not exist
+    """
+    global_args = _worker.global_args
+
+    contents = _worker.reader.read(x, y, z)
+
+    if contents is None:
+        return None
+
+    with Image.open(BytesIO(contents)) as im:
+        rgb = np.rollaxis(np.asarray(im.convert("RGB")), 2, 0)
+
+    return _decode(rgb, global_args["base_val"], global_args["precision"][z][0])
+
+
+def _metatile_worker(tiles):
+    """
+    Warp a block of adjacent tiles of one zoom with a single `reproject` call,
+    then cut and encode each tile into RGB as `_tile_worker` does.
+
+    Parameters
+    -----------
+    tiles: list
+        list of [x, y, z] indices of tiles in one metatile
+
+    Returns
+    --------
+    results: list
+        list of (tile, buffer, tile_id, timings, precision) tuples for tiles
+        with valid source data; see `_tile_worker`
+    """
+    global_args = _worker.global_args
+
+    if len(tiles) == 1:
+        return _finish_job([_tile_worker(tiles[0])])
+
+    start = timer()
+
+    z = tiles[0][2]
+    min_x = min(x for x, _, _ in tiles)
+    min_y = min(y for _, y, _ in tiles)
+    max_x = max(x for x, _, _ in tiles)
+    max_y = max(y for _, y, _ in tiles)
+
+    west, north = mercantile.xy(*mercantile.ul(min_x, min_y, z))
+    east, south = mercantile.xy(*mercantile.ul(max_x + 1, max_y + 1, z))
+
+    size = global_args["tile_size"]
+    width = (max_x - min_x + 1) * size
+    height = (max_y - min_y + 1) * size
+
+    out = _warp(
+        transform.from_bounds(west, south, east, north, width, height), width, height, z
+    )
+
+    # each tile is charged an equal share of the warp
+    warp = (timer() - start) / len(tiles)
+    results = []
+
+    for tile in tiles:
+        x, y, _ = tile
+        row = (y - min_y) * size
+        col = (x - min_x) * size
+
+        timings = {"warp": warp} if global_args["stats"] else None
+
+        results.append(
+            _encode_tile(
+                tile,
+                out[row : row + size, col : col + size],
+                _tile_affine(x, y, z, size),
+                timings,
+            )
+        )
+
+    return _finish_job(results)
+
+
+def _finish_job(results):
+    """
+    Drop empty results of a job, and stamp the rest with worker
+    statistics if `global_args["stats"]`
+    """
+    global_args = _worker.global_args
+
+    results = [result for result in results if result is not None]
+
+    if global_args["stats"]:
+        _stamp(results)
+
+    return results
+
+
+def _pyramid_worker(tiles):
+    """
+    Build each tile from the decoded data of its four children, which must
+    already be written to the output, then encode this tile into RGB.
+    Children are downsampled with `global_args["resampling"]`.
+
+    Parameters
+    -----------
+    tiles: list
+        list of [x, y, z] indices of tiles
+
+    Returns
+    --------
+    results: list
+        list of (tile, buffer, tile_id, timings, precision) tuples;
+        see `_tile_worker`
+    """
+    global_args = _worker.global_args
+
+    size = global_args["tile_size"]
+    results = []
+
+    for tile in tiles:
+        x, y, z = tile
+
+        timings = {} if global_args["stats"] else None
+        start = timer()
+
+        # areas without a child tile are nodata
+        mosaic = np.full((2 * size, 2 * size), np.nan, dtype=np.float64)
+        found = False
+
+        for child in mercantile.children(x, y, z):
+            data = _read_tile(child.x, child.y, child.z)
+
+            if data is None:
+                continue
+
+            found = True
+            row = (child.y - 2 * y) * size
+            col = (child.x - 2 * x) * size
+            mosaic[row : row + size, col : col + size] = data
+
+        if not found:
+            continue
+
+        read = timer()
+        toaffine = _tile_affine(x, y, z, size)
+
+        out = np.empty((size, size), dtype=np.float64)
+
+        reproject(
+            mosaic,
+            out,
+            src_transform=_tile_affine(x, y, z, 2 * size),
+            src_crs="EPSG:3857",
+            src_nodata=np.nan,
+            dst_transform=toaffine,
+            dst_crs="EPSG:3857",
+            dst_nodata=np.nan,
+            init_dest_nodata=True,
+            resampling=global_args["resampling"],
+            num_threads=global_args.get("warp_threads", 1),
+            warp_mem_limit=global_args.get("warp_mem_limit", 0),
+        )
+
+        if timings is not None:
+            timings["read"] = read - start
+            timings["resample"] = timer() - read
+
+        results.append(_encode_tile(tile, out, toaffine, timings))
+
+    return _finish_job(results)
+
+
+def _schedule(value, min_z, max_z):
+    """
+    Expand a value, or a {zoom: value} schedule, into a value for each zoom.
+    Each zoom takes the value of the closest scheduled zoom at or below it;
+    zooms below the first scheduled zoom take its value.
+
+    Parameters
+    -----------
+    value: number or dict
+        value for all zooms, or a schedule of values from zooms on
+    min_z, max_z: int
+        zoom range to expand the value over
+
+    Returns
+    --------
+    dict
+        {zoom: value} for each zoom from min_z to max_z
+    """
+    if not isinstance(value, dict):
+        return dict((z, value) for z in range(min_z, max_z + 1))
+
+    try:
+        schedule = sorted((int(z), v) for z, v in value.items())
+    except (TypeError, ValueError):
+        raise ValueError("Schedule of {0} must have integer zooms".format(value))
+
+    if not schedule:
+        raise ValueError("Schedule of {0} is empty".format(value))
+
+    values = {}
+    for z in range(min_z, max_z + 1):
+        earlier = [v for start, v in schedule if start <= z]
+        values[z] = earlier[-1] if earlier else schedule[0][1]
+
+    return values
+
+
+def _error_budgets(max_error, min_z, max_z):
+    """
+    Largest vertical error of each zoom. A single error is that of `max_z`,
+    doubling with each zoom out as the ground size of a pixel does; a
+    {zoom: error} schedule is expanded as `_schedule` does.
+    """
+    if max_error is None or isinstance(max_error, dict):
+        return _schedule(max_error, min_z, max_z)
+
+    return dict((z, max_error * 2 ** (max_z - z)) for z in range(min_z, max_z + 1))
+
+
+def _add_precision(summary, z, precision):
+    """
+    Add the (round_digits, max error, summed squared error, pixels) of
+    a tile of zoom z to a per-zoom summary, as recorded in the metadata
+    """
+    round_digits, error, squared_error, pixels = precision
+
+    return _merge_precision(
+        summary,
+        {
+            str(z): {
+                "round_digits": [round_digits, round_digits],
+                "max_error": error,
+                "rmse": math.sqrt(squared_error / pixels),
+                "pixels": pixels,
+            }
+        },
+    )
+
+
+def _merge_precision(summary, other):
+    """
+    Merge the per-zoom precision summary `other` into `summary`
+    """
+    for z, entry in other.items():
+        current = summary.get(z)
+
+        if current is None:
+            summary[z] = dict(entry)
+            continue
+
+        pixels = current["pixels"] + entry["pixels"]
+        squared_error = (
+            current["rmse"] ** 2 * current["pixels"] + entry["rmse"] ** 2 * entry["pixels"]
+        )
+
+        summary[z] = {
+            "round_digits": [
+                min(current["round_digits"][0], entry["round_digits"][0]),
+                max(current["round_digits"][1], entry["round_digits"][1]),
+            ],
+            "max_error": max(current["max_error"], entry["max_error"]),
+            "rmse": math.sqrt(squared_error / pixels),
+            "pixels": pixels,
+        }
+
+    return summary
+
+
+def _json_schedule(value):
+    """
+    A value or {zoom: value} schedule as it reads back from JSON metadata
+    """
+    if isinstance(value, dict):
+        return dict((str(int(z)), v) for z, v in value.items())
+
+    return value
+
+
+def _gdal_options(processes, gdal_cachemax=None, warp_mem_limit=None, memory_budget=None):
+    """
+    Per-worker GDAL settings, splitting a total memory budget across
+    workers for the settings not given explicitly
+
+    Parameters
+    -----------
+    processes: int
+        number of workers
+    gdal_cachemax: int
+        GDAL block cache size of each worker in MB, or None for GDAL's default
+    warp_mem_limit: int
+        warp buffer size of each worker in MB, or None for GDAL's default
+    memory_budget: int
+        total MB for all workers, or None; each worker gets
+        `BUDGET_CACHE_SHARE` of its share for the block cache and
+        `BUDGET_WARP_SHARE` for warp buffers
+
+    Returns
+    --------
+    env, warp_mem_limit: dict, int
+        `rasterio.Env` options, and the `reproject` warp_mem_limit (0 for
+        GDAL's default)
+    """
+    if memory_budget is not None:
+        per_worker = memory_budget / processes
+
+        if gdal_cachemax is None:
+            gdal_cachemax = max(1, int(per_worker * BUDGET_CACHE_SHARE))
+
+        if warp_mem_limit is None:
+            warp_mem_limit = max(1, int(per_worker * BUDGET_WARP_SHARE))
+
+    env = {}
+
+    if gdal_cachemax is not None:
+        # GDAL reads values under 100000 as MB, and larger ones as bytes
+        env["GDAL_CACHEMAX"] = gdal_cachemax * 1024 * 1024
+
+    return env, warp_mem_limit or 0
+
+
+def _tile_resolution(z, size=512):
+    """
+    Resolution of tiles of a zoom in EPSG:3857 meters
+    """
+    return WORLD_SIZE / (size * 2 ** z)
+
+
+def _source_resolution(dataset):
+    """
+    Approximate resolution of a dataset in EPSG:3857 meters
+    """
+    w, s, e, n = transform_bounds(dataset.crs, "EPSG:3857", *dataset.bounds)
+
+    return min((e - w) / dataset.width, (n - s) / dataset.height)
+
+
+def _overview_levels(inpath):
+    """
+    Find the resolutions of a source and its overviews
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the source
+
+    Returns
+    --------
+    levels: list
+        list of (resolution, path, open kwargs) from finest to coarsest,
+        starting with the source itself
+    """
+    with rasterio.open(inpath) as src:
+        resolution = _source_resolution(src)
+        width = src.width
+        levels = [(resolution, inpath, {})]
+
+        for i in range(len(src.overviews(1))):
+            with rasterio.open(inpath, overview_level=i) as ovr:
+                levels.append(
+                    (resolution * width / ovr.width, inpath, {"overview_level": i})
+                )
+
+    return levels
+
+
+def _build_overviews(inpath, outdir, max_resolution):
+    """
+    Build temporary overviews of band 1 of a source, halving its resolution
+    until it is coarser than `max_resolution`. Each overview is warped from
+    the previous one with average resampling, and stores nodata as NaN.
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the source
+    outdir: string
+        directory to write overviews to
+    max_resolution: float
+        resolution in EPSG:3857 meters of the coarsest tiles to make
+
+    Returns
+    --------
+    levels: list
+        list of (resolution, path, open kwargs) from finest to coarsest,
+        starting with the source itself
+    """
+    levels = _overview_levels(inpath)[:1]
+    resolution, path, _ = levels[0]
+
+    while resolution * 2 <= max_resolution:
+        with rasterio.open(path) as src:
+            if src.width < 2 or src.height < 2:
+                break
+
+            width = src.width // 2
+            height = src.height // 2
+            dst_transform = src.transform * Affine.scale(
+                src.width / width, src.height / height
+            )
+            dtype = "float64" if src.dtypes[0] == "float64" else "float32"
+
+            resolution = resolution * src.width / width
+            path = os.path.join(outdir, "overview-{0}.tif".format(len(levels)))
+
+            profile = {
+                "driver": "GTiff",
+                "dtype": dtype,
+                "width": width,
+                "height": height,
+                "count": 1,
+                "crs": src.crs,
+                "transform": dst_transform,
+                "nodata": np.nan,
+                "tiled": True,
+                "blockxsize": 512,
+                "blockysize": 512,
+            }
+
+            with rasterio.open(path, "w", **profile) as dst:
+                for row in range(0, height, 512):
+                    rows = min(512, height - row)
+                    out = np.empty((rows, width), dtype=dtype)
+
+                    reproject(
+                        rasterio.band(src, 1),
+                        out,
+                        dst_transform=dst_transform * Affine.translation(0, row),
+                        dst_crs=src.crs,
+                        dst_nodata=np.nan,
+                        init_dest_nodata=True,
+                        resampling=Resampling.average,
+                    )
+
+                    dst.write(out, 1, window=Window(0, row, width, rows))
+
+        levels.append((resolution, path, {}))
+
+    return levels
+
+
+def _tile_range(min_tile, max_tile, ordering="columns", covered=None):
+    """
+    Given a min and max tile, return an iterator of
+    all combinations of this tile range
+
+    Parameters
+    -----------
+    min_tile: list
+        [x, y, z] of minimun tile
+    max_tile:
+        [x, y, z] of minimun tile
+    ordering: str
+        walk the range along a Hilbert curve (hilbert), a Z-order
+        curve (zorder), or column by column (columns)
+        Default=columns
+    covered: callable
+        called with (min_x, min_y, max_x, max_y) of a block of tiles,
+        returns whether to make any of them; None makes all tiles
+        Default=None
+
+    Returns
+    --------
+    tiles: iterator
+        iterator of (x, y) tiles
+    """
+    min_x, min_y, z = min_tile
+    max_x, max_y, _ = max_tile
+
+    if ordering == "columns":
+        tiles = itertools.product(range(min_x, max_x + 1), range(min_y, max_y + 1))
+
+        if covered is None:
+            return tiles
+
+        return ((x, y) for x, y in tiles if covered(x, y, x, y))
+
+    return _curve_range(min_x, min_y, max_x, max_y, z, ordering == "hilbert", covered)
+
+
+def _curve_range(min_x, min_y, max_x, max_y, z, hilbert=True, covered=None):
+    """
+    Walk a range of tiles along a space-filling curve over the 2 ** z grid
+    of a zoom, so neighbouring tiles come out close together. Quadrants
+    outside the range, or not `covered`, are pruned without visiting
+    them, so the children of uncovered blocks are never enumerated.
+    The Hilbert curve is the one of `_tile_id`; the Z-order curve visits
+    quadrants left to right, then top to bottom.
+
+    Returns
+    --------
+    tiles: generator
+        generator of (x, y) tiles
+    """
+    if max_x < min_x or max_y < min_y:
+        return
+
+    # the orientation of a Hilbert curve depends on the size of its grid
+    size = 2 ** z
+    while size <= max(max_x, max_y):
+        size *= 2
+
+    # each square maps its local (u, v) to tile (ox + a * u + b * v, oy + c * u + d * v)
+    stack = [(size, 0, 0, 1, 0, 0, 1)]
+
+    while stack:
+        size, ox, oy, a, b, c, d = stack.pop()
+
+        # squares are axis aligned, whatever their orientation
+        x0, x1 = sorted((ox, ox + (a + b) * (size - 1)))
+        y0, y1 = sorted((oy, oy + (c + d) * (size - 1)))
+
+        if x1 < min_x or x0 > max_x or y1 < min_y or y0 > max_y:
+            continue
+
+        if covered is not None and not covered(
+            max(x0, min_x), max(y0, min_y), min(x1, max_x), min(y1, max_y)
+        ):
+            continue
+
+        if size == 1:
+            yield ox, oy
+            continue
+
+        if size == CURVE_LEAF_SIZE:
+            for u, v in _CURVE_LEAVES[hilbert]:
+                x = ox + a * u + b * v
+                y = oy + c * u + d * v
+
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    if covered is None or covered(x, y, x, y):
+                        yield x, y
+
+            continue
+
+        h = size // 2
+
+        if hilbert:
+            quadrants = [
+                (h, ox, oy, b, a, d, c),
+                (h, ox + b * h, oy + d * h, a, b, c, d),
+                (h, ox + (a + b) * h, oy + (c + d) * h, a, b, c, d),
+                (
+                    h,
+                    ox + a * (2 * h - 1) + b * (h - 1),
+                    oy + c * (2 * h - 1) + d * (h - 1),
+                    -b,
+                    -a,
+                    -d,
+                    -c,
+                ),
+            ]
+        else:
+            quadrants = [
+                (h, ox, oy, 1, 0, 0, 1),
+                (h, ox + h, oy, 1, 0, 0, 1),
+                (h, ox, oy + h, 1, 0, 0, 1),
+                (h, ox + h, oy + h, 1, 0, 0, 1),
+            ]
+
+        # last in, first out
+        stack.extend(reversed(quadrants))
+
+
+def _make_tiles(bbox, src_crs, minz, maxz, ordering="columns", footprint=None):
+    """
+    Given a bounding box, zoom range, and source crs,
+    find all tiles that would intersect, and touch a footprint
+
+    Parameters
+    -----------
+    bbox: list
+        [w, s, e, n] bounds
+    src_crs: str
+        the source crs of the input bbox
+    minz: int
+        minumum zoom to find tiles for
+    maxz: int
+        maximum zoom to find tiles for
+    ordering: str
+        order of the tiles of each zoom; see `_tile_range`
+        Default=columns
+    footprint: Footprint
+        coverage of the source; tiles that do not touch it are skipped,
+        and blocks of tiles that do not are pruned. None makes all tiles
+        of the bounding box
+        Default=None
+
+    Returns
+    --------
+    tiles: generator
+        generator of [x, y, z] tiles that intersect
+        the provided bounding box
+    """
+    for z, min_tile, max_tile in _zoom_ranges(bbox, src_crs, minz, maxz):
+        covered = None
+
+        if footprint is not None:
+            covered = functools.partial(footprint.covers, z=z)
+
+        for x, y in _tile_range(min_tile, max_tile, ordering, covered):
+            yield [x, y, z]
+
+
+def _zoom_ranges(bbox, src_crs, minz, maxz):
+    """
+    Given a bounding box, zoom range, and source crs,
+    find the min and max tile intersecting the bounding box at each zoom
+
+    Parameters
+    -----------
+    bbox: list
+        [w, s, e, n] bounds
+    src_crs: str
+        the source crs of the input bbox
+    minz: int
+        minumum zoom to find tiles for
+    maxz: int
+        maximum zoom to find tiles for
+
+    Returns
+    --------
+    ranges: generator
+        generator of (z, min_tile, max_tile) tuples
+    """
+    w, s, e, n = transform_bounds(*[src_crs, "EPSG:4326"] + bbox, densify_pts=0)
+
+    EPSILON = 1.0e-10
+
+    w += EPSILON
+    s += EPSILON
+    e -= EPSILON
+    n -= EPSILON
+
+    for z in range(minz, maxz + 1):
+        yield z, mercantile.tile(w, n, z), mercantile.tile(e, s, z)
+
+
+def _make_metatiles(
+    bbox, src_crs, minz, maxz, metatile_size, ordering="columns", footprint=None
+):
+    """
+    Given a bounding box, zoom range, and source crs,
+    find all tiles that would intersect, and touch a footprint,
+    grouped into aligned blocks of (metatile_size x metatile_size) tiles
+
+    Parameters
+    -----------
+    bbox: list
+        [w, s, e, n] bounds
+    src_crs: str
+        the source crs of the input bbox
+    minz: int
+        minumum zoom to find tiles for
+    maxz: int
+        maximum zoom to find tiles for
+    metatile_size: int
+        width and height of a metatile, in tiles
+    ordering: str
+        order of the metatiles of each zoom; see `_tile_range`
+        Default=columns
+    footprint: Footprint
+        coverage of the source; see `_make_tiles`
+        Default=None
+
+    Returns
+    --------
+    metatiles: generator
+        generator of lists of [x, y, z] tiles that intersect
+        the provided bounding box
+    """
+    for z, min_tile, max_tile in _zoom_ranges(bbox, src_crs, minz, maxz):
+        min_x, min_y, _ = min_tile
+        max_x, max_y, _ = max_tile
+
+        covered = None
+
+        if footprint is not None:
+            covered = functools.partial(
+                _covers_metatiles, footprint, metatile_size, min_tile, max_tile
+            )
 
-from rasterio import transform
-from rasterio.warp import reproject, transform_bounds
+        for mx, my in _tile_range(
+            [min_x // metatile_size, min_y // metatile_size, z],
+            [max_x // metatile_size, max_y // metatile_size, z],
+            ordering,
+            covered,
+        ):
+            xs = range(
+                max(min_x, mx * metatile_size), min(max_x, (mx + 1) * metatile_size - 1) + 1
+            )
+            ys = range(
+                max(min_y, my * metatile_size), min(max_y, (my + 1) * metatile_size - 1) + 1
+            )
+            tiles = itertools.product(xs, ys)
 
-from rasterio.enums import Resampling
+            if footprint is not None and metatile_size > 1:
+                tiles = [(x, y) for x, y in tiles if footprint.covers(x, y, x, y, z)]
+
+            yield [[x, y, z] for x, y in tiles]
 
-from rio_rgbify.encoders import data_to_rgb
 
-buffer = bytes if sys.version_info > (3,) else buffer
+def _covers_metatiles(
+    footprint, metatile_size, min_tile, max_tile, min_mx, min_my, max_mx, max_my
+):
+    """
+    Whether a footprint touches any tile of a block of metatiles,
+    within the (min_tile, max_tile) range of their zoom
+    """
+    min_x, min_y, z = min_tile
+    max_x, max_y, _ = max_tile
 
-work_func = None
-global_args = None
-src = None
+    return footprint.covers(
+        max(min_x, min_mx * metatile_size),
+        max(min_y, min_my * metatile_size),
+        min(max_x, (max_mx + 1) * metatile_size - 1),
+        min(max_y, (max_my + 1) * metatile_size - 1),
+        z,
+    )
 
 
-def _main_worker(inpath, g_work_func, g_args):
+def _count_jobs(ranges, metatile_size):
     """
-    Util for setting global vars w/ a Pool
+    Number of metatiles `_make_metatiles` makes for (z, min_tile, max_tile) ranges
     """
-    global work_func
-    global global_args
-    global src
-    work_func = g_work_func
-    global_args = g_args
+    count = 0
+
+    for _, (min_x, min_y, _), (max_x, max_y, _) in ranges:
+        count += (max_x // metatile_size - min_x // metatile_size + 1) * (
+            max_y // metatile_size - min_y // metatile_size + 1
+        )
 
-    src = rasterio.open(inpath)
+    return count
 
 
-def _encode_as_webp(data, profile=None, affine=None):
+def _shard_bounds(ranges, metatile_size, shard, counts=None):
     """
-    Uses BytesIO + PIL to encode a (3, 512, 512)
-    array into a webp bytearray.
+    Split the jobs of each zoom into `count` runs of consecutive jobs,
+    balanced to within one job, and find the run of shard `index`.
+    Along a curve ordering, each run is a compact area, and the same
+    shard covers about the same area at every zoom.
 
     Parameters
     -----------
-    data: ndarray
-        (3 x 512 x 512) uint8 RGB array
-    profile: None
-        ignored
-    affine: None
-        ignored
+    ranges: iterable
+        (z, min_tile, max_tile) tuples, as made by `_zoom_ranges`
+    metatile_size: int
+        width and height of a metatile, in tiles
+    shard: tuple
+        (index, count) of the shard, from 1 to count
+    counts: dict
+        {zoom: number of jobs} of jobs that are not all the jobs of the
+        ranges, such as the jobs that touch a footprint; see `_count_zoom_jobs`
+        Default=None
 
     Returns
     --------
-    contents: bytearray
-        webp-encoded bytearray of the provided input data
+    dict
+        {zoom: (start, stop)} positions of the jobs of the shard
+        among the jobs of each zoom
     """
-    with BytesIO() as f:
-        im = Image.fromarray(np.rollaxis(data, 0, 3))
-        im.save(f, format="webp", lossless=True)
+    index, count = shard
+    bounds = {}
 
-        return f.getvalue()
+    for z, min_tile, max_tile in ranges:
+        if counts is None:
+            njobs = _count_jobs([(z, min_tile, max_tile)], metatile_size)
+        else:
+            njobs = counts.get(z, 0)
 
+        bounds[z] = (njobs * (index - 1) // count, njobs * index // count)
 
-def _encode_as_png(data, profile, dst_transform):
-    """
-    Uses rasterio's virtual file system to encode a (3, 512, 512)
-    array as a png-encoded bytearray.
+    return bounds
 
-    Parameters
-    -----------
-    data: ndarray
-        (3 x 512 x 512) uint8 RGB array
-    profile: dictionary
-        dictionary of kwargs for png writing
-    affine: Affine
-        affine transform for output tile
+
+def _count_zoom_jobs(jobs):
+    """
+    Count lists of [x, y, z] tiles by zoom
 
     Returns
     --------
-    contents: bytearray
-        png-encoded bytearray of the provided input data
+    dict
+        {zoom: number of jobs}
     """
-    profile["affine"] = dst_transform
+    counts = {}
 
-    with rasterio.open("/vsimem/tileimg", "w", **profile) as dst:
-        dst.write(data)
+    for job in jobs:
+        z = job[0][2]
+        counts[z] = counts.get(z, 0) + 1
 
-    contents = bytearray(virtual_file_to_buffer("/vsimem/tileimg"))
+    return counts
 
-    return contents
 
+def _shard_jobs(jobs, bounds):
+    """
+    Yield the jobs at the `_shard_bounds` positions of their zoom
+    """
+    positions = {}
+
+    for job in jobs:
+        z = job[0][2]
+        position = positions.get(z, 0)
+        positions[z] = position + 1
 
-def _tile_worker(tile):
+        start, stop = bounds[z]
+
+        if start <= position < stop:
+            yield job
+
+
+def _footprint_jobs(jobs, mosaic):
     """
-    For each tile, and given an open rasterio src, plus a`global_args` dictionary
-    with attributes of `base_val`, `interval`, `round_digits` and a `writer_func`,
-    warp a continous single band raster to a 512 x 512 mercator tile,
-    then encode this tile into RGB.
+    Drop the tiles of jobs that no source of a mosaic overlaps,
+    and jobs left without tiles
 
     Parameters
     -----------
-    tile: list
-        [x, y, z] indices of tile
+    jobs: iterable
+        lists of [x, y, z] tiles
+    mosaic: SourceIndex
+        sources of the mosaic
 
     Returns
     --------
-    tile, buffer
-        tuple with the input tile, and a bytearray with the data encoded into
-        the format created in the `writer_func`
+    generator
+        lists of [x, y, z] tiles
+    """
+    for tiles in jobs:
+        tiles = [tile for tile in tiles if mosaic.intersects(mercantile.xy_bounds(*tile))]
+
+        if tiles:
+            yield tiles
+
 
+def _chunksize(njobs, processes):
     """
-    x, y, z = tile
+    Pick the number of jobs sent to a worker at a time: enough to amortize
+    inter-process overhead, while leaving about 16 tasks per worker to
+    balance load, and at most `MAX_CHUNKSIZE`
+    """
+    return max(1, min(MAX_CHUNKSIZE, njobs // (processes * 16)))
 
-    bounds = [
-        c
-        for i in (
-            mercantile.xy(*mercantile.ul(x, y + 1, z)),
-            mercantile.xy(*mercantile.ul(x + 1, y, z)),
-        )
-        for c in i
-    ]
 
-    toaffine = transform.from_bounds(*bounds + [512, 512])
+def _throttle(jobs, semaphore, stopped=None):
+    """
+    Acquire `semaphore` before yielding each job, blocking
+    the pool's task feeder while too many jobs are in flight,
+    and stop once the event `stopped` is set
+    """
+    for job in jobs:
+        semaphore.acquire()
+
+        if stopped is not None and stopped.is_set():
+            return
 
-    out = np.empty((512, 512), dtype=src.meta["dtype"])
+        yield job
 
-    reproject(
-        rasterio.band(src, 1),
-        out,
-        dst_transform=toaffine,
-        dst_crs="EPSG:3857",
-        resampling=Resampling.bilinear,
-    )
 
-    out = data_to_rgb(out, global_args["base_val"], global_args["interval"], global_args["round_digits"])
+def _stop_throttle(semaphore, stopped):
+    """
+    Stop a `_throttle` after an error: set `stopped`, and release
+    `semaphore` to wake a feeder blocked on it
+    """
+    stopped.set()
 
-    return tile, global_args["writer_func"](out, global_args["kwargs"].copy(), toaffine)
+    try:
+        semaphore.release()
+    except ValueError:
+        # nothing is in flight, so nothing is blocked
+        pass
 
 
-def _tile_range(min_tile, max_tile):
+def _terminate_pool(pool, processes):
     """
-    Given a min and max tile, return an iterator of
-    all combinations of this tile range
+    Stop the workers of a pool after an error, once worker threads have
+    closed their datasets; a `MockTub` runs in this thread, and has none
+    """
+    if isinstance(pool, ThreadPool):
+        _close_thread_workers(pool, processes)
 
-    Parameters
-    -----------
-    min_tile: list
-        [x, y, z] of minimun tile
-    max_tile:
-        [x, y, z] of minimun tile
+    if not isinstance(pool, MockTub):
+        pool.terminate()
 
-    Returns
-    --------
-    tiles: iterator
-        iterator of [x, y, z] tiles
+
+def _skip_tiles(jobs, done):
     """
-    min_x, min_y, _ = min_tile
-    max_x, max_y, _ = max_tile
+    Remove tiles in `done` from lists of tiles, dropping lists left empty
+    """
+    for tiles in jobs:
+        tiles = [tile for tile in tiles if tile not in done]
 
-    return itertools.product(range(min_x, max_x + 1), range(min_y, max_y + 1))
+        if tiles:
+            yield tiles
 
 
-def _make_tiles(bbox, src_crs, minz, maxz):
+def _record_tiles(jobs, tiles):
     """
-    Given a bounding box, zoom range, and source crs,
-    find all tiles that would intersect
+    Add the tiles of lists of tiles to the set `tiles` as they pass through
+    """
+    for job in jobs:
+        tiles.update(tuple(tile) for tile in job)
+        yield job
+
+
+def _footprint_key(footprint):
+    """
+    Footprint of a run as shards record it: its mode, or a hash of its GeoJSON
+    """
+    if not isinstance(footprint, dict):
+        if footprint in FOOTPRINT_MODES:
+            return footprint
+
+        with open(footprint) as f:
+            footprint = json.load(f)
+
+    return hashlib.sha1(json.dumps(footprint, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _update_extents(bounds, inpath, mosaic, tile_size):
+    """
+    Extents of changed source data, grown by `PIXEL_PADDING` pixels of
+    the coarsest source they overlap
 
     Parameters
     -----------
-    bbox: list
-        [w, s, e, n] bounds
-    src_crs: str
-        the source crs of the input bbox
-    minz: int
-        minumum zoom to find tiles for
-    maxz: int
-        maximum zoom to find tiles for
+    bounds: list
+        [w, s, e, n] extents in EPSG:4326
+    inpath: string
+        filepath of the source, unless `mosaic` is given
+    mosaic: SourceIndex
+        sources of a mosaic, or None
+    tile_size: int
+        width and height of tiles in pixels
 
     Returns
     --------
-    tiles: generator
-        generator of [x, y, z] tiles that intersect
-        the provided bounding box
+    Extents
     """
-    w, s, e, n = transform_bounds(*[src_crs, "EPSG:4326"] + bbox, densify_pts=0)
+    extents = Extents(bounds, tile_size=tile_size)
 
-    EPSILON = 1.0e-10
+    if mosaic is None:
+        paths = [inpath]
+    else:
+        paths = sorted(set(mosaic.paths[i] for box in extents.boxes for i in mosaic.query(box)))
 
-    w += EPSILON
-    s += EPSILON
-    e -= EPSILON
-    n -= EPSILON
+    resolution = 0
 
-    for z in range(minz, maxz + 1):
-        for x, y in _tile_range(mercantile.tile(w, n, z), mercantile.tile(e, s, z)):
-            yield [x, y, z]
+    for path in paths:
+        with rasterio.open(path) as src:
+            resolution = max(resolution, _source_resolution(src))
+
+    extents.padding = PIXEL_PADDING * resolution
+
+    return extents
 
 
 class RGBTiler:
     """
     Takes continous source data of an arbitrary bit depth and encodes it
-    in parallel into RGB tiles in an MBTiles file. Provided with a context manager:
+    in parallel into RGB tiles in an MBTiles file, a PMTiles archive or
+    a `{z}/{x}/{y}` directory tree. Provided with a context manager:
     ```
     with RGBTiler(inpath, outpath, min_z, max_x, **kwargs) as tiler:
         tiler.run(processes)
@@ -217,10 +1786,12 @@ class RGBTiler:
 
     Parameters
     -----------
-    inpath: string
-        filepath of the source file to read and encode
+    inpath: string or list
+        filepath of the source file to read and encode, or a list of
+        filepaths of sources to mosaic. Sources listed first take priority
+        where sources overlap, and only tiles that overlap a source are made.
     outpath: string
-        filepath of the output `mbtiles`
+        filepath of the output `mbtiles` or `pmtiles`, or output directory
     min_z: int
         minimum zoom level to tile
     max_z: int
@@ -232,17 +1803,159 @@ class RGBTiler:
         the base value of the RGB numbering system.
         (will be treated as zero for this encoding)
         Default=0
-    interval: float
-        the interval at which to encode
+    interval: float or dict
+        the interval at which to encode, or a {zoom: interval} schedule;
+        each zoom uses the interval of the closest scheduled zoom at or
+        below it
         Default=1
-    round_digits: int
-        Erased less significant digits
+    round_digits: int or dict
+        Erased less significant digits, or a {zoom: round_digits} schedule
         Default=0
+    shard: tuple
+        (index, count) to make only shard `index` of `count`, from 1 to
+        count. The tiles of each zoom are split into `count` balanced,
+        spatially compact runs along `ordering`; shards written to separate
+        mbtiles files on separate machines are combined with `merge_mbtiles`.
+        Not supported with `pyramid`.
+        Default=None
+    max_error: float or dict
+        pick the coarsest `round_digits` of each tile that keeps the
+        vertical error of every pixel within this many data units,
+        replacing `round_digits`. A single error applies to `max_z`, and
+        doubles with each zoom out as the ground size of a pixel does; a
+        {zoom: error} schedule sets the error of each zoom instead. The
+        error measured at each zoom is recorded in the `rgbify_precision`
+        metadata, and is available as `precision` after `run`.
+        Default=None
     format: str
         output tile image format (png or webp)
         Default=png
+    png_encoder: str
+        encode png tiles through a GDAL dataset (gdal), or directly with
+        numpy + zlib (zlib), which is faster but makes other bytes
+        Default=gdal
+    png_level: int
+        zlib compression level of png tiles, 1 (fastest) through 9 (smallest)
+        Default=6
+    png_filter: str
+        PNG row filter of the zlib encoder (none, sub, up, average, paeth,
+        or adaptive to pick one for each row)
+        Default=sub
     bounding_tile: list
         [x, y, z] of bounding tile; limits tiled output to this extent
+    footprint: str or dict
+        make only the tiles that touch the valid data of the source (mask),
+        all tiles of its bounding box (none), or the tiles that touch the
+        polygons of a GeoJSON file or object in EPSG:4326. Coverage is
+        found on a coarse grid and grown by a cell, so edge tiles without
+        data may still be warped, and then skipped. Blocks of tiles that
+        do not touch it are pruned without enumerating their tiles. A
+        mosaic's mask is the bounds of its sources.
+        Default=mask
+    tile_size: int
+        width and height of tiles in pixels (256, 512 or 1024)
+        Default=512
+    writer: str
+        output writer (mbtiles, pmtiles or directory); pmtiles archives
+        are staged in an mbtiles file, and written in Hilbert order at
+        the end of the run
+        Default=pmtiles for a `.pmtiles` outpath, otherwise mbtiles
+    batch_size: int
+        number of tiles written per sqlite transaction
+        Default=256
+    max_in_flight: int
+        number of tiles submitted to workers but not yet queued for writing,
+        at most; bounds memory use when writing falls behind. At least two
+        tasks per worker are always kept in flight.
+        Default=1024
+    chunksize: int
+        number of jobs (tiles or metatiles) sent to a worker at a time
+        Default=picked from the number of jobs and processes
+    executor: str or concurrent.futures.Executor
+        make tiles in worker processes (processes), in worker threads of
+        this process (threads), or with any `concurrent.futures.Executor`.
+        Threads start faster, use less memory and return tiles without
+        pickling them; warping, encoding and compressing mostly release
+        the GIL. Each thread opens its own datasets.
+        Default=processes
+    gdal_cachemax: int
+        GDAL block cache size of each worker in MB; worker threads share
+        one cache of this size
+        Default=GDAL's default
+    warp_threads: int
+        threads each worker warps with
+        Default=1
+    warp_mem_limit: int
+        warp buffer size of each worker in MB
+        Default=GDAL's default
+    memory_budget: int
+        total MB of GDAL block cache and warp buffers across all workers,
+        split evenly between `processes`; `gdal_cachemax` and
+        `warp_mem_limit` override their share
+        Default=None
+    ordering: str
+        order to make the tiles of each zoom in: along a Hilbert curve
+        (hilbert), a Z-order curve (zorder), or column by column (columns).
+        The curves keep the tiles of each chunk of jobs close together,
+        so workers reuse source blocks already in their GDAL block cache.
+        Default=hilbert
+    durability: str
+        sqlite durability while loading tiles (off, normal or full);
+        `off` is fastest, but a crash can leave a corrupt file
+        Default=normal
+    dedupe: bool
+        store identical tiles once, using the mbtiles `map` + `images` layout
+        Default=False
+    pyramid: bool
+        warp only `max_z` from the source, and build each lower zoom
+        from the decoded tiles of the zoom above it
+        Default=False
+    resampling: str
+        resampling method used to build lower zooms in pyramid mode
+        Default=average
+    metatile_size: int
+        warp blocks of (metatile_size x metatile_size) tiles at once
+        Default=1
+    nodata_fill: float
+        value written where a tile has no valid source data;
+        tiles without any valid source data are skipped
+        Default=0
+    overviews: str
+        warp lower zooms from the closest source overview (auto),
+        always from full resolution data (none), or build temporary
+        overviews if the source has none (build)
+        Default=auto
+    resume: bool
+        keep an existing output written with the same encoding parameters,
+        and only make the tiles it does not contain yet
+        Default=False
+    update: list
+        [w, s, e, n] EPSG:4326 extents of changed source data to re-tile
+        into an existing mbtiles output written with the same encoding
+        parameters, bounds and zooms. Only the tiles of each zoom whose
+        pixels resample data within an extent are made again; tiles that
+        changed are replaced in batched transactions, tiles left without
+        data are deleted, and both are listed in `changed` after `run`.
+        Measured errors of re-made tiles are added to the recorded ones.
+        Default=None
+    stats: bool
+        collect per-stage timings, throughput and memory use into
+        a `TilerStats` object, available as `stats` after `run`
+        Default=False
+    profile: string
+        filepath to write a cProfile pstats file of the run to, merging
+        the profiles of the workers with those of the parent's result
+        and writer loops. Worker processes dump their profiles as they
+        exit; those of a caller's `Executor` are not merged.
+        Default=None
+    profile_sample: float
+        fraction of jobs profiled in workers, picked at random, to keep
+        the overhead of profiling low
+        Default=1
+    callback: callable
+        called with (tile, timings) for each tile written; timings is
+        None unless collecting stats
+        Default=None
 
     Returns
     --------
@@ -259,21 +1972,223 @@ class RGBTiler:
         interval=1,
         base_val=0,
         round_digits=0,
+        max_error=None,
+        shard=None,
         bounding_tile=None,
+        footprint="mask",
+        tile_size=512,
+        png_encoder="gdal",
+        png_level=6,
+        png_filter="sub",
+        writer=None,
+        batch_size=256,
+        max_in_flight=MAX_IN_FLIGHT,
+        chunksize=None,
+        executor="processes",
+        ordering="hilbert",
+        gdal_cachemax=None,
+        warp_threads=1,
+        warp_mem_limit=None,
+        memory_budget=None,
+        durability="normal",
+        dedupe=False,
+        pyramid=False,
+        resampling="average",
+        metatile_size=1,
+        nodata_fill=0,
+        overviews="auto",
+        resume=False,
+        update=None,
+        stats=False,
+        profile=None,
+        profile_sample=1,
+        callback=None,
         **kwargs
     ):
-        self.run_function = _tile_worker
+        self.run_function = _metatile_worker
+
+        # a mosaic of one source is that source
+        if isinstance(inpath, (list, tuple)):
+            if not inpath:
+                raise ValueError("At least one source is needed")
+
+            if len(inpath) == 1:
+                inpath = inpath[0]
+            else:
+                inpath = list(inpath)
+
         self.inpath = inpath
+        self.mosaic = isinstance(inpath, list)
         self.outpath = outpath
         self.min_z = min_z
         self.max_z = max_z
         self.bounding_tile = bounding_tile
 
+        if not (
+            isinstance(footprint, dict)
+            or footprint in FOOTPRINT_MODES
+            or os.path.isfile(footprint)
+        ):
+            raise ValueError("{0} is not a supported footprint!".format(footprint))
+        self.footprint = footprint
+
+        if tile_size not in TILE_SIZES:
+            raise ValueError("{0} is not a supported tile size!".format(tile_size))
+
+        if writer is None:
+            writer = _writer_for(outpath)
+        elif writer not in WRITERS:
+            raise ValueError("{0} is not a supported writer!".format(writer))
+        self.writer = writer
+
+        if batch_size < 1:
+            raise ValueError("Batch size of {0} must be at least 1".format(batch_size))
+        self.batch_size = batch_size
+
+        if max_in_flight < 1:
+            raise ValueError(
+                "Max in flight of {0} must be at least 1".format(max_in_flight)
+            )
+        self.max_in_flight = max_in_flight
+
+        if chunksize is not None and chunksize < 1:
+            raise ValueError("Chunksize of {0} must be at least 1".format(chunksize))
+        self.chunksize = chunksize
+
+        if executor not in EXECUTORS and not (
+            Executor is not None and isinstance(executor, Executor)
+        ):
+            raise ValueError("{0} is not a supported executor!".format(executor))
+        self.executor = executor
+
+        if ordering not in ORDERINGS:
+            raise ValueError("{0} is not a supported tile ordering!".format(ordering))
+        self.ordering = ordering
+
+        for name, value in (
+            ("GDAL cachemax", gdal_cachemax),
+            ("Warp mem limit", warp_mem_limit),
+            ("Memory budget", memory_budget),
+        ):
+            if value is not None and value < 1:
+                raise ValueError("{0} of {1} must be at least 1 MB".format(name, value))
+
+        if warp_threads < 1:
+            raise ValueError("Warp threads of {0} must be at least 1".format(warp_threads))
+
+        self.gdal_cachemax = gdal_cachemax
+        self.warp_mem_limit = warp_mem_limit
+        self.memory_budget = memory_budget
+
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(
+                "{0} is not a supported durability level!".format(durability)
+            )
+        self.durability = durability
+
+        if resampling not in PYRAMID_RESAMPLING:
+            raise ValueError(
+                "{0} is not a supported resampling method!".format(resampling)
+            )
+        self.pyramid = pyramid
+
+        if metatile_size < 1:
+            raise ValueError(
+                "Metatile size of {0} must be at least 1".format(metatile_size)
+            )
+        self.metatile_size = metatile_size
+
+        if overviews not in OVERVIEW_MODES:
+            raise ValueError("{0} is not a supported overview mode!".format(overviews))
+
+        if self.mosaic and overviews == "build":
+            raise ValueError("Overviews cannot be built for a mosaic of sources")
+        self.overviews = overviews
+        self.resume = resume
+
+        if update is not None:
+            update = [list(extent) for extent in update]
+
+            if not update:
+                raise ValueError("At least one update extent is needed")
+
+            for extent in update:
+                if len(extent) != 4 or not (extent[0] < extent[2] and extent[1] < extent[3]):
+                    raise ValueError("Update extent of {0} is not valid".format(extent))
+
+            if writer != "mbtiles":
+                raise ValueError("{0} output cannot be updated, only mbtiles".format(writer))
+
+            if resume:
+                raise ValueError("An output cannot be resumed and updated at once")
+
+        self.update = update
+        self.changed = None
+
+        if not 0 < profile_sample <= 1:
+            raise ValueError(
+                "Profile sample of {0} must be above 0 and at most 1".format(profile_sample)
+            )
+        self.profile = profile
+        self.profile_sample = profile_sample
+
+        self.callback = callback
+        self.stats = None
+
+        intervals = _schedule(interval, min_z, max_z)
+        digits = _schedule(round_digits, min_z, max_z)
+        errors = _error_budgets(max_error, min_z, max_z)
+
+        for z in range(min_z, max_z + 1):
+            if not intervals[z] > 0:
+                raise ValueError(
+                    "Interval of {0} at zoom {1} must be positive".format(intervals[z], z)
+                )
+
+            if errors[z] is not None and not errors[z] > 0:
+                raise ValueError(
+                    "Max error of {0} at zoom {1} must be positive".format(errors[z], z)
+                )
+
+        if shard is not None:
+            index, count = shard
+
+            if not 1 <= index <= count:
+                raise ValueError(
+                    "Shard {0} of {1} must be from 1 to {1}".format(index, count)
+                )
+
+            if pyramid:
+                raise ValueError("Shards cannot be made in pyramid mode")
+
+            if update is not None:
+                raise ValueError("Shards cannot be updated")
+
+            shard = (index, count)
+
+        self.shard = shard
+
+        self.interval = interval
+        self.round_digits = round_digits
+        self.max_error = max_error
+        self.precision = None
+
+        if png_encoder not in PNG_ENCODERS:
+            raise ValueError("{0} is not a supported png encoder!".format(png_encoder))
+
+        if png_filter not in PNG_FILTERS:
+            raise ValueError("{0} is not a supported PNG filter!".format(png_filter))
+
+        if not 1 <= png_level <= 9:
+            raise ValueError("PNG level of {0} must be 1 through 9".format(png_level))
+
+        png_func = _encode_as_zlib_png if png_encoder == "zlib" else _encode_as_png
+
         if not "format" in kwargs:
-            writer_func = _encode_as_png
+            writer_func = png_func
             self.image_format = "png"
         elif kwargs["format"].lower() == "png":
-            writer_func = _encode_as_png
+            writer_func = png_func
             self.image_format = "png"
         elif kwargs["format"].lower() == "webp":
             writer_func = _encode_as_webp
@@ -284,19 +2199,32 @@ class RGBTiler:
             )
 
         # global kwargs not used if output  is webp
-        self.global_args = {
-            "kwargs": {
+        if png_encoder == "zlib":
+            png_kwargs = {"zlevel": png_level, "png_filter": png_filter}
+        else:
+            png_kwargs = {
                 "driver": "PNG",
                 "dtype": "uint8",
-                "height": 512,
-                "width": 512,
+                "height": tile_size,
+                "width": tile_size,
                 "count": 3,
                 "crs": "EPSG:3857",
-            },
+                "zlevel": png_level,
+            }
+
+        self.global_args = {
+            "kwargs": png_kwargs,
             "base_val": base_val,
-            "interval": interval,
-            "round_digits": round_digits,
+            "precision": dict(
+                (z, (intervals[z], digits[z], errors[z])) for z in range(min_z, max_z + 1)
+            ),
             "writer_func": writer_func,
+            "dedupe": dedupe,
+            "resampling": Resampling[resampling],
+            "tile_size": tile_size,
+            "warp_threads": warp_threads,
+            "nodata_fill": nodata_fill,
+            "stats": stats,
         }
 
     def __enter__(self):
@@ -311,85 +2239,398 @@ class RGBTiler:
         Warp, encode, and tile
         """
 
-        # get the bounding box + crs of the file to tile
-        with rasterio.open(self.inpath) as src:
-            bbox = list(src.bounds)
-            src_crs = src.crs
+        if self.global_args["stats"]:
+            self.stats = TilerStats()
 
-        # remove the output filepath if it exists
-        if os.path.exists(self.outpath):
-            os.unlink(self.outpath)
+        # source levels to warp each zoom from
+        overview_dir = None
+        mosaic = None
 
-        # create a connection to the mbtiles file
-        conn = sqlite3.connect(self.outpath)
-        cur = conn.cursor()
+        if self.mosaic:
+            # index the sources; workers find the levels of each source
+            mosaic = SourceIndex(self.inpath)
+            bbox = mosaic.bounds
+            src_crs = "EPSG:3857"
+            self.global_args["mosaic"] = mosaic
+            self.global_args["source_overviews"] = self.overviews == "auto"
+        else:
+            # get the bounding box + crs of the file to tile
+            with rasterio.open(self.inpath) as src:
+                bbox = list(src.bounds)
+                src_crs = src.crs
+                has_overviews = len(src.overviews(1)) > 0
+
+            if self.overviews == "none":
+                self.global_args["overviews"] = _overview_levels(self.inpath)[:1]
+            elif self.overviews == "build" and not has_overviews:
+                overview_dir = tempfile.mkdtemp(prefix="rgbify-overviews-")
+                warped_min_z = self.max_z if self.pyramid else self.min_z
+                self.global_args["overviews"] = _build_overviews(
+                    self.inpath,
+                    overview_dir,
+                    _tile_resolution(warped_min_z, self.global_args["tile_size"]),
+                )
+            else:
+                self.global_args["overviews"] = _overview_levels(self.inpath)
+
+        # coverage of the tiles to make
+        footprint = None
+
+        if self.update is not None:
+            # only tiles that changed data can reach
+            footprint = _update_extents(
+                self.update, self.inpath, mosaic, self.global_args["tile_size"]
+            )
+        elif self.footprint == "mask" and not self.mosaic:
+            footprint = Footprint.from_levels(
+                self.global_args["overviews"],
+                np.clip(
+                    transform_bounds(src_crs, "EPSG:3857", *bbox, densify_pts=21),
+                    -WORLD_SIZE / 2,
+                    WORLD_SIZE / 2,
+                ),
+            )
+        elif self.footprint not in FOOTPRINT_MODES:
+            footprint = Footprint.from_geojson(self.footprint)
 
-        # create the tiles table
-        cur.execute(
-            "CREATE TABLE tiles "
-            "(zoom_level integer, tile_column integer, "
-            "tile_row integer, tile_data blob);"
+        # bounding box of tiles to make
+        if self.bounding_tile is None:
+            tile_bbox = bbox
+            tile_crs = src_crs
+        else:
+            tile_bbox = list(mercantile.bounds(self.bounding_tile))
+            tile_crs = "EPSG:4326"
+
+        writer = _make_writer(
+            self.writer,
+            self.outpath,
+            self.image_format,
+            self.global_args["dedupe"],
+            self.durability,
+            list(transform_bounds(tile_crs, "EPSG:4326", *tile_bbox, densify_pts=0)),
         )
-        # create empty metadata
-        cur.execute("CREATE TABLE metadata (name text, value text);")
+        params = self._params()
 
-        conn.commit()
+        resuming = self.resume and writer.exists()
+        updating = self.update is not None
 
-        # populate metadata with required fields
-        cur.execute(
-            "INSERT INTO metadata " "(name, value) " "VALUES ('format', ?);",
-            (self.image_format,),
-        )
+        if updating:
+            if not writer.exists():
+                raise ValueError("Cannot update {0}: it does not exist".format(self.outpath))
+
+            writer.reopen(params, "update")
+
+            # tiles are replaced through the unique tile index
+            writer.index()
+            self.changed = []
+        elif resuming:
+            writer.reopen(params)
+        else:
+            writer.create(params)
+
+        # errors measured by an interrupted or updated run are added to
+        if self.max_error is not None:
+            self.precision = (
+                (resuming or updating) and writer.read_metadata(PRECISION_METADATA)
+            ) or {}
+
+        # lower zooms of a pyramid are built from tiles read back by workers
+        self.global_args["reader"] = writer.reader()
 
-        cur.execute("INSERT INTO metadata " "(name, value) " "VALUES ('name', '');")
-        cur.execute(
-            "INSERT INTO metadata " "(name, value) " "VALUES ('description', '');"
+        self.processes = processes
+
+        # worker GDAL settings depend on the number of workers sharing the budget
+        self.global_args["env"], self.global_args["warp_mem_limit"] = _gdal_options(
+            processes, self.gdal_cachemax, self.warp_mem_limit, self.memory_budget
         )
-        cur.execute("INSERT INTO metadata " "(name, value) " "VALUES ('version', '1');")
-        cur.execute(
-            "INSERT INTO metadata " "(name, value) " "VALUES ('type', 'baselayer');"
+
+        # worker threads share one block cache, with the share of all workers
+        if _shares_cache(self.executor):
+            self.global_args["env"], _ = _gdal_options(
+                1, self.gdal_cachemax, self.warp_mem_limit, self.memory_budget
+            )
+
+        # worker processes dump their profiles here, to merge at the end
+        profile_dir = None
+
+        if self.profile is not None:
+            reset_profiles()
+            profile_dir = tempfile.mkdtemp(prefix="rgbify-profile-")
+
+        self.global_args["profile_dir"] = profile_dir
+        self.global_args["profile_pid"] = os.getpid()
+
+        self.pool = _make_pool(
+            self.executor, processes, self.inpath, self.run_function, self.global_args
         )
 
-        conn.commit()
+        # tiles already written by a previous run
+        done = None
 
-        if processes == 1:
-            # use mock pool for profiling / debugging
-            self.pool = MockTub(
-                _main_worker, (self.inpath, self.run_function, self.global_args)
+        if resuming:
+            done = writer.written(
+                _zoom_ranges(tile_bbox, tile_crs, self.min_z, self.max_z)
             )
+
+        if not self.pyramid:
+            zooms = [(self.min_z, self.max_z)]
         else:
-            self.pool = Pool(
-                processes,
-                _main_worker,
-                (self.inpath, self.run_function, self.global_args),
+            zooms = [(z, z) for z in range(self.max_z, self.min_z - 1, -1)]
+
+        # follow the footprint of the sources, not their bounding box; updates
+        # also visit tiles of removed sources, to delete them
+        follow_mosaic = mosaic is not None and not updating
+
+        for min_z, max_z in zooms:
+            jobs = self._zoom_jobs(
+                tile_bbox, tile_crs, min_z, max_z, footprint, mosaic if follow_mosaic else None
             )
+            ranges = list(_zoom_ranges(tile_bbox, tile_crs, min_z, max_z))
+
+            if self.shard is None:
+                njobs = _count_jobs(ranges, self.metatile_size)
+            else:
+                # shards split the jobs that touch the footprint, counted in a first pass
+                counts = None
+
+                if footprint is not None or follow_mosaic:
+                    counts = _count_zoom_jobs(
+                        self._zoom_jobs(
+                            tile_bbox,
+                            tile_crs,
+                            min_z,
+                            max_z,
+                            footprint,
+                            mosaic if follow_mosaic else None,
+                        )
+                    )
+
+                bounds = _shard_bounds(ranges, self.metatile_size, self.shard, counts)
+                jobs = _shard_jobs(jobs, bounds)
+                njobs = sum(stop - start for start, stop in bounds.values())
+
+            # tiles made again, and those of them with data
+            candidates = rendered = None
+
+            if updating:
+                candidates, rendered = set(), set()
+                jobs = _record_tiles(jobs, candidates)
+
+            if max_z < self.max_z:
+                self._load_tiles(writer, jobs, _pyramid_worker, done, njobs, rendered)
+            else:
+                self._load_tiles(writer, jobs, self.run_function, done, njobs, rendered)
+
+                # lower zooms of a pyramid read their children back, so index first
+                if self.pyramid:
+                    writer.index()
+
+            # before lower zooms of a pyramid read them back
+            if updating:
+                self.changed.extend(writer.delete(sorted(candidates - rendered)))
+
+        # worker threads hold datasets and GDAL environments of their own
+        if isinstance(self.pool, ThreadPool):
+            _close_thread_workers(self.pool, processes)
 
-        # generator of tiles to make
-        if self.bounding_tile is None:
-            tiles = _make_tiles(bbox, src_crs, self.min_z, self.max_z)
-        else:
-            constrained_bbox = list(mercantile.bounds(self.bounding_tile))
-            tiles = _make_tiles(constrained_bbox, "EPSG:4326", self.min_z, self.max_z)
+        self.pool.close()
+        self.pool.join()
 
-        for tile, contents in self.pool.imap_unordered(self.run_function, tiles):
-            x, y, z = tile
+        # release handles held by a MockTub worker, which runs in this process
+        _close_worker()
 
-            # mbtiles use inverse y indexing
-            tiley = int(math.pow(2, z)) - y - 1
+        # worker processes have exited, dumping their profiles
+        if profile_dir is not None:
+            merge_profiles(self.profile, profile_dir)
+            shutil.rmtree(profile_dir)
 
-            # insert tile object
-            cur.execute(
-                "INSERT INTO tiles "
-                "(zoom_level, tile_column, tile_row, tile_data) "
-                "VALUES (?, ?, ?, ?);",
-                (z, x, tiley, buffer(contents)),
-            )
+        if self.precision is not None:
+            writer.write_metadata(PRECISION_METADATA, self.precision)
 
-            conn.commit()
+        # index, or convert a staged archive, once all tiles are loaded
+        writer.close()
 
-        conn.close()
+        if overview_dir is not None:
+            shutil.rmtree(overview_dir)
 
-        self.pool.close()
-        self.pool.join()
+        if self.stats is not None:
+            self.stats.finish()
+
+        if self.changed is not None:
+            self.changed.sort(key=lambda tile: (tile[2], tile[0], tile[1]))
 
         return None
+
+    def _params(self):
+        """
+        Parameters that change the encoded tiles, recorded in the metadata;
+        shards also record how the tiles of their run were split
+        """
+        params = {
+            "base_val": self.global_args["base_val"],
+            "interval": _json_schedule(self.interval),
+            "round_digits": _json_schedule(self.round_digits),
+            "max_error": _json_schedule(self.max_error),
+            "shard": None if self.shard is None else list(self.shard),
+            "format": self.image_format,
+            "tile_size": self.global_args["tile_size"],
+            "dedupe": self.global_args["dedupe"],
+            "nodata_fill": self.global_args["nodata_fill"],
+            "pyramid": self.pyramid,
+            "resampling": self.global_args["resampling"].name,
+        }
+
+        if self.shard is not None:
+            params["partition"] = {
+                "min_z": self.min_z,
+                "max_z": self.max_z,
+                "metatile_size": self.metatile_size,
+                "ordering": self.ordering,
+                "bounding_tile": (
+                    None if self.bounding_tile is None else list(self.bounding_tile)
+                ),
+                "footprint": _footprint_key(self.footprint),
+            }
+
+        return params
+
+    def _zoom_jobs(self, tile_bbox, tile_crs, min_z, max_z, footprint=None, mosaic=None):
+        """
+        Jobs of a range of zooms that touch a footprint, and with only
+        the tiles that a source of `mosaic` overlaps, if given
+        """
+        jobs = _make_metatiles(
+            tile_bbox, tile_crs, min_z, max_z, self.metatile_size, self.ordering, footprint
+        )
+
+        if mosaic is not None:
+            jobs = _footprint_jobs(jobs, mosaic)
+
+        return jobs
+
+    def _load_tiles(self, writer, jobs, work_func, done=None, njobs=1, rendered=None):
+        """
+        Map `work_func` over lists of tiles, skipping tiles in `done`, and
+        hand results in batches to a writer thread through a bounded queue.
+        Job submission is throttled, so a slow writer stalls the workers
+        instead of piling up encoded tiles in memory. Tiles with data are
+        added to the set `rendered`, if given.
+        """
+        if done is not None:
+            jobs = _skip_tiles(jobs, done)
+
+        # profile a sample of jobs, within the profile of the loop in this thread
+        if self.profile is not None:
+            work_func = functools.partial(sampled, self.profile_sample, work_func)
+
+        chunksize = self.chunksize or _chunksize(njobs, self.processes)
+
+        # jobs submitted to workers, or with results not yet queued for writing
+        in_flight = max(
+            self.max_in_flight // self.metatile_size ** 2, 2 * self.processes * chunksize
+        )
+        semaphore = threading.BoundedSemaphore(in_flight)
+        stopped = threading.Event()
+        jobs = _throttle(jobs, semaphore, stopped)
+
+        if isinstance(self.pool, MockTub):
+            job_results = self.pool.imap_unordered(work_func, jobs)
+        else:
+            job_results = self.pool.imap_unordered(work_func, jobs, chunksize)
+
+        queue = Queue(WRITE_QUEUE_SIZE)
+        errors = []
+
+        thread = threading.Thread(
+            target=self._write_batches, args=(writer, queue, errors)
+        )
+        thread.daemon = True
+        thread.start()
+
+        try:
+            with profiled(True if self.profile is not None else None):
+                self._queue_results(job_results, queue, semaphore, rendered)
+        except BaseException:
+            # unblock the pool's task feeder, so the pool can be torn down
+            _stop_throttle(semaphore, stopped)
+            _terminate_pool(self.pool, self.processes)
+            raise
+        finally:
+            queue.put(None)
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _queue_results(self, job_results, queue, semaphore, rendered=None):
+        """
+        Queue the results of jobs for writing in batches, releasing
+        `semaphore` as each job is done
+        """
+        batch = []
+
+        for results in job_results:
+            for tile, contents, tile_id, timings, precision in results:
+                x, y, z = tile
+
+                if precision is not None:
+                    _add_precision(self.precision, z, precision)
+
+                if self.stats is not None:
+                    self.stats.add(tile, timings)
+
+                if self.callback is not None:
+                    self.callback(tile, timings)
+
+                if rendered is not None:
+                    rendered.add((x, y, z))
+
+                batch.append((x, y, z, contents, tile_id))
+
+                # write tiles one transaction per batch
+                if len(batch) >= self.batch_size:
+                    queue.put(batch)
+                    batch = []
+
+            semaphore.release()
+
+        if batch:
+            queue.put(batch)
+
+    def _write_batches(self, writer, queue, errors):
+        """
+        Write batches from a queue until it yields None. After an error,
+        keep draining the queue so the producer never blocks.
+        """
+        with profiled(True if self.profile is not None else None):
+            while True:
+                batch = queue.get()
+
+                if batch is None:
+                    return
+
+                if errors:
+                    continue
+
+                try:
+                    self._write_batch(writer, batch)
+                except Exception as e:
+                    errors.append(e)
+
+    def _write_batch(self, writer, batch):
+        """
+        Write and commit a batch of tiles
+        """
+        if not batch:
+            return
+
+        start = timer()
+
+        # updates replace tiles, and keep track of those that changed
+        if self.changed is None:
+            writer.write(batch)
+        else:
+            self.changed.extend((x, y, z) for x, y, z, _, _ in writer.upsert(batch))
+
+        if self.stats is not None:
+            self.stats.add_write(len(batch), timer() - start)
@@ -0,0 +1,190 @@
+"""Merge shard MBTiles files made with `RGBTiler(shard=...)`"""
+from __future__ import division
+
+import sqlite3
+
+import mercantile
+
+from rio_rgbify.mbtiler import PRECISION_METADATA, _merge_precision
+from rio_rgbify.writers import (
+    SQLITE_TIMEOUT,
+    _make_writer,
+    _writer_for,
+    _read_params,
+    _read_json_metadata,
+)
+
+
+def _read_shard(path):
+    """
+    Read the run parameters and precision summary of a shard
+
+    Parameters
+    -----------
+    path: string
+        filepath of the shard mbtiles file
+
+    Returns
+    --------
+    params, precision
+        parameters recorded by `RGBTiler`, and the `PRECISION_METADATA`
+        summary or None
+    """
+    conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+
+    try:
+        cur = conn.cursor()
+        params = _read_params(cur)
+        precision = _read_json_metadata(cur, PRECISION_METADATA)
+    finally:
+        conn.close()
+
+    if params is None:
+        raise ValueError("{0} is not an mbtiles file made by rio-rgbify".format(path))
+
+    return params, precision
+
+
+def _check_shards(inpaths, shard_params):
+    """
+    Check that shards were made with the same parameters, and
+    that there is exactly one of each shard
+
+    Returns
+    --------
+    params: dict
+        the parameters of the merged output
+    """
+    params = dict(shard_params[0], shard=None)
+    partition = params.pop("partition", None)
+
+    for path, other in zip(inpaths, shard_params):
+        other = dict(other)
+        other_partition = other.pop("partition", None)
+
+        if other["shard"] is None:
+            raise ValueError("Cannot merge {0}: it is not a shard".format(path))
+
+        if dict(other, shard=None) != params:
+            raise ValueError(
+                "Cannot merge {0}: it was made with parameters {1}, not {2}".format(
+                    path, dict(other, shard=None), params
+                )
+            )
+
+        # shards of other zooms, bounds or job orders do not add up to one run
+        if other_partition != partition:
+            raise ValueError(
+                "Cannot merge {0}: it splits the tiles of its run as {1}, not {2}".format(
+                    path, other_partition, partition
+                )
+            )
+
+    count = shard_params[0]["shard"][1]
+    indexes = sorted(other["shard"][0] for other in shard_params)
+
+    if indexes != list(range(1, count + 1)) or any(
+        other["shard"][1] != count for other in shard_params
+    ):
+        raise ValueError(
+            "Cannot merge shards {0}: each shard from 1 to {1} is needed once".format(
+                [other["shard"] for other in shard_params], count
+            )
+        )
+
+    return params
+
+
+def _tile_bounds(cur, dedupe=False):
+    """
+    [w, s, e, n] bounds in EPSG:4326 of the tiles of the highest zoom
+    of an mbtiles file, or None if it has no tiles
+    """
+    table = "map" if dedupe else "tiles"
+
+    z, min_x, max_x, min_row, max_row = cur.execute(
+        "SELECT zoom_level, MIN(tile_column), MAX(tile_column), "
+        "MIN(tile_row), MAX(tile_row) FROM {0} "
+        "WHERE zoom_level = (SELECT MAX(zoom_level) FROM {0});".format(table)
+    ).fetchone()
+
+    if z is None:
+        return None
+
+    # mbtiles use inverse y indexing
+    west, north = mercantile.ul(min_x, 2 ** z - max_row - 1, z)
+    east, south = mercantile.ul(max_x + 1, 2 ** z - min_row, z)
+
+    return [west, south, east, north]
+
+
+def merge_mbtiles(inpaths, outpath, durability="normal"):
+    """
+    Merge the shard mbtiles files of one tiling run into an `.mbtiles`
+    file or a `.pmtiles` archive. Tiles are copied with `ATTACH` plus
+    `INSERT ... SELECT`, without decoding them; with `dedupe`, identical
+    tiles of different shards are stored once.
+
+    Parameters
+    -----------
+    inpaths: list
+        filepaths of shard mbtiles files, one of each shard of the run
+    outpath: string
+        filepath of the output `mbtiles` or `pmtiles`
+    durability: str
+        sqlite durability while merging (off, normal or full)
+        Default=normal
+
+    Returns
+    --------
+    None
+    """
+    if not inpaths:
+        raise ValueError("No shards to merge")
+
+    shards = [_read_shard(path) for path in inpaths]
+    params = _check_shards(inpaths, [shard_params for shard_params, _ in shards])
+
+    dedupe = params["dedupe"]
+
+    writer = _make_writer(
+        _writer_for(outpath), outpath, params["format"], dedupe, durability
+    )
+    writer.create(params)
+
+    cur = writer.conn.cursor()
+
+    for path in inpaths:
+        cur.execute("ATTACH DATABASE ? AS shard;", (path,))
+
+        if dedupe:
+            cur.execute(
+                "INSERT OR IGNORE INTO images (tile_data, tile_id) "
+                "SELECT tile_data, tile_id FROM shard.images;"
+            )
+            cur.execute(
+                "INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) "
+                "SELECT zoom_level, tile_column, tile_row, tile_id FROM shard.map;"
+            )
+        else:
+            cur.execute(
+                "INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) "
+                "SELECT zoom_level, tile_column, tile_row, tile_data FROM shard.tiles;"
+            )
+
+        writer.conn.commit()
+        cur.execute("DETACH DATABASE shard;")
+
+    precision = None
+    for _, shard_precision in shards:
+        if shard_precision is not None:
+            precision = _merge_precision(precision or {}, shard_precision)
+
+    if precision is not None:
+        writer.write_metadata(PRECISION_METADATA, precision)
+
+    # shards without tiles cover nothing; archives then claim the whole world
+    writer.bounds = _tile_bounds(cur, dedupe) or list(mercantile.bounds(0, 0, 0))
+
+    # index, or convert a staged archive
+    writer.close()
@@ -0,0 +1,200 @@
+"""Direct PNG encoding of RGB tiles with numpy and zlib"""
+from __future__ import division
+
+import zlib
+import struct
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG filters, in order of filter type; adaptive picks one per row
+PNG_FILTERS = ("none", "sub", "up", "average", "paeth", "adaptive")
+ADAPTIVE = PNG_FILTERS.index("adaptive")
+
+# bytes per pixel of 8 bit RGB
+BYTES_PER_PIXEL = 3
+
+
+def _chunk(tag, data):
+    """
+    Make a PNG chunk: length, tag, data and CRC of tag + data
+    """
+    return b"".join(
+        [
+            struct.pack(">I", len(data)),
+            tag,
+            data,
+            struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF),
+        ]
+    )
+
+
+def _neighbors(rows):
+    """
+    Bytes left of, above, and above and left of each byte of `rows`,
+    zero outside of the image
+
+    Parameters
+    -----------
+    rows: ndarray
+        (height x width * 3) uint8 array of interleaved RGB rows
+
+    Returns
+    --------
+    left, up, up_left: ndarray
+        uint8 arrays of the same shape as `rows`
+    """
+    left = np.zeros_like(rows)
+    left[:, BYTES_PER_PIXEL:] = rows[:, :-BYTES_PER_PIXEL]
+
+    up = np.zeros_like(rows)
+    up[1:] = rows[:-1]
+
+    up_left = np.zeros_like(rows)
+    up_left[1:, BYTES_PER_PIXEL:] = rows[:-1, :-BYTES_PER_PIXEL]
+
+    return left, up, up_left
+
+
+def _paeth(left, up, up_left):
+    """
+    Paeth predictor of each byte, vectorized
+    """
+    a = left.astype(np.int16)
+    b = up.astype(np.int16)
+    c = up_left.astype(np.int16)
+
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2 * c)
+
+    return np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+
+
+def _filter(rows, filter_type, neighbors):
+    """
+    Apply one PNG filter type to every row
+
+    Parameters
+    -----------
+    rows: ndarray
+        (height x width * 3) uint8 array of interleaved RGB rows
+    filter_type: int
+        PNG filter type, 0 through 4
+    neighbors: tuple
+        left, up and up left arrays of `rows`; see `_neighbors`
+
+    Returns
+    --------
+    ndarray
+        uint8 array of filtered rows
+    """
+    if filter_type == 0:
+        return rows
+
+    left, up, up_left = neighbors
+
+    if filter_type == 1:
+        return rows - left
+    elif filter_type == 2:
+        return rows - up
+    elif filter_type == 3:
+        return rows - ((left.astype(np.uint16) + up) >> 1).astype(np.uint8)
+    else:
+        return rows - _paeth(left, up, up_left)
+
+
+def _filter_rows(rows, png_filter):
+    """
+    Filter rows, prefixing each with its filter type byte
+
+    The adaptive filter picks the filter type of each row with the
+    smallest sum of absolute signed differences, as libpng does.
+
+    Parameters
+    -----------
+    rows: ndarray
+        (height x width * 3) uint8 array of interleaved RGB rows
+    png_filter: str
+        name of filter; see `PNG_FILTERS`
+
+    Returns
+    --------
+    ndarray
+        (height x width * 3 + 1) uint8 array of filtered rows
+    """
+    height, stride = rows.shape
+    filtered = np.empty((height, stride + 1), dtype=np.uint8)
+    filter_type = PNG_FILTERS.index(png_filter)
+
+    neighbors = _neighbors(rows) if filter_type != 0 else None
+
+    if filter_type != ADAPTIVE:
+        filtered[:, 0] = filter_type
+        filtered[:, 1:] = _filter(rows, filter_type, neighbors)
+        return filtered
+
+    candidates = np.stack([_filter(rows, i, neighbors) for i in range(ADAPTIVE)])
+    scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = scores.argmin(axis=0)
+
+    filtered[:, 0] = best
+    filtered[:, 1:] = candidates[best, np.arange(height)]
+
+    return filtered
+
+
+def encode_png(data, level=6, png_filter="sub"):
+    """
+    Encode a (3, rows, cols) uint8 RGB array as PNG
+
+    Parameters
+    -----------
+    data: ndarray
+        (3 x rows x cols) uint8 RGB array
+    level: int
+        zlib compression level, 0 (none) through 9 (smallest)
+    png_filter: str
+        PNG filter applied to each row before compression (none, sub,
+        up, average, paeth, or adaptive to pick one for each row)
+
+    Returns
+    --------
+    contents: bytes
+        png-encoded bytes of the provided input data
+    """
+    data = np.asarray(data)
+
+    if data.dtype != np.uint8 or data.ndim != 3 or data.shape[0] != 3:
+        raise TypeError(
+            "{0} {1} is not a supported PNG array, it must be (3, rows, cols) uint8".format(
+                data.shape, data.dtype
+            )
+        )
+
+    if png_filter not in PNG_FILTERS:
+        raise ValueError("{0} is not a supported PNG filter!".format(png_filter))
+
+    if not 0 <= level <= 9:
+        raise ValueError("PNG level of {0} must be 0 through 9".format(level))
+
+    _, height, width = data.shape
+
+    # interleave bands into rows of RGB pixels
+    rows = np.empty((height, width, BYTES_PER_PIXEL), dtype=np.uint8)
+    for band in range(BYTES_PER_PIXEL):
+        rows[:, :, band] = data[band]
+
+    filtered = _filter_rows(rows.reshape(height, width * BYTES_PER_PIXEL), png_filter)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+
+    return b"".join(
+        [
+            PNG_SIGNATURE,
+            _chunk(b"IHDR", header),
+            _chunk(b"IDAT", zlib.compress(filtered.tobytes(), level)),
+            _chunk(b"IEND", b""),
+        ]
+    )
@@ -0,0 +1,169 @@
+"""Profiling of tiling runs: cProfile in every worker and parent thread, merged"""
+from __future__ import with_statement
+
+import os
+import glob
+import random
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# prefix of the profiles worker processes dump on exit
+WORKER_PREFIX = "worker-"
+
+_local = threading.local()
+
+# profilers of the threads of this process, from the last `reset_profiles` on
+_profilers = []
+_generation = [0]
+_lock = threading.Lock()
+
+
+def reset_profiles():
+    """
+    Forget the profilers of this process, such as those of an earlier run,
+    or those a forked worker inherited from its parent
+    """
+    with _lock:
+        del _profilers[:]
+        _generation[0] += 1
+
+
+def _thread_profiler():
+    """
+    Profiler of this thread, made on first use
+    """
+    if getattr(_local, "generation", None) != _generation[0]:
+        _local.profiler = cProfile.Profile()
+        _local.active = False
+        _local.generation = _generation[0]
+
+        with _lock:
+            _profilers.append(_local.profiler)
+
+    return _local.profiler
+
+
+@contextmanager
+def profiled(enabled=True):
+    """
+    Profile a block with the profiler of this thread, or with `enabled`
+    False, pause profiling it; with None, leave profiling as it is.
+    Blocks nest: the outer state is restored on exit.
+    """
+    if enabled is None:
+        yield
+        return
+
+    profiler = _thread_profiler()
+    active = _local.active
+
+    if active == enabled:
+        yield
+        return
+
+    try:
+        if enabled:
+            profiler.enable()
+        else:
+            profiler.disable()
+    except ValueError:
+        # pythons that allow one active profiler per process, not per thread
+        yield
+        return
+
+    _local.active = enabled
+
+    try:
+        yield
+    finally:
+        if active:
+            profiler.enable()
+        else:
+            profiler.disable()
+
+        _local.active = active
+
+
+def sampled(sample, func, job):
+    """
+    Call `func` on a job, profiling a `sample` fraction of calls at random
+    """
+    with profiled(random.random() < sample):
+        return func(job)
+
+
+def _add(merged, source):
+    """
+    Add a profiler or a pstats file to merged pstats.Stats, skipping empty
+    profiles, which pstats cannot load
+    """
+    try:
+        stats = pstats.Stats(source)
+    except TypeError:
+        return merged
+
+    if merged is None:
+        return stats
+
+    merged.add(stats)
+
+    return merged
+
+
+def dump_profiles(path):
+    """
+    Merge the profilers of this process into a pstats file at `path`,
+    unless none of them profiled anything
+    """
+    merged = None
+
+    with _lock:
+        profilers = list(_profilers)
+
+    for profiler in profilers:
+        merged = _add(merged, profiler)
+
+    if merged is not None:
+        merged.dump_stats(path)
+
+
+def worker_profile_path(profile_dir, pid=None):
+    """
+    Path of the profile a worker process dumps to `profile_dir`
+    """
+    return os.path.join(
+        profile_dir, "{0}{1}.prof".format(WORKER_PREFIX, os.getpid() if pid is None else pid)
+    )
+
+
+def merge_profiles(outpath, profile_dir):
+    """
+    Merge the profilers of this process and the profiles worker processes
+    dumped to `profile_dir` into one pstats file, unless nothing was profiled
+
+    Parameters
+    -----------
+    outpath: string
+        filepath of the merged pstats file
+    profile_dir: string
+        directory of worker profiles
+
+    Returns
+    --------
+    pstats.Stats
+        the merged profile, or None
+    """
+    merged = None
+
+    with _lock:
+        profilers = list(_profilers)
+
+    for source in profilers + sorted(glob.glob(worker_profile_path(profile_dir, "*"))):
+        merged = _add(merged, source)
+
+    if merged is not None:
+        merged.dump_stats(outpath)
+
+    return merged
@@ -0,0 +1,408 @@
+"""Elevation queries: sample many points of RGB encoded tiles or GeoTIFFs"""
+from __future__ import division
+
+import os
+import sqlite3
+from io import BytesIO
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.warp import transform as transform_points
+from rasterio.windows import Window
+
+from rio_rgbify.encoders import decode
+from rio_rgbify.mbtiler import _schedule
+from rio_rgbify.writers import MBTilesReader, _read_params
+
+# decoded tiles each query keeps in memory at most
+TILE_CACHE_SIZE = 128
+
+# GeoTIFF blocks are grouped into tiles at least this many pixels across
+MIN_TILE_SIZE = 256
+
+# latitude north and south of which there are no web mercator tiles
+MAX_LATITUDE = 85.0511287798066
+
+
+def _mbtiles_encoding(path, zoom=None, base_val=None, interval=None):
+    """
+    Find how a zoom of an MBTiles file was encoded, from the parameters
+    `RGBTiler` records in its metadata, unless given
+
+    Parameters
+    -----------
+    path: string
+        filepath of the mbtiles file
+    zoom: int
+        zoom of the tiles, or None for the highest zoom of the file
+    base_val, interval: float
+        base value and interval of the tiles, or None for the recorded ones
+
+    Returns
+    --------
+    zoom, base_val, interval, tile_size
+    """
+    if not os.path.exists(path):
+        raise ValueError("{0} does not exist".format(path))
+
+    conn = sqlite3.connect(path)
+
+    try:
+        params = _read_params(conn.cursor()) or {}
+
+        if zoom is None:
+            zoom = conn.execute("SELECT MAX(zoom_level) FROM tiles;").fetchone()[0]
+
+        row = conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? LIMIT 1;", (zoom,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+    if row is None:
+        raise ValueError("{0} has no tiles at zoom {1}".format(path, zoom))
+
+    # files that do not record their tile size have tiles of any size
+    size = params.get("tile_size")
+
+    if size is None:
+        with Image.open(BytesIO(bytes(row[0]))) as im:
+            size = im.size[0]
+
+    if base_val is None:
+        base_val = params.get("base_val")
+
+    if interval is None and params.get("interval") is not None:
+        interval = _schedule(params["interval"], zoom, zoom)[zoom]
+
+    if base_val is None or interval is None:
+        raise ValueError(
+            "{0} does not record its encoding, so base_val and interval "
+            "must be given".format(path)
+        )
+
+    return zoom, base_val, interval, size
+
+
+class _TileSampler(object):
+    """
+    Bilinear sampling of a grid of pixels split into tiles, decoding each
+    tile once into a least recently used cache of float32 arrays.
+    Subclasses set `shape` and `tile_shape`, and implement `_read_tile`.
+
+    Parameters
+    -----------
+    cache_size: int
+        number of decoded tiles to keep at most
+        Default=TILE_CACHE_SIZE
+
+    Attributes
+    -----------
+    hits, misses: int
+        tiles found in the cache, and tiles read and decoded
+    """
+
+    shape = None
+    tile_shape = None
+
+    def __init__(self, cache_size=TILE_CACHE_SIZE):
+        if cache_size < 1:
+            raise ValueError("Cache size of {0} must be at least 1".format(cache_size))
+
+        self.cache_size = cache_size
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ext_t, ext_v, trace):
+        self.close()
+
+    def _read_tile(self, tx, ty):
+        """
+        Read and decode a tile into a float32 array, or None if it is missing
+        """
+        raise NotImplementedError
+
+    def _tile(self, tx, ty):
+        """
+        Decoded tile from the cache, reading it on a miss
+        """
+        key = (tx, ty)
+
+        if key in self.tiles:
+            data = self.tiles.pop(key)
+            self.hits += 1
+        else:
+            data = self._read_tile(tx, ty)
+            self.misses += 1
+
+            if len(self.tiles) >= self.cache_size:
+                self.tiles.popitem(last=False)
+
+        self.tiles[key] = data
+
+        return data
+
+    def _gather(self, cols, rows):
+        """
+        Values of integer pixels of the grid, NaN in missing tiles
+        """
+        tile_rows, tile_cols = self.tile_shape
+        txs = cols // tile_cols
+        tys = rows // tile_rows
+        values = np.full(cols.shape, np.nan, dtype=np.float64)
+
+        for tx, ty in set(zip(txs.tolist(), tys.tolist())):
+            data = self._tile(tx, ty)
+
+            if data is None:
+                continue
+
+            here = (txs == tx) & (tys == ty)
+            values[here] = data[rows[here] - ty * tile_rows, cols[here] - tx * tile_cols]
+
+        return values
+
+    def _sample_pixels(self, cols, rows):
+        """
+        Bilinear sample at fractional pixel coordinates of the grid, with pixel
+        centers at +0.5. Missing pixels are left out of the weights; points
+        outside of the grid, or without any valid pixel around them, are NaN.
+        Points are taken tile by tile, so each tile is decoded once.
+        """
+        height, width = self.shape
+        tile_rows, tile_cols = self.tile_shape
+
+        cols = np.asarray(cols, dtype=np.float64).ravel()
+        rows = np.asarray(rows, dtype=np.float64).ravel()
+        values = np.full(cols.shape, np.nan, dtype=np.float64)
+
+        inside = np.flatnonzero((cols >= 0) & (cols < width) & (rows >= 0) & (rows < height))
+
+        if not len(inside):
+            return values
+
+        # upper left pixel of each point, and its weights; edges are clamped
+        px = np.clip(cols[inside] - 0.5, 0, width - 1)
+        py = np.clip(rows[inside] - 0.5, 0, height - 1)
+        x0 = np.floor(px).astype(np.int64)
+        y0 = np.floor(py).astype(np.int64)
+        fx = px - x0
+        fy = py - y0
+        x1 = np.minimum(x0 + 1, width - 1)
+        y1 = np.minimum(y0 + 1, height - 1)
+
+        # group points by the tile of their upper left pixel
+        keys = (y0 // tile_rows) * (width // tile_cols + 1) + x0 // tile_cols
+        order = np.argsort(keys, kind="mergesort")
+        starts = np.flatnonzero(np.diff(keys[order])) + 1
+
+        for group in np.split(order, starts):
+            n = len(group)
+            corners = self._gather(
+                np.concatenate([x0[group], x1[group], x0[group], x1[group]]),
+                np.concatenate([y0[group], y0[group], y1[group], y1[group]]),
+            ).reshape(4, n)
+            weights = np.stack(
+                [
+                    (1 - fx[group]) * (1 - fy[group]),
+                    fx[group] * (1 - fy[group]),
+                    (1 - fx[group]) * fy[group],
+                    fx[group] * fy[group],
+                ]
+            )
+
+            valid = ~np.isnan(corners)
+            total = np.where(valid, weights, 0).sum(axis=0)
+            weighted = np.where(valid, weights * np.where(valid, corners, 0), 0).sum(axis=0)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values[inside[group]] = np.where(total > 0, weighted / total, np.nan)
+
+        return values
+
+    def close(self):
+        """
+        Drop the cached tiles
+        """
+        self.tiles.clear()
+
+
+class MBTilesElevation(_TileSampler):
+    """
+    Elevations of points from one zoom of an MBTiles file of RGB encoded
+    tiles, such as made by `RGBTiler`
+
+    Parameters
+    -----------
+    path: string
+        filepath of the mbtiles file
+    zoom: int
+        zoom to sample
+        Default=the highest zoom of the file
+    base_val: float
+        base value the tiles were encoded with
+        Default=recorded by `RGBTiler`
+    interval: float
+        interval the tiles were encoded with
+        Default=recorded by `RGBTiler`, for `zoom`
+    cache_size: int
+        number of decoded tiles to keep at most
+        Default=TILE_CACHE_SIZE
+    """
+
+    def __init__(self, path, zoom=None, base_val=None, interval=None, cache_size=TILE_CACHE_SIZE):
+        super(MBTilesElevation, self).__init__(cache_size)
+
+        zoom, base_val, interval, size = _mbtiles_encoding(path, zoom, base_val, interval)
+
+        self.path = path
+        self.zoom = zoom
+        self.base_val = base_val
+        self.interval = interval
+        self.reader = MBTilesReader(path)
+        self.tile_shape = (size, size)
+        self.shape = (size * 2 ** zoom, size * 2 ** zoom)
+
+    def _read_tile(self, tx, ty):
+        contents = self.reader.read(tx, ty, self.zoom)
+
+        if contents is None:
+            return None
+
+        with Image.open(BytesIO(contents)) as im:
+            rgb = np.rollaxis(np.asarray(im.convert("RGB")), 2, 0)
+
+        return decode(rgb, self.base_val, self.interval, np.float32)
+
+    def sample(self, lons, lats):
+        """
+        Bilinear sampled elevations at points
+
+        Parameters
+        -----------
+        lons, lats: array_like
+            longitudes and latitudes of the points in EPSG:4326
+
+        Returns
+        --------
+        ndarray
+            float64 elevations, NaN for points without data
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        height, width = self.shape
+
+        # pixels of the zoom; latitudes beyond the tiles map outside of them
+        with np.errstate(invalid="ignore"):
+            lats = np.where(np.abs(lats) <= MAX_LATITUDE, lats, np.nan)
+            sin = np.sin(np.radians(lats))
+            cols = (lons + 180.0) / 360.0 * width
+            rows = (0.5 - np.log((1 + sin) / (1 - sin)) / (4 * np.pi)) * height
+
+        rows = np.where(np.isnan(rows), -1.0, rows)
+
+        return self._sample_pixels(cols, rows).reshape(lons.shape)
+
+    def close(self):
+        """
+        Drop the cached tiles, and close the mbtiles file
+        """
+        super(MBTilesElevation, self).close()
+        self.reader.close()
+
+
+class GeoTIFFElevation(_TileSampler):
+    """
+    Elevations of points from an RGB encoded GeoTIFF, such as written by
+    `encode_geotiff`. Blocks of the GeoTIFF are read and decoded a tile
+    of whole blocks at a time.
+
+    Parameters
+    -----------
+    path: string
+        filepath of the GeoTIFF
+    base_val: float
+        base value the GeoTIFF was encoded with
+        Default=0
+    interval: float
+        interval the GeoTIFF was encoded with
+        Default=1
+    cache_size: int
+        number of decoded tiles to keep at most
+        Default=TILE_CACHE_SIZE
+    """
+
+    def __init__(self, path, base_val=0, interval=1, cache_size=TILE_CACHE_SIZE):
+        super(GeoTIFFElevation, self).__init__(cache_size)
+
+        self.src = rasterio.open(path)
+
+        if self.src.count < 3:
+            self.src.close()
+            raise ValueError("{0} is not an RGB GeoTIFF".format(path))
+
+        self.base_val = base_val
+        self.interval = interval
+        self.shape = (self.src.height, self.src.width)
+
+        block_rows, block_cols = self.src.block_shapes[0]
+        self.tile_shape = (
+            block_rows * max(1, -(-MIN_TILE_SIZE // block_rows)),
+            block_cols * max(1, -(-MIN_TILE_SIZE // block_cols)),
+        )
+
+    def _read_tile(self, tx, ty):
+        tile_rows, tile_cols = self.tile_shape
+        window = Window(
+            tx * tile_cols,
+            ty * tile_rows,
+            min(tile_cols, self.src.width - tx * tile_cols),
+            min(tile_rows, self.src.height - ty * tile_rows),
+        )
+        rgb = self.src.read([1, 2, 3], window=window)
+
+        return decode(rgb, self.base_val, self.interval, np.float32)
+
+    def sample(self, lons, lats):
+        """
+        Bilinear sampled elevations at points; see `MBTilesElevation.sample`
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+        if lons.size:
+            xs, ys = transform_points("EPSG:4326", self.src.crs, lons.ravel(), lats.ravel())
+        else:
+            xs, ys = [], []
+
+        cols, rows = ~self.src.transform * (np.asarray(xs), np.asarray(ys))
+
+        return self._sample_pixels(cols, rows).reshape(lons.shape)
+
+    def close(self):
+        """
+        Drop the cached tiles, and close the GeoTIFF
+        """
+        super(GeoTIFFElevation, self).close()
+        self.src.close()
+
+
+def open_elevation(path, **kwargs):
+    """
+    Open an MBTiles file (`MBTilesElevation`) or a GeoTIFF
+    (`GeoTIFFElevation`) to query elevations from, by its extension
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".mbtiles":
+        return MBTilesElevation(path, **kwargs)
+    elif extension in (".tif", ".tiff"):
+        return GeoTIFFElevation(path, **kwargs)
+    else:
+        raise ValueError("{0} is not a supported elevation source!".format(extension))
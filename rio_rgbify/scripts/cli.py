@@ -1,26 +1,80 @@
 """rio_rgbify CLI."""
 
+import os
+
 import click
 
-import rasterio as rio
-import numpy as np
-from riomucho import RioMucho
 import json
 from rasterio.rio.options import creation_options
 
-from rio_rgbify.encoders import data_to_rgb
-from rio_rgbify.mbtiler import RGBTiler
+from rio_rgbify.geotiff import decode_geotiff, encode_geotiff
+from rio_rgbify.png import PNG_FILTERS
+from rio_rgbify.merge import merge_mbtiles
+from rio_rgbify.untiler import decode_mbtiles
+from rio_rgbify.mbtiler import (
+    RGBTiler,
+    TILE_SIZES,
+    MAX_IN_FLIGHT,
+    ORDERINGS,
+    EXECUTORS,
+    PNG_ENCODERS,
+    DURABILITY_LEVELS,
+    OVERVIEW_MODES,
+    PYRAMID_RESAMPLING,
+)
+
+
+def _parse_schedule(name, value):
+    """
+    Parse a JSON {zoom: value} schedule
+    """
+    try:
+        schedule = json.loads(value)
+    except ValueError:
+        schedule = None
+
+    if not isinstance(schedule, dict):
+        raise ValueError("{0} schedule of {1} is not valid".format(name, value))
+
+    return schedule
 
 
-def _rgb_worker(data, window, ij, g_args):
-    return data_to_rgb(
-        data[0][g_args["bidx"] - 1], g_args["base_val"], g_args["interval"], g_args["round_digits"]
-    )
+def _parse_shard(value):
+    """
+    Parse an `index/count` shard
+    """
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise ValueError("Shard of {0} is not valid, it must be index/count".format(value))
+
+    return index, count
+
+
+def _parse_bounds(name, value):
+    """
+    Parse JSON '[w, s, e, n]' bounds
+    """
+    try:
+        bounds = json.loads(value)
+    except ValueError:
+        bounds = None
+
+    if not isinstance(bounds, list) or len(bounds) != 4:
+        raise ValueError("{0} of {1} is not valid".format(name, value))
+
+    return bounds
 
 
 @click.command("rgbify")
-@click.argument("src_path", type=click.Path(exists=True))
+@click.argument("src_paths", nargs=-1, type=click.Path(exists=True))
 @click.argument("dst_path", type=click.Path(exists=False))
+@click.option(
+    "--files-from",
+    type=click.File("r"),
+    default=None,
+    help="Read more source paths from this file, one per line (tiled output only)",
+)
 @click.option(
     "--base-val",
     "-b",
@@ -42,72 +96,312 @@ def _rgb_worker(data, window, ij, g_args):
     default=0,
     help="Less significants encoded bits to be set to 0. Round the values, but have better images compression [DEFAULT=0]",
 )
+@click.option(
+    "--interval-schedule",
+    type=str,
+    default=None,
+    help="Interval from each zoom on, as JSON '{\"{z}\": interval, ...}' (tiled output only)",
+)
+@click.option(
+    "--round-digits-schedule",
+    type=str,
+    default=None,
+    help="Round digits from each zoom on, as JSON '{\"{z}\": digits, ...}' (tiled output only)",
+)
+@click.option(
+    "--max-error",
+    type=float,
+    default=None,
+    help="Round away as many digits of each tile as keep its error at max zoom within this, doubling per zoom out (tiled output only)",
+)
 @click.option("--bidx", type=int, default=1, help="Band to encode [DEFAULT=1]")
 @click.option(
     "--max-z",
     type=int,
     default=None,
-    help="Maximum zoom to tile (.mbtiles output only)",
+    help="Maximum zoom to tile (tiled output only)",
 )
 @click.option(
     "--bounding-tile",
     type=str,
     default=None,
-    help="Bounding tile '[{x}, {y}, {z}]' to limit output tiles (.mbtiles output only)",
+    help="Bounding tile '[{x}, {y}, {z}]' to limit output tiles (tiled output only)",
+)
+@click.option(
+    "--footprint",
+    type=str,
+    default="mask",
+    help="Make only tiles touching valid source data (mask), all tiles of the bounds (none), or tiles touching the polygons of a GeoJSON file (tiled output only) [DEFAULT=mask]",
 )
 @click.option(
     "--min-z",
     type=int,
     default=None,
-    help="Minimum zoom to tile (.mbtiles output only)",
+    help="Minimum zoom to tile (tiled output only)",
 )
 @click.option(
     "--format",
     type=click.Choice(["png", "webp"]),
     default="png",
-    help="Output tile format (.mbtiles output only)",
+    help="Output tile format (tiled output only)",
+)
+@click.option(
+    "--tile-size",
+    type=click.Choice([str(size) for size in TILE_SIZES]),
+    default="512",
+    help="Tile width and height in pixels (tiled output only) [DEFAULT=512]",
+)
+@click.option(
+    "--png-encoder",
+    type=click.Choice(PNG_ENCODERS),
+    default="gdal",
+    help="Encode png tiles with numpy + zlib, or through GDAL (tiled output only) [DEFAULT=gdal]",
+)
+@click.option(
+    "--png-level",
+    type=click.IntRange(1, 9),
+    default=6,
+    help="zlib compression level of png tiles (tiled output only) [DEFAULT=6]",
+)
+@click.option(
+    "--png-filter",
+    type=click.Choice(PNG_FILTERS),
+    default="sub",
+    help="PNG row filter of the zlib encoder (tiled output only) [DEFAULT=sub]",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=256,
+    help="Tiles written per transaction (tiled output only) [DEFAULT=256]",
+)
+@click.option(
+    "--max-in-flight",
+    type=int,
+    default=MAX_IN_FLIGHT,
+    help="Tiles submitted to workers but not yet written, at most (tiled output only) [DEFAULT={0}]".format(
+        MAX_IN_FLIGHT
+    ),
+)
+@click.option(
+    "--executor",
+    type=click.Choice(EXECUTORS),
+    default="processes",
+    help="Make tiles in worker processes, or in worker threads sharing one process (tiled output only) [DEFAULT=processes]",
+)
+@click.option(
+    "--ordering",
+    type=click.Choice(ORDERINGS),
+    default="hilbert",
+    help="Order to make the tiles of each zoom in (tiled output only) [DEFAULT=hilbert]",
+)
+@click.option(
+    "--shard",
+    type=str,
+    default=None,
+    help="Make only shard i of n, as 'i/n' from 1/n to n/n, for rio rgbify-merge (tiled output only)",
+)
+@click.option(
+    "--gdal-cachemax",
+    type=int,
+    default=None,
+    help="GDAL block cache size of each worker in MB (tiled output only)",
+)
+@click.option(
+    "--warp-threads",
+    type=int,
+    default=1,
+    help="Threads each worker warps with (tiled output only) [DEFAULT=1]",
+)
+@click.option(
+    "--warp-mem-limit",
+    type=int,
+    default=None,
+    help="Warp buffer size of each worker in MB (tiled output only)",
+)
+@click.option(
+    "--memory-budget",
+    type=int,
+    default=None,
+    help="Total MB of GDAL cache and warp buffers split across workers, or of blocks in flight for GeoTIFF output",
+)
+@click.option(
+    "--durability",
+    type=click.Choice(sorted(DURABILITY_LEVELS)),
+    default="normal",
+    help="SQLite durability while writing tiles (tiled output only) [DEFAULT=normal]",
+)
+@click.option(
+    "--dedupe",
+    is_flag=True,
+    default=False,
+    help="Store identical tiles once (tiled output only)",
+)
+@click.option(
+    "--pyramid",
+    is_flag=True,
+    default=False,
+    help="Build lower zooms from the max zoom instead of the source (tiled output only)",
+)
+@click.option(
+    "--resampling",
+    type=click.Choice(PYRAMID_RESAMPLING),
+    default="average",
+    help="Resampling used to build lower zooms with --pyramid [DEFAULT=average]",
+)
+@click.option(
+    "--metatile-size",
+    type=int,
+    default=1,
+    help="Warp blocks of N x N tiles at once (tiled output only) [DEFAULT=1]",
+)
+@click.option(
+    "--nodata-fill",
+    type=float,
+    default=0,
+    help="Value written where tiles have no valid source data; empty tiles are skipped (tiled output only) [DEFAULT=0]",
+)
+@click.option(
+    "--overviews",
+    type=click.Choice(OVERVIEW_MODES),
+    default="auto",
+    help="Warp lower zooms from source overviews (auto), full resolution data (none), or temporary overviews (build) (tiled output only) [DEFAULT=auto]",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Keep an existing output and only make missing tiles (tiled output only)",
+)
+@click.option(
+    "--update-extent",
+    type=str,
+    multiple=True,
+    help="Re-tile changed source data within '[w, s, e, n]' (EPSG:4326) into an existing .mbtiles; repeatable (tiled output only)",
+)
+@click.option(
+    "--changed-out",
+    type=click.Path(exists=False),
+    default=None,
+    help="Write the {z}/{x}/{y} tiles an update changed to this file, one per line (tiled output only)",
+)
+@click.option(
+    "--stats-out",
+    type=click.Path(exists=False),
+    default=None,
+    help="Write per-stage timing, throughput and memory statistics to this JSON file (tiled output only)",
+)
+@click.option(
+    "--profile-out",
+    type=click.Path(exists=False),
+    default=None,
+    help="Write a cProfile of the workers and the writer loop, merged into one pstats file (tiled output only)",
+)
+@click.option(
+    "--profile-sample",
+    type=click.FloatRange(0, 1),
+    default=1,
+    help="Fraction of jobs profiled in workers (tiled output only) [DEFAULT=1]",
+)
+@click.option(
+    "--workers",
+    "-j",
+    type=int,
+    default=4,
+    help="Workers to run; threads for GeoTIFF output [DEFAULT=4]",
 )
-@click.option("--workers", "-j", type=int, default=4, help="Workers to run [DEFAULT=4]")
 @click.option("--verbose", "-v", is_flag=True, default=False)
 @click.pass_context
 @creation_options
 def rgbify(
     ctx,
-    src_path,
+    src_paths,
     dst_path,
+    files_from,
     base_val,
     interval,
     round_digits,
+    interval_schedule,
+    round_digits_schedule,
+    max_error,
     bidx,
     max_z,
     min_z,
     bounding_tile,
+    footprint,
     format,
+    tile_size,
+    png_encoder,
+    png_level,
+    png_filter,
+    batch_size,
+    max_in_flight,
+    executor,
+    ordering,
+    shard,
+    gdal_cachemax,
+    warp_threads,
+    warp_mem_limit,
+    memory_budget,
+    durability,
+    dedupe,
+    pyramid,
+    resampling,
+    metatile_size,
+    nodata_fill,
+    overviews,
+    resume,
+    update_extent,
+    changed_out,
+    stats_out,
+    profile_out,
+    profile_sample,
     workers,
     verbose,
     creation_options,
 ):
-    """rio-rgbify cli."""
-    if dst_path.split(".")[-1].lower() == "tif":
-        with rio.open(src_path) as src:
-            meta = src.profile.copy()
+    """rio-rgbify cli.
 
-        meta.update(count=3, dtype=np.uint8)
+    Writes a GeoTIFF to a `.tif` DST_PATH, and tiles to an `.mbtiles` file,
+    a `.pmtiles` archive, or a `{z}/{x}/{y}` directory tree at a DST_PATH
+    without an extension. Tiles can be made from a mosaic of many
+    SRC_PATHS; sources listed first take priority where they overlap.
+    """
+    extension = os.path.splitext(dst_path)[1][1:].lower()
 
-        for c in creation_options:
-            meta[c] = creation_options[c]
+    src_paths = list(src_paths)
 
-        gargs = {"interval": interval, "base_val": base_val, "round_digits": round_digits, "bidx": bidx}
+    if files_from is not None:
+        src_paths.extend(line.strip() for line in files_from if line.strip())
 
-        with RioMucho(
-            [src_path], dst_path, _rgb_worker, options=meta, global_args=gargs
-        ) as rm:
+    if not src_paths:
+        raise click.BadParameter("at least one source is needed", param_hint="SRC_PATHS")
 
-            rm.run(workers)
+    # FloatRange of click < 8 cannot exclude 0
+    if profile_sample <= 0:
+        raise click.BadParameter(
+            "{0} is not in the range 0<x<=1".format(profile_sample), param_hint="--profile-sample"
+        )
+
+    if extension == "tif":
+        if len(src_paths) > 1:
+            raise ValueError("GeoTIFF output takes a single source")
 
-    elif dst_path.split(".")[-1].lower() == "mbtiles":
+        encode_geotiff(
+            src_paths[0],
+            dst_path,
+            base_val=base_val,
+            interval=interval,
+            round_digits=round_digits,
+            bidx=bidx,
+            options=creation_options,
+            threads=workers,
+            memory_budget=memory_budget,
+        )
+
+    elif extension in ("mbtiles", "pmtiles", ""):
         if min_z is None or max_z is None:
-            raise ValueError("Zoom range must be provided for mbtile output")
+            raise ValueError("Zoom range must be provided for tiled output")
 
         if max_z < min_z:
             raise ValueError(
@@ -122,20 +416,173 @@ def rgbify(
                     "Bounding tile of {0} is not valid".format(bounding_tile)
                 )
 
+        if interval_schedule is not None:
+            interval = _parse_schedule("Interval", interval_schedule)
+
+        if shard is not None:
+            shard = _parse_shard(shard)
+
+        update = None
+
+        if update_extent:
+            update = [_parse_bounds("Update extent", extent) for extent in update_extent]
+        elif changed_out is not None:
+            raise ValueError("Changed tiles are only reported by updates")
+
+        if round_digits_schedule is not None:
+            round_digits = _parse_schedule("Round digits", round_digits_schedule)
+
         with RGBTiler(
-            src_path,
+            src_paths,
             dst_path,
             interval=interval,
             base_val=base_val,
             round_digits=round_digits,
+            max_error=max_error,
             format=format,
+            tile_size=int(tile_size),
+            png_encoder=png_encoder,
+            png_level=png_level,
+            png_filter=png_filter,
+            writer=extension or "directory",
             bounding_tile=bounding_tile,
+            footprint=footprint,
             max_z=max_z,
             min_z=min_z,
+            batch_size=batch_size,
+            max_in_flight=max_in_flight,
+            executor=executor,
+            ordering=ordering,
+            shard=shard,
+            gdal_cachemax=gdal_cachemax,
+            warp_threads=warp_threads,
+            warp_mem_limit=warp_mem_limit,
+            memory_budget=memory_budget,
+            durability=durability,
+            dedupe=dedupe,
+            pyramid=pyramid,
+            resampling=resampling,
+            metatile_size=metatile_size,
+            nodata_fill=nodata_fill,
+            overviews=overviews,
+            resume=resume,
+            update=update,
+            stats=stats_out is not None,
+            profile=profile_out,
+            profile_sample=profile_sample,
         ) as tiler:
             tiler.run(workers)
 
+            if changed_out is not None:
+                with open(changed_out, "w") as f:
+                    for x, y, z in tiler.changed:
+                        f.write("{0}/{1}/{2}\n".format(z, x, y))
+
+            if stats_out is not None:
+                tiler.stats.write(stats_out)
+
     else:
-        raise ValueError(
-            "{} output filetype not supported".format(dst_path.split(".")[-1])
+        raise ValueError("{} output filetype not supported".format(extension))
+
+
+@click.command("rgbify-merge")
+@click.argument("shard_paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.argument("dst_path", type=click.Path(exists=False))
+@click.option(
+    "--durability",
+    type=click.Choice(sorted(DURABILITY_LEVELS)),
+    default="normal",
+    help="SQLite durability while merging [DEFAULT=normal]",
+)
+def merge(shard_paths, dst_path, durability):
+    """Merge shard .mbtiles files made with rio rgbify --shard.
+
+    Writes all tiles of the shards to an `.mbtiles` file or `.pmtiles`
+    archive at DST_PATH, without decoding them.
+    """
+    merge_mbtiles(list(shard_paths), dst_path, durability)
+
+
+@click.command("rgbify-decode")
+@click.argument("src_path", type=click.Path(exists=True))
+@click.argument("dst_path", type=click.Path(exists=False))
+@click.option(
+    "--base-val",
+    "-b",
+    type=float,
+    default=None,
+    help="The base value the source was encoded from [DEFAULT=recorded in .mbtiles, else 0]",
+)
+@click.option(
+    "--interval",
+    "-i",
+    type=float,
+    default=None,
+    help="The interval the source was encoded at [DEFAULT=recorded in .mbtiles, else 1]",
+)
+@click.option(
+    "--zoom",
+    type=int,
+    default=None,
+    help="Zoom of the tiles to decode (.mbtiles only) [DEFAULT=highest zoom]",
+)
+@click.option(
+    "--bounds",
+    type=str,
+    default=None,
+    help="Decode the tiles intersecting '[w, s, e, n]' (EPSG:4326) (.mbtiles only)",
+)
+@click.option(
+    "--memory-budget",
+    type=int,
+    default=None,
+    help="MB of blocks in flight (GeoTIFF only)",
+)
+@click.option(
+    "--workers",
+    "-j",
+    type=int,
+    default=4,
+    help="Threads decoding tiles or blocks [DEFAULT=4]",
+)
+@creation_options
+def decode(
+    src_path,
+    dst_path,
+    base_val,
+    interval,
+    zoom,
+    bounds,
+    memory_budget,
+    workers,
+    creation_options,
+):
+    """Decode an RGB GeoTIFF or .mbtiles back into a float32 GeoTIFF.
+
+    Writes a tiled, compressed 1 band GeoTIFF at DST_PATH. The tiles of a
+    zoom of an `.mbtiles` SRC_PATH are mosaicked into an EPSG:3857 grid.
+    """
+    if os.path.splitext(src_path)[1].lower() == ".mbtiles":
+        if bounds is not None:
+            bounds = _parse_bounds("Bounds", bounds)
+
+        decode_mbtiles(
+            src_path,
+            dst_path,
+            bounds=bounds,
+            zoom=zoom,
+            base_val=base_val,
+            interval=interval,
+            options=creation_options,
+            threads=workers,
+        )
+    else:
+        decode_geotiff(
+            src_path,
+            dst_path,
+            base_val=0 if base_val is None else base_val,
+            interval=1 if interval is None else interval,
+            options=creation_options,
+            threads=workers,
+            memory_budget=memory_budget,
         )
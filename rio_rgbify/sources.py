@@ -0,0 +1,249 @@
+"""Mosaics of many source rasters: a spatial index, and open dataset handles"""
+from __future__ import division
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
+
+# entries of each node of the spatial index
+NODE_CAPACITY = 16
+
+# source datasets each worker keeps open at most
+MAX_OPEN_SOURCES = 64
+
+# half the width of the EPSG:3857 world, in meters
+MERCATOR_EXTENT = 20037508.342789244
+
+
+def _str_order(boxes, capacity):
+    """
+    Sort-Tile-Recursive order of boxes: sorted into vertical slabs by the x
+    of their centers, then by the y of their centers within each slab, so
+    each run of `capacity` boxes is spatially compact
+
+    Parameters
+    -----------
+    boxes: ndarray
+        (n x 4) array of [minx, miny, maxx, maxy] boxes
+    capacity: int
+        number of boxes grouped into each node
+
+    Returns
+    --------
+    ndarray
+        indices of boxes in packed order
+    """
+    count = len(boxes)
+    slabs = int(math.ceil(math.sqrt(math.ceil(count / capacity))))
+    slab_size = slabs * capacity
+
+    xs = boxes[:, 0] + boxes[:, 2]
+    ys = boxes[:, 1] + boxes[:, 3]
+
+    order = np.argsort(xs, kind="mergesort")
+
+    return np.concatenate(
+        [
+            order[start : start + slab_size][
+                np.argsort(ys[order[start : start + slab_size]], kind="mergesort")
+            ]
+            for start in range(0, count, slab_size)
+        ]
+    )
+
+
+class _RTree(object):
+    """
+    Static R-tree of boxes, bulk loaded with Sort-Tile-Recursive packing
+
+    Parameters
+    -----------
+    boxes: ndarray
+        (n x 4) array of [minx, miny, maxx, maxy] boxes
+    """
+
+    def __init__(self, boxes):
+        # levels from the leaves up, each a (boxes, ids) of entries in
+        # packed order; node i of a level holds its entries i * capacity on
+        # to (i + 1) * capacity, whose ids are boxes or nodes of the level below
+        self.levels = []
+        ids = np.arange(len(boxes))
+
+        while True:
+            order = _str_order(boxes, NODE_CAPACITY)
+            boxes, ids = boxes[order], ids[order]
+            self.levels.append((boxes, ids))
+
+            if len(boxes) <= NODE_CAPACITY:
+                break
+
+            starts = np.arange(0, len(boxes), NODE_CAPACITY)
+            boxes = np.column_stack(
+                [
+                    np.minimum.reduceat(boxes[:, 0], starts),
+                    np.minimum.reduceat(boxes[:, 1], starts),
+                    np.maximum.reduceat(boxes[:, 2], starts),
+                    np.maximum.reduceat(boxes[:, 3], starts),
+                ]
+            )
+            ids = np.arange(len(starts))
+
+    def query(self, bounds):
+        """
+        Boxes that overlap bounds; boxes that only touch its edges do not
+
+        Parameters
+        -----------
+        bounds: list
+            [minx, miny, maxx, maxy] bounds
+
+        Returns
+        --------
+        list
+            sorted indices of the overlapping boxes
+        """
+        w, s, e, n = bounds
+        nodes = None
+
+        for boxes, ids in reversed(self.levels):
+            if nodes is None:
+                positions = np.arange(len(boxes))
+            else:
+                positions = (
+                    nodes[:, np.newaxis] * NODE_CAPACITY + np.arange(NODE_CAPACITY)
+                ).ravel()
+                positions = positions[positions < len(boxes)]
+
+            candidates = boxes[positions]
+            hits = (
+                (candidates[:, 0] < e)
+                & (candidates[:, 2] > w)
+                & (candidates[:, 1] < n)
+                & (candidates[:, 3] > s)
+            )
+            nodes = ids[positions[hits]]
+
+            if not len(nodes):
+                return []
+
+        return sorted(int(i) for i in nodes)
+
+
+class SourceIndex(object):
+    """
+    Spatial index of the EPSG:3857 bounds of many sources. Sources listed
+    first take priority where sources overlap. Picklable, to share with
+    workers.
+
+    Parameters
+    -----------
+    paths: list
+        filepaths of single band sources, in priority order
+
+    Attributes
+    -----------
+    paths: list
+        filepaths of the sources
+    bounds: list
+        [w, s, e, n] EPSG:3857 bounds of all sources
+    dtype: str
+        float dtype to warp the sources to (float64 if any source is)
+    """
+
+    def __init__(self, paths):
+        if not paths:
+            raise ValueError("At least one source is needed")
+
+        self.paths = list(paths)
+        boxes = np.empty((len(self.paths), 4), dtype=np.float64)
+        self.dtype = "float32"
+
+        for i, path in enumerate(self.paths):
+            with rasterio.open(path) as src:
+                boxes[i] = transform_bounds(src.crs, "EPSG:3857", *src.bounds, densify_pts=21)
+
+                if src.dtypes[0] == "float64":
+                    self.dtype = "float64"
+
+        np.clip(boxes, -MERCATOR_EXTENT, MERCATOR_EXTENT, out=boxes)
+
+        self.bounds = [
+            float(boxes[:, 0].min()),
+            float(boxes[:, 1].min()),
+            float(boxes[:, 2].max()),
+            float(boxes[:, 3].max()),
+        ]
+        self.tree = _RTree(boxes)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def query(self, bounds):
+        """
+        Sources that overlap bounds, in priority order
+
+        Parameters
+        -----------
+        bounds: list
+            [w, s, e, n] EPSG:3857 bounds; sources that only touch
+            its edges do not overlap it
+
+        Returns
+        --------
+        list
+            indices of the overlapping sources in `paths`
+        """
+        return self.tree.query(bounds)
+
+    def intersects(self, bounds):
+        """
+        Whether any source overlaps bounds; see `query`
+        """
+        return len(self.tree.query(bounds)) > 0
+
+
+class SourceCache(object):
+    """
+    Least recently used cache of open datasets, closing the least
+    recently used dataset once more than `size` are open
+
+    Parameters
+    -----------
+    size: int
+        number of datasets to keep open at most
+        Default=MAX_OPEN_SOURCES
+    """
+
+    def __init__(self, size=MAX_OPEN_SOURCES):
+        self.size = size
+        self.datasets = OrderedDict()
+
+    def get(self, path, **kwargs):
+        """
+        Open a dataset, or reuse the open one, with rasterio.open kwargs
+        """
+        key = (path, tuple(sorted(kwargs.items())))
+        dataset = self.datasets.pop(key, None)
+
+        if dataset is None:
+            dataset = rasterio.open(path, **kwargs)
+
+            if len(self.datasets) >= self.size:
+                _, oldest = self.datasets.popitem(last=False)
+                oldest.close()
+
+        self.datasets[key] = dataset
+
+        return dataset
+
+    def close(self):
+        """
+        Close all open datasets
+        """
+        for dataset in self.datasets.values():
+            dataset.close()
+
+        self.datasets.clear()
@@ -0,0 +1,231 @@
+"""Tiling run statistics."""
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import heapq
+from array import array
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+# stages a tile worker may time
+STAGES = ("read", "warp", "resample", "rgb", "encode")
+
+
+def _peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None if unknown
+    """
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports kilobytes, macos bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _stamp(results):
+    """
+    Add the worker pid, peak RSS and send time to the timings of results
+
+    Parameters
+    -----------
+    results: list
+        list of (tile, buffer, tile_id, timings, precision) tuples
+
+    Returns
+    --------
+    results: list
+        the same results
+    """
+    pid = os.getpid()
+    rss = _peak_rss()
+    sent = time.time()
+
+    for result in results:
+        timings = result[3]
+
+        if timings is not None:
+            timings.update(pid=pid, rss=rss, sent=sent)
+
+    return results
+
+
+def _summary(latencies):
+    """
+    Summarize an array of tile latencies in seconds
+    """
+    if not len(latencies):
+        return None
+
+    values = np.frombuffer(latencies, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+
+    return {
+        "mean": float(values.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(values.max()),
+    }
+
+
+class TilerStats(object):
+    """
+    Aggregates the stage timings tile workers report for each tile,
+    plus the time the parent spends writing them.
+
+    Parameters
+    -----------
+    slowest: int
+        number of slowest tiles to keep
+        Default=10
+    """
+
+    def __init__(self, slowest=10):
+        self.started = time.time()
+        self.finished = None
+        self.nslowest = slowest
+        self.slowest = []
+        self.zooms = {}
+        self.ipc_seconds = 0.0
+        self.write_seconds = 0.0
+        self.write_batches = 0
+        self.written = 0
+        self.peak_rss = {}
+
+    def add(self, tile, timings, received=None):
+        """
+        Record the timings of one tile
+
+        Parameters
+        -----------
+        tile: list
+            [x, y, z] indices of tile
+        timings: dict
+            seconds per stage, plus the `pid`, `rss` and `sent`
+            time of the worker that made the tile
+        received: float
+            time the parent received the tile
+            Default=now
+        """
+        received = time.time() if received is None else received
+        x, y, z = tile
+
+        if z not in self.zooms:
+            self.zooms[z] = {
+                "tiles": 0,
+                "first": received,
+                "last": received,
+                "latencies": array("d"),
+                "stages": dict((stage, 0.0) for stage in STAGES),
+            }
+
+        zoom = self.zooms[z]
+        zoom["tiles"] += 1
+        zoom["last"] = received
+
+        latency = 0.0
+
+        for stage in STAGES:
+            seconds = timings.get(stage, 0.0)
+            zoom["stages"][stage] += seconds
+            latency += seconds
+
+        zoom["latencies"].append(latency)
+
+        if timings.get("sent") is not None:
+            self.ipc_seconds += max(0.0, received - timings["sent"])
+
+        if timings.get("rss") is not None:
+            pid = timings.get("pid")
+            self.peak_rss[pid] = max(self.peak_rss.get(pid, 0), timings["rss"])
+
+        entry = (latency, [x, y, z])
+
+        if len(self.slowest) < self.nslowest:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def add_write(self, tiles, seconds):
+        """
+        Record the time spent writing a batch of tiles
+        """
+        self.write_batches += 1
+        self.written += tiles
+        self.write_seconds += seconds
+
+    def finish(self):
+        """
+        Mark the end of the run
+        """
+        self.finished = time.time()
+
+    def to_dict(self):
+        """
+        Summarize the run as a json-serializable dictionary
+        """
+        finished = time.time() if self.finished is None else self.finished
+        seconds = finished - self.started
+
+        tiles = sum(zoom["tiles"] for zoom in self.zooms.values())
+        latencies = array("d")
+        stages = dict((stage, 0.0) for stage in STAGES)
+        zooms = {}
+
+        for z in sorted(self.zooms):
+            zoom = self.zooms[z]
+            latencies.extend(zoom["latencies"])
+            span = zoom["last"] - zoom["first"]
+
+            for stage in STAGES:
+                stages[stage] += zoom["stages"][stage]
+
+            zooms[str(z)] = {
+                "tiles": zoom["tiles"],
+                "seconds": span,
+                "tiles_per_sec": zoom["tiles"] / span if span > 0 else None,
+                "latency": _summary(zoom["latencies"]),
+                "stages": dict(zoom["stages"]),
+            }
+
+        rss = [value for value in self.peak_rss.values() if value is not None]
+
+        return {
+            "seconds": seconds,
+            "tiles": tiles,
+            "tiles_per_sec": tiles / seconds if seconds > 0 else None,
+            "latency": _summary(latencies),
+            "stages": stages,
+            "ipc_seconds": self.ipc_seconds,
+            "write": {
+                "seconds": self.write_seconds,
+                "batches": self.write_batches,
+                "tiles": self.written,
+            },
+            "peak_rss": {
+                "max": max(rss) if rss else None,
+                "workers": dict((str(pid), value) for pid, value in self.peak_rss.items()),
+            },
+            "zooms": zooms,
+            "slowest": [
+                {"tile": tile, "seconds": latency}
+                for latency, tile in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def write(self, path):
+        """
+        Write the summary of the run to a json file
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
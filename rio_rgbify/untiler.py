@@ -0,0 +1,169 @@
+"""Decode a zoom of RGB encoded MBTiles back into a float32 GeoTIFF"""
+from __future__ import division
+
+import sqlite3
+from io import BytesIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import mercantile
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio import transform
+from rasterio.windows import Window
+
+from rio_rgbify.encoders import decode
+from rio_rgbify.geotiff import DECODED_OPTIONS, WINDOWS_PER_THREAD
+from rio_rgbify.mbtiler import _zoom_ranges
+from rio_rgbify.query import _mbtiles_encoding
+
+
+def _decode_tile(contents, size, base_val, interval):
+    """
+    Decode the image of a tile into a (1 x size x size) float32 array
+    """
+    with Image.open(BytesIO(contents)) as im:
+        if im.size != (size, size):
+            raise ValueError("Tile of {0} is not {1} pixels across".format(im.size, size))
+
+        rgb = np.rollaxis(np.asarray(im.convert("RGB")), 2, 0)
+
+    return decode(rgb, base_val, interval, np.float32)[np.newaxis]
+
+
+def _decoded_range(conn, zoom, bounds=None):
+    """
+    Upper left and lower right [x, y] tiles of a zoom to decode: those that
+    intersect [w, s, e, n] EPSG:4326 bounds, or all tiles of the zoom
+    """
+    if bounds is not None:
+        _, (min_x, min_y, _), (max_x, max_y, _) = next(
+            _zoom_ranges(list(bounds), "EPSG:4326", zoom, zoom)
+        )
+        return (min_x, min_y), (max_x, max_y)
+
+    min_x, max_x, min_row, max_row = conn.execute(
+        "SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row) "
+        "FROM tiles WHERE zoom_level = ?;",
+        (zoom,),
+    ).fetchone()
+
+    # mbtiles use inverse y indexing
+    return (min_x, 2 ** zoom - max_row - 1), (max_x, 2 ** zoom - min_row - 1)
+
+
+def decode_mbtiles(
+    inpath,
+    outpath,
+    bounds=None,
+    zoom=None,
+    base_val=None,
+    interval=None,
+    options=None,
+    threads=4,
+):
+    """
+    Decode the tiles of a zoom of an MBTiles file, such as made by `RGBTiler`,
+    into one float32 EPSG:3857 GeoTIFF. Tiles are streamed from the file and
+    decoded by a pool of threads, and each is written into its own block of
+    the output as it finishes, so only the tiles in flight are held in
+    memory. Missing tiles are left as sparse NaN blocks.
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the mbtiles file
+    outpath: string
+        filepath of the output GeoTIFF
+    bounds: list
+        [w, s, e, n] EPSG:4326 bounds; the output covers the whole tiles
+        that intersect them
+        Default=all tiles of the zoom
+    zoom: int
+        zoom to decode
+        Default=the highest zoom of the file
+    base_val: float
+        the base value the tiles were encoded from
+        Default=recorded by `RGBTiler`
+    interval: float
+        the interval the tiles were encoded at
+        Default=recorded by `RGBTiler`, for `zoom`
+    options: dict
+        creation options of the output, on top of `DECODED_OPTIONS`
+        with blocks of one tile
+    threads: int
+        threads decoding tiles
+        Default=4
+
+    Returns
+    --------
+    None
+    """
+    if threads < 1:
+        raise ValueError("{0} threads is not a supported number of threads!".format(threads))
+
+    zoom, base_val, interval, size = _mbtiles_encoding(inpath, zoom, base_val, interval)
+
+    conn = sqlite3.connect(inpath)
+    pool = ThreadPool(threads)
+
+    try:
+        (min_x, min_y), (max_x, max_y) = _decoded_range(conn, zoom, bounds)
+
+        west, _, _, north = mercantile.xy_bounds(min_x, min_y, zoom)
+        _, south, east, _ = mercantile.xy_bounds(max_x, max_y, zoom)
+
+        profile = dict(DECODED_OPTIONS)
+        profile.update(
+            driver="GTiff",
+            count=1,
+            dtype=np.float32,
+            nodata=np.nan,
+            crs="EPSG:3857",
+            width=(max_x - min_x + 1) * size,
+            height=(max_y - min_y + 1) * size,
+            transform=transform.from_bounds(
+                west, south, east, north, (max_x - min_x + 1) * size, (max_y - min_y + 1) * size
+            ),
+            blockxsize=size,
+            blockysize=size,
+            sparse_ok=True,
+        )
+        profile.update(options or {})
+
+        rows = conn.execute(
+            "SELECT tile_column, tile_row, tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?;",
+            (zoom, min_x, max_x, 2 ** zoom - max_y - 1, 2 ** zoom - min_y - 1),
+        )
+
+        in_flight = WINDOWS_PER_THREAD * threads
+        pending = deque()
+
+        with rasterio.open(outpath, "w", **profile) as dst:
+            for x, row, contents in rows:
+                y = 2 ** zoom - row - 1
+                window = Window((x - min_x) * size, (y - min_y) * size, size, size)
+
+                pending.append(
+                    (
+                        window,
+                        pool.apply_async(
+                            _decode_tile, (bytes(contents), size, base_val, interval)
+                        ),
+                    )
+                )
+
+                # write in order, holding at most `in_flight` tiles
+                if len(pending) >= in_flight:
+                    window, result = pending.popleft()
+                    dst.write(result.get(), window=window)
+
+            while pending:
+                window, result = pending.popleft()
+                dst.write(result.get(), window=window)
+    finally:
+        pool.terminate()
+        pool.join()
+        conn.close()
@@ -0,0 +1,1274 @@
+"""Tile output writers: MBTiles, PMTiles and z/x/y directory trees."""
+from __future__ import with_statement
+from __future__ import division
+
+import os
+import sys
+import json
+import zlib
+import errno
+import shutil
+import struct
+import sqlite3
+import tempfile
+
+import numpy as np
+
+buffer = bytes if sys.version_info > (3,) else buffer  # noqa: F821
+
+# output writers, by name
+WRITERS = ("mbtiles", "pmtiles", "directory")
+
+# journal_mode and synchronous pragmas for each durability level
+DURABILITY_LEVELS = {
+    "off": ("OFF", "OFF"),
+    "normal": ("TRUNCATE", "NORMAL"),
+    "full": ("DELETE", "FULL"),
+}
+
+# page size (bytes) and page cache size (negative = KiB) used while loading tiles
+PAGE_SIZE = 4096
+CACHE_SIZE = -65536
+
+# seconds to wait on a locked mbtiles file
+SQLITE_TIMEOUT = 60
+
+# metadata every mbtiles output has; other metadata holds JSON values
+MBTILES_METADATA = ("format", "name", "description", "version", "type", "rgbify")
+
+# suffix of the mbtiles file a pmtiles archive is staged in
+STAGING_SUFFIX = ".staging"
+
+# pmtiles header size, and the size the header and root directory must fit in
+PMTILES_HEADER_SIZE = 127
+PMTILES_ROOT_SIZE = 16384
+
+# pmtiles tile type of each image format
+PMTILES_TILE_TYPES = {"png": 2, "webp": 4}
+
+# pmtiles compression codes
+PMTILES_NONE = 1
+PMTILES_GZIP = 2
+
+
+def _writer_for(outpath):
+    """
+    Name of the writer for an output path: pmtiles for `.pmtiles`,
+    otherwise mbtiles
+    """
+    if os.path.splitext(outpath)[1].lower() == ".pmtiles":
+        return "pmtiles"
+
+    return "mbtiles"
+
+
+def _make_writer(writer, outpath, image_format, dedupe=False, durability="normal", bounds=None):
+    """
+    Make a writer by name; see `MBTilesWriter` for parameters
+    """
+    if writer == "mbtiles":
+        return MBTilesWriter(outpath, image_format, dedupe, durability, bounds)
+    elif writer == "pmtiles":
+        return PMTilesWriter(outpath, image_format, dedupe, durability, bounds)
+    elif writer == "directory":
+        return DirectoryWriter(outpath, image_format, dedupe, durability, bounds)
+    else:
+        raise ValueError("{0} is not a supported writer!".format(writer))
+
+
+def _check_params(path, written_params, params, mode="resume"):
+    """
+    Raise a ValueError if an output to resume or update was written
+    with other parameters
+    """
+    if written_params == params:
+        return
+
+    if mode == "update":
+        raise ValueError(
+            "Cannot update {0}: its tiles were made with parameters {1}, not {2}; "
+            "tile it again in full to change them".format(path, written_params, params)
+        )
+
+    raise ValueError(
+        "Cannot resume {0}: it was written with parameters {1}, not {2}".format(
+            path, written_params, params
+        )
+    )
+
+
+def _apply_pragmas(cur, durability):
+    """
+    Configure an sqlite cursor for bulk loading tiles
+
+    Parameters
+    -----------
+    cur: sqlite3.Cursor
+        cursor of a newly created mbtiles file
+    durability: str
+        one of `DURABILITY_LEVELS`
+
+    Returns
+    --------
+    None
+    """
+    journal_mode, synchronous = DURABILITY_LEVELS[durability]
+
+    # page size must be set before any table is created
+    cur.execute("PRAGMA page_size = {0};".format(PAGE_SIZE))
+    cur.execute("PRAGMA cache_size = {0};".format(CACHE_SIZE))
+    cur.execute("PRAGMA journal_mode = {0};".format(journal_mode))
+    cur.execute("PRAGMA synchronous = {0};".format(synchronous))
+
+
+def _create_tables(cur, dedupe=False):
+    """
+    Create the tile tables of an mbtiles file
+
+    Parameters
+    -----------
+    cur: sqlite3.Cursor
+        cursor of the mbtiles file
+    dedupe: bool
+        use a `map` + `images` layout with a `tiles` view
+        instead of a flat `tiles` table
+
+    Returns
+    --------
+    None
+    """
+    if not dedupe:
+        cur.execute(
+            "CREATE TABLE tiles "
+            "(zoom_level integer, tile_column integer, "
+            "tile_row integer, tile_data blob);"
+        )
+        return
+
+    cur.execute(
+        "CREATE TABLE map "
+        "(zoom_level integer, tile_column integer, "
+        "tile_row integer, tile_id text);"
+    )
+    cur.execute("CREATE TABLE images (tile_data blob, tile_id text);")
+
+    # needed while loading to skip images that are already stored
+    cur.execute("CREATE UNIQUE INDEX images_id ON images (tile_id);")
+
+    cur.execute(
+        "CREATE VIEW tiles AS SELECT "
+        "map.zoom_level AS zoom_level, "
+        "map.tile_column AS tile_column, "
+        "map.tile_row AS tile_row, "
+        "images.tile_data AS tile_data "
+        "FROM map JOIN images ON images.tile_id = map.tile_id;"
+    )
+
+
+def _create_index(cur, dedupe=False):
+    """
+    Create the unique tile index of an mbtiles file once tiles are loaded
+
+    Parameters
+    -----------
+    cur: sqlite3.Cursor
+        cursor of the mbtiles file
+    dedupe: bool
+        whether the file uses the `map` + `images` layout
+
+    Returns
+    --------
+    None
+    """
+    if dedupe:
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS map_index "
+            "ON map (zoom_level, tile_column, tile_row);"
+        )
+    else:
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+            "ON tiles (zoom_level, tile_column, tile_row);"
+        )
+
+
+class _TileSet(object):
+    """
+    Compact set of tiles, stored as one bitmap per zoom over the tile range
+    of that zoom. Tiles outside of the ranges are never members.
+
+    Parameters
+    -----------
+    ranges: iterable
+        (z, min_tile, max_tile) tuples, as made by `_zoom_ranges`
+    """
+
+    def __init__(self, ranges):
+        self.ranges = {}
+        self.bitmaps = {}
+
+        for z, (min_x, min_y, _), (max_x, max_y, _) in ranges:
+            width = max_x - min_x + 1
+            height = max_y - min_y + 1
+            self.ranges[z] = (min_x, min_y, width, height)
+            self.bitmaps[z] = np.zeros((width * height + 7) // 8, dtype=np.uint8)
+
+    def _bits(self, xs, ys, z):
+        """
+        Bit positions of tiles of one zoom, and whether they are in range
+        """
+        min_x, min_y, width, height = self.ranges[z]
+        cols = np.asarray(xs, dtype=np.int64) - min_x
+        rows = np.asarray(ys, dtype=np.int64) - min_y
+        inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+
+        return rows * width + cols, inside
+
+    def update(self, xs, ys, z):
+        """
+        Add arrays of tile columns and rows of one zoom to the set
+        """
+        if z not in self.ranges:
+            return
+
+        bits, inside = self._bits(xs, ys, z)
+        bits = bits[inside]
+
+        np.bitwise_or.at(
+            self.bitmaps[z], bits >> 3, np.left_shift(1, bits & 7).astype(np.uint8)
+        )
+
+    def __contains__(self, tile):
+        x, y, z = tile
+
+        if z not in self.ranges:
+            return False
+
+        bits, inside = self._bits([x], [y], z)
+
+        if not inside[0]:
+            return False
+
+        bit = bits[0]
+
+        return bool(self.bitmaps[z][bit >> 3] & (1 << (bit & 7)))
+
+    def __len__(self):
+        return int(
+            sum(np.unpackbits(bitmap).sum() for bitmap in self.bitmaps.values())
+        )
+
+
+def _load_tile_set(cur, ranges, dedupe=False):
+    """
+    Load the tiles already written to an mbtiles file
+
+    Parameters
+    -----------
+    cur: sqlite3.Cursor
+        cursor of the mbtiles file
+    ranges: iterable
+        (z, min_tile, max_tile) tuples of the tiles to track
+    dedupe: bool
+        whether the file uses the `map` + `images` layout
+
+    Returns
+    --------
+    _TileSet
+        set of the written tiles within the ranges
+    """
+    ranges = list(ranges)
+    done = _TileSet(ranges)
+    table = "map" if dedupe else "tiles"
+
+    for z, _, _ in ranges:
+        cur.execute(
+            "SELECT tile_column, tile_row FROM {0} WHERE zoom_level = ?;".format(table),
+            (z,),
+        )
+
+        while True:
+            rows = cur.fetchmany(65536)
+
+            if not rows:
+                break
+
+            xs, tile_rows = np.array(rows, dtype=np.int64).T
+
+            # mbtiles use inverse y indexing
+            done.update(xs, 2 ** z - tile_rows - 1, z)
+
+    return done
+
+
+def _read_params(cur):
+    """
+    Read the run parameters recorded in the metadata of an mbtiles file
+
+    Returns
+    --------
+    dict or None
+        parameters, or None if the file does not record any
+    """
+    return _read_json_metadata(cur, "rgbify")
+
+
+def _read_json_metadata(cur, name):
+    """
+    Read a JSON value from the metadata of an mbtiles file, or None
+    if the file does not have it
+    """
+    try:
+        row = cur.execute("SELECT value FROM metadata WHERE name = ?;", (name,)).fetchone()
+    except sqlite3.DatabaseError:
+        return None
+
+    return None if row is None else json.loads(row[0])
+
+
+def _extra_metadata(cur):
+    """
+    Read the JSON values of the metadata other than `MBTILES_METADATA`
+    """
+    rows = cur.execute("SELECT name, value FROM metadata;").fetchall()
+
+    return dict(
+        (name, json.loads(value)) for name, value in rows if name not in MBTILES_METADATA
+    )
+
+
+def _insert_tiles(cur, rows, dedupe=False):
+    """
+    Insert a batch of tiles into an mbtiles file
+
+    Parameters
+    -----------
+    cur: sqlite3.Cursor
+        cursor of the mbtiles file
+    rows: list
+        list of (zoom_level, tile_column, tile_row, tile_data, tile_id) tuples;
+        with `dedupe`, tile_data may be None for an already returned tile_id
+    dedupe: bool
+        whether the file uses the `map` + `images` layout
+
+    Returns
+    --------
+    None
+    """
+    if not rows:
+        return
+
+    if not dedupe:
+        cur.executemany(
+            "INSERT INTO tiles "
+            "(zoom_level, tile_column, tile_row, tile_data) "
+            "VALUES (?, ?, ?, ?);",
+            [(z, x, y, buffer(contents)) for z, x, y, contents, _ in rows],
+        )
+        return
+
+    cur.executemany(
+        "INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);",
+        [
+            (buffer(contents), tile_id)
+            for _, _, _, contents, tile_id in rows
+            if contents is not None
+        ],
+    )
+    cur.executemany(
+        "INSERT INTO map "
+        "(zoom_level, tile_column, tile_row, tile_id) "
+        "VALUES (?, ?, ?, ?);",
+        [(z, x, y, tile_id) for z, x, y, _, tile_id in rows],
+    )
+
+
+def _upsert_tiles(cur, rows, dedupe=False):
+    """
+    Insert or replace a batch of tiles in an mbtiles file with a unique
+    tile index, skipping tiles already stored with the same contents
+
+    Parameters
+    -----------
+    cur: sqlite3.Cursor
+        cursor of the mbtiles file
+    rows: list
+        list of (zoom_level, tile_column, tile_row, tile_data, tile_id) tuples;
+        with `dedupe`, tile_data may be None for an already returned tile_id
+    dedupe: bool
+        whether the file uses the `map` + `images` layout
+
+    Returns
+    --------
+    list
+        the rows that were inserted or replaced
+    """
+    changed = []
+
+    for row in rows:
+        z, x, y, contents, tile_id = row
+
+        # deduplicated tiles are compared by the hash of their image
+        if dedupe:
+            stored = cur.execute(
+                "SELECT tile_id FROM map "
+                "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+                (z, x, y),
+            ).fetchone()
+            same = stored is not None and stored[0] == tile_id
+        else:
+            stored = cur.execute(
+                "SELECT tile_data FROM tiles "
+                "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+                (z, x, y),
+            ).fetchone()
+            same = stored is not None and bytes(stored[0]) == bytes(contents)
+
+        if not same:
+            changed.append(row)
+
+    if not dedupe:
+        cur.executemany(
+            "INSERT OR REPLACE INTO tiles "
+            "(zoom_level, tile_column, tile_row, tile_data) "
+            "VALUES (?, ?, ?, ?);",
+            [(z, x, y, buffer(contents)) for z, x, y, contents, _ in changed],
+        )
+        return changed
+
+    cur.executemany(
+        "INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);",
+        [
+            (buffer(contents), tile_id)
+            for _, _, _, contents, tile_id in changed
+            if contents is not None
+        ],
+    )
+    cur.executemany(
+        "INSERT OR REPLACE INTO map "
+        "(zoom_level, tile_column, tile_row, tile_id) "
+        "VALUES (?, ?, ?, ?);",
+        [(z, x, y, tile_id) for z, x, y, _, tile_id in changed],
+    )
+
+    return changed
+
+
+class MBTilesWriter(object):
+    """
+    Writes tiles to an MBTiles file
+
+    Parameters
+    -----------
+    outpath: string
+        filepath of the output
+    image_format: str
+        image format of the tiles (png or webp)
+    dedupe: bool
+        store identical tiles once
+        Default=False
+    durability: str
+        sqlite durability while loading tiles; one of `DURABILITY_LEVELS`
+        Default=normal
+    bounds: list
+        [w, s, e, n] bounds of the tiles in EPSG:4326; unused by MBTiles
+        Default=None
+    """
+
+    def __init__(self, outpath, image_format, dedupe=False, durability="normal", bounds=None):
+        self.outpath = outpath
+        self.image_format = image_format
+        self.dedupe = dedupe
+        self.durability = durability
+        self.bounds = bounds
+        self.conn = None
+
+        # whether images may have been left without tiles by replacing tiles
+        self.replaced = False
+
+    def exists(self):
+        """
+        Whether there is an output to resume
+        """
+        return os.path.exists(self.outpath)
+
+    def create(self, params):
+        """
+        Replace any existing output with an empty one
+
+        Parameters
+        -----------
+        params: dict
+            run parameters to record, and check when resuming
+        """
+        # remove the output filepath if it exists
+        if os.path.exists(self.outpath):
+            os.unlink(self.outpath)
+
+        # create a connection to the mbtiles file; batches are written
+        # from a writer thread, but never while another thread uses it
+        self.conn = sqlite3.connect(
+            self.outpath, timeout=SQLITE_TIMEOUT, check_same_thread=False
+        )
+        cur = self.conn.cursor()
+
+        _apply_pragmas(cur, self.durability)
+
+        # create the tiles table(s)
+        _create_tables(cur, self.dedupe)
+
+        # create empty metadata
+        cur.execute("CREATE TABLE metadata (name text, value text);")
+
+        self.conn.commit()
+
+        # populate metadata with required fields
+        cur.execute(
+            "INSERT INTO metadata " "(name, value) " "VALUES ('format', ?);",
+            (self.image_format,),
+        )
+
+        cur.execute("INSERT INTO metadata " "(name, value) " "VALUES ('name', '');")
+        cur.execute(
+            "INSERT INTO metadata " "(name, value) " "VALUES ('description', '');"
+        )
+        cur.execute("INSERT INTO metadata " "(name, value) " "VALUES ('version', '1');")
+        cur.execute(
+            "INSERT INTO metadata " "(name, value) " "VALUES ('type', 'baselayer');"
+        )
+
+        # record encoding parameters to check when resuming
+        cur.execute(
+            "INSERT INTO metadata " "(name, value) " "VALUES ('rgbify', ?);",
+            (json.dumps(params, sort_keys=True),),
+        )
+
+        self.conn.commit()
+
+    def reopen(self, params, mode="resume"):
+        """
+        Open an existing output to add missing tiles to (resume), or to
+        replace tiles of (update), raising a ValueError if it was written
+        with other parameters
+        """
+        self.conn = sqlite3.connect(
+            self.outpath, timeout=SQLITE_TIMEOUT, check_same_thread=False
+        )
+        cur = self.conn.cursor()
+
+        try:
+            _check_params(self.outpath, _read_params(cur), params, mode)
+        except ValueError:
+            self.conn.close()
+            raise
+
+        _apply_pragmas(cur, self.durability)
+
+    def written(self, ranges):
+        """
+        Set of the tiles within (z, min_tile, max_tile) ranges already written
+        """
+        return _load_tile_set(self.conn.cursor(), ranges, self.dedupe)
+
+    def write(self, rows):
+        """
+        Write and commit a batch of tiles
+
+        Parameters
+        -----------
+        rows: list
+            list of (x, y, z, tile_data, tile_id) tuples;
+            with `dedupe`, tile_data may be None for an already written tile_id
+        """
+        # mbtiles use inverse y indexing
+        _insert_tiles(
+            self.conn.cursor(),
+            [(z, x, 2 ** z - y - 1, contents, tile_id) for x, y, z, contents, tile_id in rows],
+            self.dedupe,
+        )
+        self.conn.commit()
+
+    def upsert(self, rows):
+        """
+        Write and commit a batch of tiles, replacing existing tiles;
+        needs the index made by `index`
+
+        Parameters
+        -----------
+        rows: list
+            list of (x, y, z, tile_data, tile_id) tuples; see `write`
+
+        Returns
+        --------
+        list
+            the rows that changed a tile, leaving out tiles already
+            stored with the same contents
+        """
+        changed = _upsert_tiles(
+            self.conn.cursor(),
+            [(z, x, 2 ** z - y - 1, contents, tile_id) for x, y, z, contents, tile_id in rows],
+            self.dedupe,
+        )
+        self.conn.commit()
+        self.replaced = True
+
+        return [(x, 2 ** z - y - 1, z, contents, tile_id) for z, x, y, contents, tile_id in changed]
+
+    def delete(self, tiles):
+        """
+        Delete and commit tiles
+
+        Parameters
+        -----------
+        tiles: list
+            list of (x, y, z) tiles
+
+        Returns
+        --------
+        list
+            the tiles that existed
+        """
+        cur = self.conn.cursor()
+        table = "map" if self.dedupe else "tiles"
+        deleted = []
+
+        for x, y, z in tiles:
+            cur.execute(
+                "DELETE FROM {0} "
+                "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;".format(table),
+                (z, x, 2 ** z - y - 1),
+            )
+
+            if cur.rowcount > 0:
+                deleted.append((x, y, z))
+
+        self.conn.commit()
+        self.replaced = True
+
+        return deleted
+
+    def index(self):
+        """
+        Make the tiles written so far quick to read back
+        """
+        _create_index(self.conn.cursor(), self.dedupe)
+        self.conn.commit()
+
+    def read_metadata(self, name):
+        """
+        Read a JSON value written with `write_metadata`, or None
+        """
+        return _read_json_metadata(self.conn.cursor(), name)
+
+    def write_metadata(self, name, value):
+        """
+        Write a JSON serializable value to the metadata, replacing
+        any value of the same name
+        """
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM metadata WHERE name = ?;", (name,))
+        cur.execute(
+            "INSERT INTO metadata (name, value) VALUES (?, ?);",
+            (name, json.dumps(value, sort_keys=True)),
+        )
+        self.conn.commit()
+
+    def reader(self):
+        """
+        Make an unopened `MBTilesReader` of the output
+        """
+        return MBTilesReader(self.outpath)
+
+    def close(self):
+        """
+        Finish the output
+        """
+        self.index()
+
+        # drop images that replaced or deleted tiles no longer use
+        if self.dedupe and self.replaced:
+            self.conn.execute(
+                "DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);"
+            )
+            self.conn.commit()
+
+        self.conn.close()
+        self.conn = None
+
+
+class MBTilesReader(object):
+    """
+    Reads tiles from an MBTiles file, connecting on the first read
+
+    Parameters
+    -----------
+    path: string
+        filepath of the mbtiles file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def read(self, x, y, z):
+        """
+        Read the image of a tile, or None if it does not exist
+        """
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+
+        row = self.conn.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+            (z, x, 2 ** z - y - 1),
+        ).fetchone()
+
+        return None if row is None else bytes(row[0])
+
+    def close(self):
+        """
+        Close the connection, if any
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class PMTilesWriter(MBTilesWriter):
+    """
+    Writes tiles to a PMTiles v3 archive. Tiles are staged in an MBTiles
+    file next to the archive, which `close` converts into a clustered
+    archive; an interrupted run leaves the staging file to resume from.
+    See `MBTilesWriter` for parameters.
+    """
+
+    def __init__(self, outpath, image_format, dedupe=False, durability="normal", bounds=None):
+        super(PMTilesWriter, self).__init__(
+            outpath + STAGING_SUFFIX, image_format, dedupe, durability, bounds
+        )
+        self.archive = outpath
+        self.params = None
+
+    def exists(self):
+        """
+        Whether there is a staging file or an archive
+        """
+        return os.path.exists(self.outpath) or os.path.exists(self.archive)
+
+    def create(self, params):
+        """
+        Replace any existing archive with an empty staging file
+        """
+        if os.path.exists(self.archive):
+            os.unlink(self.archive)
+
+        super(PMTilesWriter, self).create(params)
+        self.params = params
+
+    def reopen(self, params, mode="resume"):
+        """
+        Open the staging file of an interrupted run; see `MBTilesWriter.reopen`
+        """
+        # a finished archive cannot be added to
+        if not os.path.exists(self.outpath):
+            raise ValueError(
+                "Cannot resume {0}: it has no {1} file of an interrupted run".format(
+                    self.archive, STAGING_SUFFIX
+                )
+            )
+
+        super(PMTilesWriter, self).reopen(params, mode)
+        self.params = params
+
+    def close(self):
+        """
+        Convert the staging file into the archive, and remove it
+        """
+        metadata = _extra_metadata(self.conn.cursor())
+
+        super(PMTilesWriter, self).close()
+
+        metadata.update(
+            {
+                "name": "",
+                "description": "",
+                "version": "1",
+                "type": "baselayer",
+                "format": self.image_format,
+                "rgbify": self.params,
+            }
+        )
+
+        _write_pmtiles(
+            self.outpath, self.archive, self.image_format, self.bounds, metadata, self.dedupe
+        )
+        os.unlink(self.outpath)
+
+
+class DirectoryWriter(object):
+    """
+    Writes tiles to a `{z}/{x}/{y}.{format}` directory tree, with run
+    parameters in a `metadata.json` at its root. With `dedupe`, repeated
+    tiles are hard links to the first file with their data where the
+    filesystem allows it. See `MBTilesWriter` for parameters.
+    """
+
+    def __init__(self, outpath, image_format, dedupe=False, durability="normal", bounds=None):
+        self.outpath = outpath
+        self.image_format = image_format
+        self.dedupe = dedupe
+        self.bounds = bounds
+        self.paths = {}
+        self.dirs = set()
+
+    def _metadata_path(self):
+        return os.path.join(self.outpath, "metadata.json")
+
+    def _read_params(self):
+        return self.read_metadata("rgbify")
+
+    def read_metadata(self, name):
+        """
+        Read a value of `metadata.json`, or None if it is missing
+        """
+        try:
+            with open(self._metadata_path()) as f:
+                return json.load(f).get(name)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_metadata(self, name, value):
+        """
+        Add a value to `metadata.json`, or replace it
+        """
+        with open(self._metadata_path()) as f:
+            metadata = json.load(f)
+
+        metadata[name] = value
+
+        with open(self._metadata_path() + ".tmp", "w") as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+
+        os.unlink(self._metadata_path())
+        os.rename(self._metadata_path() + ".tmp", self._metadata_path())
+
+    def _tile_path(self, x, y, z):
+        return os.path.join(
+            self.outpath, str(z), str(x), "{0}.{1}".format(y, self.image_format)
+        )
+
+    def exists(self):
+        """
+        Whether there is an output directory to resume
+        """
+        return os.path.isdir(self.outpath)
+
+    def create(self, params):
+        """
+        Replace a directory of a previous run with an empty one; any
+        other non-empty directory is refused
+        """
+        if os.path.isdir(self.outpath) and os.listdir(self.outpath):
+            # only replace directories written by a previous run
+            if self._read_params() is None:
+                raise ValueError(
+                    "Cannot write tiles to {0}: it is not empty".format(self.outpath)
+                )
+
+            shutil.rmtree(self.outpath)
+
+        if not os.path.isdir(self.outpath):
+            os.makedirs(self.outpath)
+
+        metadata = {
+            "format": self.image_format,
+            "bounds": self.bounds,
+            "rgbify": params,
+        }
+
+        with open(self._metadata_path(), "w") as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+
+    def reopen(self, params, mode="resume"):
+        """
+        Check an existing directory was written with the same parameters
+        """
+        _check_params(self.outpath, self._read_params(), params, mode)
+
+    def written(self, ranges):
+        """
+        Set of the tiles within (z, min_tile, max_tile) ranges already written
+        """
+        ranges = list(ranges)
+        done = _TileSet(ranges)
+        suffix = "." + self.image_format
+
+        for z, _, _ in ranges:
+            zoom_dir = os.path.join(self.outpath, str(z))
+
+            if not os.path.isdir(zoom_dir):
+                continue
+
+            for column in os.listdir(zoom_dir):
+                names = [
+                    name
+                    for name in os.listdir(os.path.join(zoom_dir, column))
+                    if name.endswith(suffix)
+                ]
+                ys = [int(name[: -len(suffix)]) for name in names]
+
+                done.update([int(column)] * len(ys), ys, z)
+
+        return done
+
+    def write(self, rows):
+        """
+        Write (x, y, z, contents, tile_id) rows, each tile to its own file
+        """
+        for x, y, z, contents, tile_id in rows:
+            path = self._tile_path(x, y, z)
+            column_dir = os.path.dirname(path)
+
+            if column_dir not in self.dirs:
+                try:
+                    os.makedirs(column_dir)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+                self.dirs.add(column_dir)
+
+            if contents is None:
+                _link_or_copy(self.paths[tile_id], path)
+                continue
+
+            # a tile file either exists complete, or not at all
+            with open(path + ".tmp", "wb") as f:
+                f.write(contents)
+
+            if os.path.exists(path):
+                os.unlink(path)
+
+            os.rename(path + ".tmp", path)
+
+            if self.dedupe:
+                self.paths[tile_id] = path
+
+    def index(self):
+        """
+        Nothing to index: tiles are found by their paths
+        """
+        pass
+
+    def reader(self):
+        """
+        Reader of the tiles written so far
+        """
+        return DirectoryReader(self.outpath, self.image_format)
+
+    def close(self):
+        """
+        Forget the files of deduplicated tiles
+        """
+        self.paths.clear()
+
+
+class DirectoryReader(object):
+    """
+    Reads tiles from a `{z}/{x}/{y}.{format}` directory tree
+
+    Parameters
+    -----------
+    path: string
+        root of the directory tree
+    image_format: str
+        image format of the tiles (png or webp)
+    """
+
+    def __init__(self, path, image_format):
+        self.path = path
+        self.image_format = image_format
+
+    def read(self, x, y, z):
+        """
+        Read the image of a tile, or None if it does not exist
+        """
+        path = os.path.join(
+            self.path, str(z), str(x), "{0}.{1}".format(y, self.image_format)
+        )
+
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            return None
+
+    def close(self):
+        """
+        Nothing to close: each read opens its own file
+        """
+        pass
+
+
+def _link_or_copy(src_path, dst_path):
+    """
+    Hard link a file, or copy it if the filesystem cannot link
+    """
+    if os.path.exists(dst_path):
+        os.unlink(dst_path)
+
+    try:
+        os.link(src_path, dst_path)
+    except (AttributeError, OSError):
+        shutil.copyfile(src_path, dst_path)
+
+
+def _tile_id(z, x, y):
+    """
+    PMTiles tile id: the number of tiles of lower zooms, plus
+    the position of the tile along the Hilbert curve of its zoom
+
+    Parameters
+    -----------
+    z, x, y: int
+        tile indices
+
+    Returns
+    --------
+    int
+    """
+    tile_id = ((1 << (z * 2)) - 1) // 3
+
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += ((3 * rx) ^ ry) << (2 * a)
+
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+
+    return tile_id
+
+
+def _write_varint(out, value):
+    """
+    Append an unsigned LEB128 varint to a bytearray
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def _gzip(data):
+    """
+    Gzip compress bytes
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+
+    return compressor.compress(bytes(data)) + compressor.flush()
+
+
+def _serialize_directory(entries):
+    """
+    Serialize and gzip a PMTiles directory
+
+    Parameters
+    -----------
+    entries: list
+        list of (tile_id, offset, length, run_length) sorted by tile_id
+
+    Returns
+    --------
+    bytes
+    """
+    out = bytearray()
+    _write_varint(out, len(entries))
+
+    last_id = 0
+
+    for tile_id, _, _, _ in entries:
+        _write_varint(out, tile_id - last_id)
+        last_id = tile_id
+
+    for _, _, _, run_length in entries:
+        _write_varint(out, run_length)
+
+    for _, _, length, _ in entries:
+        _write_varint(out, length)
+
+    # 0 marks data directly following the previous entry's
+    for i, (_, offset, _, _) in enumerate(entries):
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            _write_varint(out, 0)
+        else:
+            _write_varint(out, offset + 1)
+
+    return _gzip(out)
+
+
+def _build_directories(entries, root_size):
+    """
+    Serialize PMTiles entries into a root directory of at most `root_size`
+    bytes, moving them into leaf directories if they do not fit
+
+    Returns
+    --------
+    root, leaves: bytes
+        serialized root directory, and concatenated leaf directories
+    """
+    root = _serialize_directory(entries)
+
+    if len(root) <= root_size:
+        return root, b""
+
+    leaf_size = 4096
+
+    while True:
+        leaves = []
+        leaf_entries = []
+        leaves_length = 0
+
+        for i in range(0, len(entries), leaf_size):
+            leaf = _serialize_directory(entries[i : i + leaf_size])
+            leaf_entries.append((entries[i][0], leaves_length, len(leaf), 0))
+            leaves.append(leaf)
+            leaves_length += len(leaf)
+
+        root = _serialize_directory(leaf_entries)
+
+        if len(root) <= root_size:
+            return root, b"".join(leaves)
+
+        leaf_size *= 2
+
+
+def _write_pmtiles(inpath, outpath, image_format, bounds, metadata, dedupe=False):
+    """
+    Write the tiles of an mbtiles file to a clustered PMTiles v3 archive,
+    with tile data in tile id (Hilbert) order
+
+    Parameters
+    -----------
+    inpath: string
+        filepath of the mbtiles file
+    outpath: string
+        filepath of the pmtiles archive
+    image_format: str
+        image format of the tiles (png or webp)
+    bounds: list
+        [w, s, e, n] bounds of the tiles in EPSG:4326
+    metadata: dict
+        json metadata of the archive
+    dedupe: bool
+        whether the mbtiles file uses the `map` + `images` layout;
+        identical tiles then share their data
+
+    Returns
+    --------
+    None
+    """
+    conn = sqlite3.connect(inpath, timeout=SQLITE_TIMEOUT)
+
+    try:
+        if dedupe:
+            rows = conn.execute("SELECT zoom_level, tile_column, tile_row, tile_id FROM map;")
+            query = "SELECT tile_data FROM images WHERE tile_id = ?;"
+        else:
+            rows = conn.execute("SELECT zoom_level, tile_column, tile_row, rowid FROM tiles;")
+            query = "SELECT tile_data FROM tiles WHERE rowid = ?;"
+
+        keys = []
+        zooms = set()
+
+        for z, x, row, key in rows:
+            # mbtiles use inverse y indexing
+            keys.append((_tile_id(z, x, 2 ** z - row - 1), key))
+            zooms.add(z)
+
+        keys.sort()
+
+        entries = []
+        offsets = {}
+        data_length = 0
+
+        with tempfile.TemporaryFile() as data:
+            for tile_id, key in keys:
+                if key in offsets:
+                    offset, length = offsets[key]
+                else:
+                    contents = conn.execute(query, (key,)).fetchone()[0]
+                    offset, length = data_length, len(contents)
+                    data.write(contents)
+                    data_length += length
+
+                    if dedupe:
+                        offsets[key] = offset, length
+
+                # runs of consecutive tiles with the same data share one entry
+                if entries:
+                    last_id, last_offset, _, run_length = entries[-1]
+
+                    if last_id + run_length == tile_id and last_offset == offset:
+                        entries[-1][3] += 1
+                        continue
+
+                entries.append([tile_id, offset, length, 1])
+
+            root, leaves = _build_directories(
+                [tuple(entry) for entry in entries], PMTILES_ROOT_SIZE - PMTILES_HEADER_SIZE
+            )
+            meta = _gzip(json.dumps(metadata, sort_keys=True).encode("utf-8"))
+
+            min_z, max_z = (min(zooms), max(zooms)) if zooms else (0, 0)
+            w, s, e, n = bounds
+
+            header = struct.pack(
+                "<7sBQQQQQQQQQQQBBBBBBiiiiBii",
+                b"PMTiles",
+                3,
+                PMTILES_HEADER_SIZE,
+                len(root),
+                PMTILES_HEADER_SIZE + len(root),
+                len(meta),
+                PMTILES_HEADER_SIZE + len(root) + len(meta),
+                len(leaves),
+                PMTILES_HEADER_SIZE + len(root) + len(meta) + len(leaves),
+                data_length,
+                len(keys),
+                len(entries),
+                len(offsets) if dedupe else len(keys),
+                1,
+                PMTILES_GZIP,
+                PMTILES_NONE,
+                PMTILES_TILE_TYPES[image_format],
+                min_z,
+                max_z,
+                int(round(w * 1e7)),
+                int(round(s * 1e7)),
+                int(round(e * 1e7)),
+                int(round(n * 1e7)),
+                min_z,
+                int(round((w + e) / 2 * 1e7)),
+                int(round((s + n) / 2 * 1e7)),
+            )
+
+            with open(outpath, "wb") as dst:
+                dst.write(header)
+                dst.write(root)
+                dst.write(meta)
+                dst.write(leaves)
+
+                data.seek(0)
+                shutil.copyfileobj(data, dst)
+    finally:
+        conn.close()
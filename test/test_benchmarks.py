@@ -0,0 +1,17 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+import bench_rgbify  # noqa: E402
+
+
+def test_bench_tile_worker(tmpdir):
+    path = bench_rgbify.write_dem(str(tmpdir.join("dem.tif")), 512, "float32")
+
+    results = bench_rgbify.bench_tile_worker(path, 1)
+
+    assert [(r["params"]["z"], r["params"]["metatile_size"]) for r in results] == [
+        (z, size) for z in bench_rgbify.TILE_WORKER_ZOOMS for size in (1, 4)
+    ]
+    assert all(r["tiles_per_sec"] > 0 for r in results)
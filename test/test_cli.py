@@ -1,12 +1,15 @@
 import os
+import json
+import sqlite3
 
 import click
+import mercantile
 from click.testing import CliRunner
 
 import numpy as np
 
 import rasterio as rio
-from rio_rgbify.scripts.cli import rgbify
+from rio_rgbify.scripts.cli import rgbify, merge, decode
 
 from raster_tester.compare import affaux, upsample_array
 
@@ -308,3 +311,280 @@ def test_bad_input_format():
         )
         assert result.exit_code == 1
         assert result.exception
+
+
+def test_mbtiler_batch_durability():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        out_mbtiles = "output.mbtiles"
+        result = runner.invoke(
+            rgbify,
+            [
+                in_elev_src,
+                out_mbtiles,
+                "--min-z",
+                10,
+                "--max-z",
+                11,
+                "--batch-size",
+                1,
+                "--durability",
+                "full",
+                "-j",
+                1,
+            ],
+        )
+        assert result.exit_code == 0
+        assert os.path.exists(out_mbtiles)
+
+        result_bad = runner.invoke(
+            rgbify,
+            [
+                in_elev_src,
+                out_mbtiles,
+                "--min-z",
+                10,
+                "--max-z",
+                11,
+                "--durability",
+                "yolo",
+            ],
+        )
+        assert result_bad.exit_code == 2
+
+
+def test_mbtiler_stats_out():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(
+            rgbify,
+            [
+                in_elev_src,
+                "output.mbtiles",
+                "--min-z",
+                10,
+                "--max-z",
+                11,
+                "--stats-out",
+                "stats.json",
+                "-j",
+                1,
+            ],
+        )
+        assert result.exit_code == 0
+
+        with open("stats.json") as f:
+            stats = json.load(f)
+
+        assert stats["tiles"] == 2
+
+
+def test_tiler_outputs():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        for dst_path in ["output.pmtiles", "output"]:
+            result = runner.invoke(
+                rgbify,
+                [
+                    in_elev_src,
+                    dst_path,
+                    "--min-z",
+                    10,
+                    "--max-z",
+                    11,
+                    "--tile-size",
+                    "256",
+                    "--format",
+                    "webp",
+                    "-j",
+                    1,
+                ],
+            )
+            assert result.exit_code == 0
+
+        with open("output.pmtiles", "rb") as f:
+            assert f.read(7) == b"PMTiles"
+
+        assert os.path.exists(os.path.join("output", "metadata.json"))
+        assert len(os.listdir(os.path.join("output", "11"))) == 1
+
+        result_bad = runner.invoke(
+            rgbify, [in_elev_src, "output.mbtiles", "--min-z", 10, "--max-z", 11,
+                     "--tile-size", "300"],
+        )
+        assert result_bad.exit_code == 2
+
+
+def test_mbtiler_precision_schedule():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        args = [in_elev_src, "output.mbtiles", "--min-z", 10, "--max-z", 11, "-j", 1]
+
+        result = runner.invoke(
+            rgbify,
+            args + ["--round-digits-schedule", '{"10": 4, "11": 0}', "--max-error", 0.5],
+        )
+        assert result.exit_code == 0
+
+        result_bad = runner.invoke(rgbify, args + ["--interval-schedule", "[0.1, 1]"])
+        assert result_bad.exit_code == 1
+        assert "is not valid" in str(result_bad.exception)
+
+
+def test_shard_and_merge():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        args = [in_elev_src, "--min-z", 10, "--max-z", 12, "-j", 1]
+
+        for shard in ("1/2", "2/2"):
+            result = runner.invoke(
+                rgbify, args[:1] + ["shard-{0}.mbtiles".format(shard[0])] + args[1:]
+                + ["--shard", shard]
+            )
+            assert result.exit_code == 0
+
+        result = runner.invoke(merge, ["shard-1.mbtiles", "shard-2.mbtiles", "merged.mbtiles"])
+        assert result.exit_code == 0
+        assert os.path.exists("merged.mbtiles")
+
+        result = runner.invoke(merge, ["shard-1.mbtiles", "merged-half.mbtiles"])
+        assert result.exit_code == 1
+
+        result = runner.invoke(rgbify, args[:1] + ["bad.mbtiles"] + args[1:] + ["--shard", "1-2"])
+        assert result.exit_code == 1
+        assert "is not valid" in str(result.exception)
+
+
+def test_mosaic_files_from():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with rio.open(in_elev_src) as src:
+            half = src.width // 2
+
+            for i, col in enumerate((0, half)):
+                window = rio.windows.Window(col, 0, half, src.height)
+                profile = src.profile.copy()
+                profile.update(width=half, transform=src.window_transform(window))
+
+                with rio.open("part-{0}.tif".format(i), "w", **profile) as dst:
+                    dst.write(src.read(1, window=window), 1)
+
+        with open("sources.txt", "w") as f:
+            f.write("part-1.tif\n\n")
+
+        result = runner.invoke(
+            rgbify,
+            ["part-0.tif", "mosaic.mbtiles", "--files-from", "sources.txt",
+             "--min-z", 10, "--max-z", 11, "-j", 1],
+        )
+        assert result.exit_code == 0
+        assert os.path.exists("mosaic.mbtiles")
+
+        result = runner.invoke(rgbify, ["part-0.tif", "part-1.tif", "mosaic.tif"])
+        assert result.exit_code == 1
+        assert "single source" in str(result.exception)
+
+
+def test_mbtiler_footprint():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("footprint.geojson", "w") as f:
+            json.dump(mercantile.feature(mercantile.Tile(654, 1582, 12)), f)
+
+        result = runner.invoke(
+            rgbify,
+            [in_elev_src, "footprint.mbtiles", "--footprint", "footprint.geojson",
+             "--min-z", 12, "--max-z", 13, "-j", 1],
+        )
+        assert result.exit_code == 0
+
+        with sqlite3.connect("footprint.mbtiles") as conn:
+            tiles = conn.execute("SELECT zoom_level, COUNT(*) FROM tiles GROUP BY zoom_level;")
+            counts = dict(tiles.fetchall())
+
+        # the tile and its neighbours in the grown footprint, of those with data
+        assert 1 <= counts[12] <= 4
+        assert counts[13] <= 16
+
+        result = runner.invoke(
+            rgbify,
+            [in_elev_src, "bad.mbtiles", "--footprint", "missing.geojson",
+             "--min-z", 12, "--max-z", 13],
+        )
+        assert result.exit_code == 1
+
+
+def test_mbtiler_update_changed_out():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        args = [in_elev_src, "update.mbtiles", "--min-z", 13, "--max-z", 14, "-j", 1]
+
+        result = runner.invoke(rgbify, args)
+        assert result.exit_code == 0
+
+        # re-tiling unchanged data changes no tiles
+        result = runner.invoke(
+            rgbify,
+            args + ["--update-extent", "[-122.44, 37.78, -122.43, 37.79]",
+                    "--changed-out", "changed.txt"],
+        )
+        assert result.exit_code == 0
+
+        with open("changed.txt") as f:
+            assert f.read() == ""
+
+        result = runner.invoke(rgbify, args + ["--update-extent", "[-122.44, 37.78]"])
+        assert result.exit_code == 1
+
+        result = runner.invoke(rgbify, args + ["--changed-out", "changed.txt"])
+        assert result.exit_code == 1
+
+
+def test_mbtiler_profile():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(
+            rgbify,
+            [in_elev_src, "profile.mbtiles", "--min-z", 12, "--max-z", 13, "-j", 2,
+             "--profile-out", "run.prof", "--profile-sample", 0.5],
+        )
+        assert result.exit_code == 0
+        assert os.path.getsize("run.prof") > 0
+
+        result = runner.invoke(
+            rgbify,
+            [in_elev_src, "none.mbtiles", "--profile-out", "none.prof", "--profile-sample", 0],
+        )
+        assert result.exit_code == 2
+        assert "--profile-sample" in result.output
+
+
+def test_decode():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(rgbify, [in_elev_src, "rgb.tif", "--interval", 0.1,
+                                        "--base-val", -100])
+        assert result.exit_code == 0
+
+        result = runner.invoke(decode, ["rgb.tif", "decoded.tif", "-i", 0.1, "-b", -100])
+        assert result.exit_code == 0
+
+        with rio.open(in_elev_src) as src, rio.open("decoded.tif") as decoded:
+            assert np.abs(decoded.read(1) - src.read(1)).max() <= 0.051
+
+        result = runner.invoke(rgbify, [in_elev_src, "rgb.mbtiles", "--min-z", 14,
+                                        "--max-z", 14, "-j", 1])
+        assert result.exit_code == 0
+
+        result = runner.invoke(decode, ["rgb.mbtiles", "tiles.tif", "--co", "compress=lzw"])
+        assert result.exit_code == 0
+
+        with rio.open("tiles.tif") as decoded:
+            assert decoded.crs.to_epsg() == 3857
+            assert decoded.compression.value == "LZW"
+
+        result = runner.invoke(decode, ["rgb.mbtiles", "bad.tif", "--bounds", "[-122, 37]"])
+        assert result.exit_code == 1
+
+        result = runner.invoke(decode, ["rgb.mbtiles", "bad.tif", "--zoom", 3])
+        assert result.exit_code == 1
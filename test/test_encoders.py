@@ -1,8 +1,13 @@
 from __future__ import division
-from rio_rgbify.encoders import data_to_rgb, _decode, _range_check
+from rio_rgbify.encoders import (
+    data_to_rgb, decode, _decode, _range_check, _rounding_error, _coarsest_round_digits,
+    MAX_ROUND_DIGITS)
 import numpy as np
 import pytest
 
+from hypothesis import given
+import hypothesis.strategies as st
+
 
 def test_encode_data_roundtrip():
     minrand, maxrand = np.sort(np.random.randint(-427, 8848, 2))
@@ -23,6 +28,25 @@ def test_encode_data_roundtrip():
     assert testdata.max() == rtripped.max()
 
 
+def test_decode():
+    rgb = np.random.RandomState(0).randint(0, 256, (3, 64, 65)).astype(np.uint8)
+    expected = -10000 + (
+        rgb[0].astype(np.float64) * 256 * 256 + rgb[1] * 256.0 + rgb[2]) * 0.1
+
+    assert np.array_equal(decode(rgb, -10000, 0.1), expected)
+    assert np.array_equal(_decode(rgb, -10000, 0.1), expected)
+
+    decoded = decode(rgb, -10000, 0.1, dtype=np.float32)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, expected, atol=1e-3)
+
+    out = np.empty((64, 65), dtype=np.float32)
+    assert decode(rgb, -10000, 0.1, out=out) is out
+
+    with pytest.raises(ValueError):
+        decode(rgb, -10000, 0.1, out=np.empty((65, 64)))
+
+
 def test_encode_failrange():
     testdata = np.zeros((2))
 
@@ -36,3 +60,110 @@ def test_catch_range():
     assert _range_check(256 ** 3 + 1)
     assert not _range_check(256 ** 3 - 1)
 
+
+def _reference_data_to_rgb(data, baseval, interval, round_digits=0):
+    # the original float64 encoder, kept to check the fast path is bit-exact
+    data = data.astype(np.float64)
+    data -= baseval
+    data /= interval
+
+    data = np.around(data / 2**round_digits) * 2**round_digits
+
+    rgb = np.zeros((3,) + data.shape, dtype=np.uint8)
+
+    rgb[2] = ((data / 256) - (data // 256)) * 256
+    rgb[1] = (((data // 256) / 256) - ((data // 256) // 256)) * 256
+    rgb[0] = ((((data // 256) // 256) / 256) - (((data // 256) // 256) // 256)) * 256
+
+    return rgb
+
+
+@given(
+    st.sampled_from([np.float64, np.float32, np.int16, np.int32, np.uint16]),
+    st.lists(st.floats(min_value=-10000, max_value=10000), min_size=1, max_size=64),
+    st.sampled_from([-10000, -100.5, 0, 0.5, 3]),
+    st.sampled_from([0.001, 0.1, 0.25, 1, 3]),
+    st.integers(min_value=0, max_value=4))
+def test_encode_matches_reference(dtype, values, baseval, interval, round_digits):
+    testdata = np.array(values).astype(dtype).reshape(1, -1)
+
+    expected = _reference_data_to_rgb(testdata, baseval, interval, round_digits)
+
+    datarange = np.ptp(np.around((testdata.astype(np.float64) - baseval) / interval / 2**round_digits) * 2**round_digits)
+
+    if _range_check(datarange):
+        with pytest.raises(ValueError):
+            data_to_rgb(testdata, baseval, interval, round_digits)
+        return
+
+    encoded = data_to_rgb(testdata, baseval, interval, round_digits)
+
+    assert encoded.dtype == np.uint8
+    assert np.array_equal(encoded, expected)
+
+
+def test_encode_blocks_match_reference():
+    testdata = (np.random.rand(700, 300) * 8000 - 400).astype(np.float32)
+
+    expected = _reference_data_to_rgb(testdata, -10000, 0.1, 2)
+    encoded = data_to_rgb(testdata, -10000, 0.1, round_digits=2)
+
+    assert np.array_equal(encoded, expected)
+
+    testdata = np.random.randint(-400, 8000, (700, 300)).astype(np.int16)
+
+    assert np.array_equal(
+        data_to_rgb(testdata, -10000, 1), _reference_data_to_rgb(testdata, -10000, 1))
+
+
+def test_encode_out_buffer():
+    testdata = np.arange(512 * 512, dtype=np.float64).reshape(512, 512) / 100.
+
+    out = np.empty((3, 512, 512), dtype=np.uint8)
+
+    encoded = data_to_rgb(testdata, -100, 0.1, out=out)
+
+    assert encoded is out
+    assert np.array_equal(out, _reference_data_to_rgb(testdata, -100, 0.1))
+
+    with pytest.raises(ValueError):
+        data_to_rgb(testdata, -100, 0.1, out=np.empty((3, 256, 256), dtype=np.uint8))
+
+    with pytest.raises(ValueError):
+        data_to_rgb(testdata, -100, 0.1, out=np.empty((3, 512, 512), dtype=np.float64))
+
+
+@given(
+    st.floats(min_value=0.001, max_value=1000),
+    st.sampled_from([0.01, 0.1, 1]),
+    st.integers(min_value=0, max_value=2 ** 31),
+)
+def test_coarsest_round_digits(max_error, interval, seed):
+    data = np.random.RandomState(seed).uniform(-100, 4000, (64, 64))
+    baseval = -10000
+
+    round_digits, error, squared_error = _coarsest_round_digits(data, baseval, interval, max_error)
+
+    decoded = _decode(data_to_rgb(data, baseval, interval, round_digits), baseval, interval)
+    measured = np.abs(decoded - data)
+
+    assert np.isclose(error, measured.max())
+    assert np.isclose(squared_error, (measured ** 2).sum())
+
+    # within budget, unless even no rounding is not
+    if round_digits > 0:
+        assert error <= max_error
+        assert round_digits >= np.floor(np.log2(2 * max_error / interval)) - 1
+
+    if round_digits < MAX_ROUND_DIGITS:
+        assert _rounding_error(data, baseval, interval, round_digits + 1).max() > max_error
+
+
+def test_coarsest_round_digits_flat():
+    # integers on a coarse grid round away more digits than the bound allows
+    data = np.full((16, 16), 1024.0)
+
+    round_digits, error, _ = _coarsest_round_digits(data, 0, 1, 0.5)
+
+    assert round_digits == 10
+    assert error == 0
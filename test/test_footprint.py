@@ -0,0 +1,199 @@
+import os
+import json
+import itertools
+
+import mercantile
+import numpy as np
+import pytest
+import rasterio
+from rasterio import transform
+from rasterio.warp import transform_bounds
+
+from hypothesis import given
+import hypothesis.strategies as st
+
+from rio_rgbify.footprint import Extents, Footprint
+from rio_rgbify.mbtiler import (
+    _curve_range, _make_metatiles, _overview_levels, _shard_bounds, _shard_jobs,
+    _zoom_ranges, _count_zoom_jobs, RGBTiler)
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+def _diagonal(path):
+    """
+    Write elev.tif with nodata above its diagonal
+    """
+    with rasterio.open(in_elev_src) as src:
+        profile = src.profile.copy()
+        data = src.read(1)
+
+    rows, cols = np.indices(data.shape)
+    data[rows + cols < data.shape[0]] = -9999
+    profile.update(nodata=-9999)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+    return path
+
+
+def _world_footprint(covered):
+    """
+    Footprint of a grid of cells over the whole EPSG:3857 world
+    """
+    size = len(covered)
+    extent = 20037508.342789244
+
+    cell = 2 * extent / size
+
+    return Footprint(covered, transform.from_origin(-extent, extent, cell, cell))
+
+
+@given(st.integers(min_value=0, max_value=2 ** 32 - 1))
+def test_covers(seed):
+    rng = np.random.RandomState(seed)
+    covered = rng.uniform(size=(16, 16)) > 0.97
+    footprint = _world_footprint(covered)
+
+    # a zoom 4 tile is one cell; the footprint grows by one cell
+    grown = np.zeros((18, 18), dtype=bool)
+    for dr, dc in itertools.product(range(3), repeat=2):
+        grown[dr:dr + 16, dc:dc + 16] |= covered
+    grown = grown[1:-1, 1:-1]
+
+    x0, x1 = sorted(rng.randint(0, 16, 2))
+    y0, y1 = sorted(rng.randint(0, 16, 2))
+
+    assert footprint.covers(x0, y0, x1, y1, 4) == grown[y0:y1 + 1, x0:x1 + 1].any()
+
+    # tiles of higher zooms touch the cell they fall in
+    x, y = rng.randint(0, 64, 2)
+    assert footprint.covers(x, y, x, y, 6) == grown[y // 4, x // 4]
+
+
+def test_curve_range_covered():
+    covered = np.zeros((16, 16), dtype=bool)
+    covered[3, 12] = True
+    footprint = _world_footprint(covered)
+
+    calls = []
+
+    def covers(*block):
+        calls.append(block)
+        return footprint.covers(*block, z=9)
+
+    for hilbert in (True, False):
+        del calls[:]
+        tiles = list(_curve_range(0, 0, 511, 511, 9, hilbert, covers))
+        expected = [tile for tile in _curve_range(0, 0, 511, 511, 9, hilbert)
+                    if footprint.covers(tile[0], tile[1], tile[0], tile[1], 9)]
+
+        # 3 x 3 cells of 32 x 32 tiles, in curve order
+        assert tiles == expected
+        assert len(tiles) == 9 * 32 * 32
+
+        # blocks of uncovered tiles are pruned without visiting their tiles
+        assert len(calls) < 2 * len(tiles)
+
+
+def test_from_geojson(tmpdir):
+    tile = mercantile.Tile(163, 395, 10)
+    path = str(tmpdir.join('footprint.geojson'))
+
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {}, 'geometry': mercantile.feature(tile)['geometry']}]}, f)
+
+    footprint = Footprint.from_geojson(path)
+
+    assert footprint.covers(tile.x, tile.y, tile.x, tile.y, tile.z)
+    assert footprint.covers(2 * tile.x + 1, 2 * tile.y, 2 * tile.x + 1, 2 * tile.y, tile.z + 1)
+    assert not footprint.covers(tile.x + 2, tile.y, tile.x + 2, tile.y, tile.z)
+    assert not footprint.covers(0, 0, 10, 10, 5)
+
+    with pytest.raises(ValueError):
+        Footprint.from_geojson({'type': 'FeatureCollection', 'features': []})
+
+    with pytest.raises(ValueError):
+        Footprint.from_geojson({'type': 'Topology'})
+
+
+def test_extents():
+    tile = mercantile.Tile(163, 395, 10)
+    west, south, east, north = mercantile.bounds(tile)
+
+    # the middle quarter of the tile
+    extents = Extents([[west + (east - west) / 4, south + (north - south) / 4,
+                        east - (east - west) / 4, north - (north - south) / 4]])
+
+    assert extents.covers(tile.x, tile.y, tile.x, tile.y, tile.z)
+    assert extents.covers(0, 0, 2 ** 10 - 1, 2 ** 10 - 1, 10)
+    assert not extents.covers(tile.x + 1, tile.y, tile.x + 1, tile.y, tile.z)
+
+    # the corner children of the tile at zoom 13 are outside it, unless grown
+    corner = (8 * tile.x, 8 * tile.y)
+    assert not extents.covers(corner[0], corner[1], corner[0], corner[1], 13)
+
+    extents.padding = (mercantile.xy_bounds(tile).right - mercantile.xy_bounds(tile).left) / 2
+    assert extents.covers(corner[0], corner[1], corner[0], corner[1], 13)
+    assert extents.covers(tile.x + 1, tile.y, tile.x + 1, tile.y, tile.z)
+
+    with pytest.raises(ValueError):
+        Extents([])
+
+
+def test_make_metatiles_footprint(tmpdir):
+    path = _diagonal(str(tmpdir.join('diagonal.tif')))
+
+    with rasterio.open(path) as src:
+        bbox = list(src.bounds)
+        crs = src.crs
+
+    footprint = Footprint.from_levels(
+        _overview_levels(path), transform_bounds(crs, 'EPSG:3857', *bbox))
+
+    for ordering, metatile_size in itertools.product(('hilbert', 'columns'), (1, 2)):
+        pruned = list(_make_metatiles(bbox, crs, 10, 16, metatile_size, ordering, footprint))
+        jobs = list(_make_metatiles(bbox, crs, 10, 16, metatile_size, ordering))
+
+        tiles = [tuple(tile) for job in pruned for tile in job]
+        all_tiles = [tuple(tile) for job in jobs for tile in job]
+
+        # the same order, with the tiles above the diagonal dropped
+        assert tiles == [tile for tile in all_tiles if tile in set(tiles)]
+        assert len(tiles) < len(all_tiles)
+
+    # shards split the jobs that touch the footprint
+    ranges = list(_zoom_ranges(bbox, crs, 10, 16))
+    counts = _count_zoom_jobs(_make_metatiles(bbox, crs, 10, 16, 1, 'hilbert', footprint))
+
+    sharded = []
+    for index in (1, 2, 3):
+        bounds = _shard_bounds(ranges, 1, (index, 3), counts)
+        sharded.extend(
+            _shard_jobs(_make_metatiles(bbox, crs, 10, 16, 1, 'hilbert', footprint), bounds))
+
+    assert sorted(sharded) == sorted(_make_metatiles(bbox, crs, 10, 16, 1, 'hilbert', footprint))
+
+
+def test_RGBtiler_footprint(tmpdir):
+    path = _diagonal(str(tmpdir.join('diagonal.tif')))
+    written = {}
+
+    for footprint in ('mask', 'none'):
+        outpath = str(tmpdir.join('{0}.mbtiles'.format(footprint)))
+        jobs = []
+
+        with RGBTiler(path, outpath, 12, 15, interval=0.1, base_val=-10000,
+                      footprint=footprint, callback=lambda tile, _: jobs.append(tile)) as tiler:
+            tiler.run(1)
+
+        written[footprint] = sorted(jobs)
+
+    # tiles outside the footprint have no data, so are never written
+    assert written['mask'] == written['none']
+
+    with pytest.raises(ValueError):
+        RGBTiler(path, 'out.mbtiles', 12, 15, footprint='missing.geojson')
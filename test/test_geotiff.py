@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from rio_rgbify.encoders import data_to_rgb
+from rio_rgbify.geotiff import decode_geotiff, encode_geotiff, _window_shape, _windows
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+def test_window_shape():
+    # strips as tall as fit, in steps of both block heights
+    assert _window_shape(1000, 512, [(256, 256), (16, 512)], 512 * 600) == (512, 512)
+    assert _window_shape(100, 512, [(256, 256), (16, 512)], 512 * 600) == (100, 512)
+
+    # too wide for one strip: the narrowest strip is cut into aligned columns
+    assert _window_shape(1000, 4096, [(256, 256), (128, 128)], 256 * 1000) == (256, 768)
+    assert _window_shape(1000, 4096, [(256, 256), (128, 128)], 1) == (256, 256)
+
+    # strips of the output cannot be cut
+    assert _window_shape(1000, 4096, [(256, 256), (1, 4096)], 1) == (256, 4096)
+
+
+def test_windows():
+    windows = list(_windows(5, 7, 2, 3))
+
+    assert len(windows) == 9
+    assert sum(w.width * w.height for w in windows) == 35
+    assert windows[-1].col_off == 6 and windows[-1].width == 1 and windows[-1].height == 1
+
+
+@pytest.mark.parametrize('threads,memory_budget,options', [
+    (1, None, {}),
+    (3, None, {'tiled': False}),
+    (4, 1, {'tiled': True, 'blockxsize': 128, 'blockysize': 128}),
+])
+def test_encode_geotiff(tmpdir, threads, memory_budget, options):
+    outpath = str(tmpdir.join('rgb.tif'))
+
+    encode_geotiff(in_elev_src, outpath, base_val=-100, interval=0.01,
+                   options=options, threads=threads, memory_budget=memory_budget)
+
+    with rasterio.open(in_elev_src) as src:
+        expected = data_to_rgb(src.read(1), -100, 0.01)
+        bounds = src.bounds
+
+    with rasterio.open(outpath) as created:
+        assert created.count == 3
+        assert created.dtypes == ('uint8', 'uint8', 'uint8')
+        assert created.bounds == bounds
+        assert np.array_equal(created.read(), expected)
+
+
+def test_encode_geotiff_fails(tmpdir):
+    outpath = str(tmpdir.join('rgb.tif'))
+
+    # values out of range of the encoding
+    with pytest.raises(ValueError):
+        encode_geotiff(in_elev_src, outpath, base_val=-100, interval=0.00000001, threads=2)
+
+    for kwargs in ({'threads': 0}, {'memory_budget': 0}, {'bidx': 2}):
+        with pytest.raises(ValueError):
+            encode_geotiff(in_elev_src, outpath, **kwargs)
+
+
+def test_decode_geotiff(tmpdir):
+    rgb = str(tmpdir.join('rgb.tif'))
+    outpath = str(tmpdir.join('decoded.tif'))
+
+    encode_geotiff(in_elev_src, rgb, base_val=-100, interval=0.01, threads=2)
+    decode_geotiff(rgb, outpath, base_val=-100, interval=0.01, threads=3, memory_budget=1)
+
+    with rasterio.open(in_elev_src) as src:
+        expected = src.read(1)
+        bounds = src.bounds
+
+    with rasterio.open(outpath) as decoded:
+        assert decoded.count == 1
+        assert decoded.dtypes == ('float32',)
+        assert decoded.bounds == bounds
+        assert decoded.block_shapes == [(256, 256)]
+        assert decoded.compression.value == 'DEFLATE'
+        assert np.abs(decoded.read(1) - expected).max() <= 0.005 + 1e-3
+
+    with pytest.raises(ValueError):
+        decode_geotiff(in_elev_src, outpath)
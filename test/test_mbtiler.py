@@ -1,3 +1,13 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
 import mercantile
 import types
 
@@ -6,8 +16,23 @@ import hypothesis.strategies as st
 import pytest
 
 import numpy as np
+from PIL import Image
+import rasterio
 from rasterio import Affine
-from rio_rgbify.mbtiler import (_encode_as_webp, _encode_as_png, _make_tiles, _tile_range, RGBTiler)
+from rio_rgbify import mbtiler
+from rio_rgbify.mbtiler import (
+    _encode_as_webp, _encode_as_png, _make_tiles, _make_metatiles, _tile_range,
+    _overview_levels, _build_overviews, _zoom_ranges, _count_jobs,
+    _chunksize, _throttle, _stop_throttle, _curve_range, _gdal_options, _main_worker,
+    _close_worker, _metatile_worker, _schedule, _error_budgets, _shard_bounds, _shard_jobs,
+    _footprint_jobs, RGBTiler)
+from rio_rgbify.writers import _TileSet, MBTilesWriter, _tile_id
+from rio_rgbify.sources import SourceIndex
+
+from tilesets import read_tiles, decoded_tiles
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
 
 
 @given(
@@ -124,3 +149,944 @@ def test_RGBtiler_format_fails():
         with RGBTiler(test_in, test_out, test_minz, test_maxz,
             format='poo') as rtiler:
             pass
+
+
+def test_RGBtiler_durability_fails():
+    with pytest.raises(ValueError):
+        RGBTiler('i/do/not/exist.tif', 'nor/do/i.mbtiles', 0, 1, durability='yolo')
+
+    with pytest.raises(ValueError):
+        RGBTiler('i/do/not/exist.tif', 'nor/do/i.mbtiles', 0, 1, batch_size=0)
+
+
+def test_RGBtiler_batched_writes(tmpdir):
+    out_mbtiles = str(tmpdir.join('batched.mbtiles'))
+
+    with RGBTiler(in_elev_src, out_mbtiles, 10, 12, batch_size=3, durability='off') as tiler:
+        tiler.run(1)
+
+    conn = sqlite3.connect(out_mbtiles)
+    count, = conn.execute('SELECT count(*) FROM tiles;').fetchone()
+    indexes = [r[1] for r in conn.execute("PRAGMA index_list('tiles');")]
+    conn.close()
+
+    with rasterio.open(in_elev_src) as src:
+        expected = list(_make_tiles(list(src.bounds), src.crs, 10, 12))
+
+    assert count == len(expected)
+    assert 'tile_index' in indexes
+
+
+def test_RGBtiler_dedupe(tmpdir):
+    flat_src = str(tmpdir.join('flat.tif'))
+
+    with rasterio.open(in_elev_src) as src:
+        profile = src.profile
+        profile_bounds = src.bounds
+
+    with rasterio.open(flat_src, 'w', **profile) as dst:
+        dst.write(np.full((1, 512, 512), 100, dtype=profile['dtype']))
+
+    out_mbtiles = str(tmpdir.join('dedupe.mbtiles'))
+
+    with RGBTiler(flat_src, out_mbtiles, 16, 16, dedupe=True) as tiler:
+        tiler.run(1)
+
+    conn = sqlite3.connect(out_mbtiles)
+    images, = conn.execute('SELECT count(*) FROM images;').fetchone()
+    mapped, = conn.execute('SELECT count(*) FROM map;').fetchone()
+    tiles, = conn.execute('SELECT count(*) FROM tiles;').fetchone()
+    conn.close()
+
+    expected = list(_make_tiles(list(profile_bounds), profile['crs'], 16, 16))
+
+    assert mapped == tiles == len(expected)
+    assert images < mapped
+
+
+def test_RGBtiler_dedupe_matches_flat(tmpdir):
+    flat_mbtiles = str(tmpdir.join('flat.mbtiles'))
+    dedupe_mbtiles = str(tmpdir.join('dedupe.mbtiles'))
+
+    with RGBTiler(in_elev_src, flat_mbtiles, 10, 12) as tiler:
+        tiler.run(1)
+
+    with RGBTiler(in_elev_src, dedupe_mbtiles, 10, 12, dedupe=True) as tiler:
+        tiler.run(2)
+
+    query = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3;'
+
+    flat = sqlite3.connect(flat_mbtiles).execute(query).fetchall()
+    deduped = sqlite3.connect(dedupe_mbtiles).execute(query).fetchall()
+
+    assert flat == deduped
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_RGBtiler_pyramid(tmpdir, processes):
+    warped_mbtiles = str(tmpdir.join('warped.mbtiles'))
+    pyramid_mbtiles = str(tmpdir.join('pyramid.mbtiles'))
+
+    with RGBTiler(in_elev_src, warped_mbtiles, 13, 15, interval=0.1) as tiler:
+        tiler.run(processes)
+
+    with RGBTiler(in_elev_src, pyramid_mbtiles, 13, 15, interval=0.1,
+                  pyramid=True, dedupe=True) as tiler:
+        tiler.run(processes)
+
+    warped = decoded_tiles(warped_mbtiles, 0, 0.1)
+    pyramid = decoded_tiles(pyramid_mbtiles, 0, 0.1)
+
+    assert sorted(warped) == sorted(pyramid)
+
+    for key in warped:
+        if key[0] == 15:
+            assert np.array_equal(warped[key], pyramid[key])
+        else:
+            # lower zooms are resampled from quantized children
+            diff = np.abs(warped[key] - pyramid[key])
+            assert np.median(diff) < 1
+
+
+def test_RGBtiler_resampling_fails():
+    with pytest.raises(ValueError):
+        RGBTiler('i/do/not/exist.tif', 'nor/do/i.mbtiles', 0, 1, resampling='poo')
+
+
+@given(
+    st.integers(min_value=0, max_value=(2 ** 10 - 1)),
+    st.integers(min_value=0, max_value=(2 ** 10 - 1)),
+    st.integers(min_value=1, max_value=5))
+def test_make_metatiles(x, y, metatile_size):
+    test_bounds = mercantile.bounds(x, y, 10)
+
+    test_bbox = list(mercantile.xy(test_bounds.west, test_bounds.south)) + list(mercantile.xy(test_bounds.east, test_bounds.north))
+
+    metatiles = list(_make_metatiles(test_bbox, 'epsg:3857', 10, 13, metatile_size))
+    tiles = [tuple(t) for metatile in metatiles for t in metatile]
+
+    assert sorted(tiles) == sorted(tuple(t) for t in _make_tiles(test_bbox, 'epsg:3857', 10, 13))
+
+    for metatile in metatiles:
+        assert len(set((tx // metatile_size, ty // metatile_size, tz) for tx, ty, tz in metatile)) == 1
+
+
+def test_RGBtiler_metatiles(tmpdir):
+    tile_mbtiles = str(tmpdir.join('tiles.mbtiles'))
+    metatile_mbtiles = str(tmpdir.join('metatiles.mbtiles'))
+
+    with RGBTiler(in_elev_src, tile_mbtiles, 14, 15, interval=0.1) as tiler:
+        tiler.run(1)
+
+    with RGBTiler(in_elev_src, metatile_mbtiles, 14, 15, interval=0.1, metatile_size=4) as tiler:
+        tiler.run(2)
+
+    tiles = decoded_tiles(tile_mbtiles, 0, 0.1)
+    metatiles = decoded_tiles(metatile_mbtiles, 0, 0.1)
+
+    assert sorted(tiles) == sorted(metatiles)
+
+    for key in tiles:
+        assert np.allclose(tiles[key], metatiles[key], atol=0.2)
+
+
+def test_RGBtiler_metatile_size_fails():
+    with pytest.raises(ValueError):
+        RGBTiler('i/do/not/exist.tif', 'nor/do/i.mbtiles', 0, 1, metatile_size=0)
+
+
+@pytest.mark.parametrize('metatile_size', [1, 4])
+def test_RGBtiler_nodata(tmpdir, metatile_size):
+    sparse_src = str(tmpdir.join('sparse.tif'))
+
+    with rasterio.open(in_elev_src) as src:
+        profile = src.profile
+        profile.update(nodata=-9999)
+        data = src.read()
+        bounds = src.bounds
+
+    # western 3/4 of the source is nodata
+    data[:, :, :384] = -9999
+
+    with rasterio.open(sparse_src, 'w', **profile) as dst:
+        dst.write(data)
+
+    out_mbtiles = str(tmpdir.join('sparse.mbtiles'))
+
+    with RGBTiler(sparse_src, out_mbtiles, 16, 16, nodata_fill=-100, base_val=-1000,
+                  metatile_size=metatile_size) as tiler:
+        tiler.run(1)
+
+    tiles = decoded_tiles(out_mbtiles, -1000, 1)
+    bbox_tiles = list(_make_tiles(list(bounds), profile['crs'], 16, 16))
+
+    assert 0 < len(tiles) < len(bbox_tiles)
+
+    # no nodata values leak into the encoded tiles
+    for data in tiles.values():
+        assert data.min() >= -100
+        assert (data == -100).any()
+
+
+def test_overview_levels(tmpdir):
+    ovr_src = str(tmpdir.join('overviews.tif'))
+
+    with rasterio.open(in_elev_src) as src:
+        profile = src.profile
+        data = src.read()
+
+    with rasterio.open(ovr_src, 'w', **profile) as dst:
+        dst.write(data)
+        dst.build_overviews([2, 4], rasterio.enums.Resampling.average)
+
+    levels = _overview_levels(ovr_src)
+
+    assert [kwargs for _, _, kwargs in levels] == [{}, {'overview_level': 0}, {'overview_level': 1}]
+    assert np.allclose(levels[1][0], 2 * levels[0][0])
+    assert np.allclose(levels[2][0], 4 * levels[0][0])
+
+    built = _build_overviews(in_elev_src, str(tmpdir), 4.5 * levels[0][0])
+
+    assert len(built) == 3
+    assert np.allclose([res for res, _, _ in built], [res for res, _, _ in levels])
+
+    with rasterio.open(built[1][1]) as ovr:
+        assert ovr.shape == (256, 256)
+        assert np.allclose(ovr.read(1), data[0].reshape(256, 2, 256, 2).mean(axis=(1, 3)))
+
+
+@pytest.mark.parametrize('overviews', ['auto', 'build'])
+def test_RGBtiler_overviews(tmpdir, overviews):
+    ovr_src = str(tmpdir.join('overviews.tif'))
+
+    with rasterio.open(in_elev_src) as src:
+        profile = src.profile
+        data = src.read()
+
+    with rasterio.open(ovr_src, 'w', **profile) as dst:
+        dst.write(data)
+        if overviews == 'auto':
+            dst.build_overviews([2, 4], rasterio.enums.Resampling.average)
+
+    full_mbtiles = str(tmpdir.join('full.mbtiles'))
+    ovr_mbtiles = str(tmpdir.join('ovr.mbtiles'))
+
+    with RGBTiler(ovr_src, full_mbtiles, 11, 13, interval=0.1, overviews='none') as tiler:
+        tiler.run(1)
+
+    with RGBTiler(ovr_src, ovr_mbtiles, 11, 13, interval=0.1, overviews=overviews) as tiler:
+        tiler.run(2)
+
+    full = decoded_tiles(full_mbtiles, 0, 0.1)
+    ovr = decoded_tiles(ovr_mbtiles, 0, 0.1)
+
+    assert sorted(full) == sorted(ovr)
+
+    for key in full:
+        # z13 tiles are finer than the first overview
+        if key[0] == 13:
+            assert np.array_equal(full[key], ovr[key])
+        else:
+            assert np.median(np.abs(full[key] - ovr[key])) < 1
+
+    assert not [f for f in os.listdir(tempfile.gettempdir()) if f.startswith('rgbify-overviews-')]
+
+
+def test_RGBtiler_overviews_fails():
+    with pytest.raises(ValueError):
+        RGBTiler('i/do/not/exist.tif', 'nor/do/i.mbtiles', 0, 1, overviews='poo')
+
+
+def test_tile_set():
+    ranges = [(z, [10 * z, 20 * z, z], [10 * z + 5, 20 * z + 3, z]) for z in range(3)]
+    tiles = _TileSet(ranges)
+
+    tiles.update([0, 5, 6], [0, 3, 3], 0)
+    tiles.update([11, 15], [21, 23], 1)
+
+    assert [0, 0, 0] in tiles
+    assert [5, 3, 0] in tiles
+    assert [6, 3, 0] not in tiles
+    assert [1, 0, 0] not in tiles
+    assert [15, 23, 1] in tiles
+    assert [15, 23, 2] not in tiles
+    assert [15, 23, 3] not in tiles
+    assert len(tiles) == 4
+
+
+@pytest.mark.parametrize('pyramid', [False, True])
+def test_RGBtiler_resume(tmpdir, pyramid):
+    full_mbtiles = str(tmpdir.join('full.mbtiles'))
+    resumed_mbtiles = str(tmpdir.join('resumed.mbtiles'))
+
+    # resuming without an existing output starts from scratch
+    for path in (full_mbtiles, resumed_mbtiles):
+        with RGBTiler(in_elev_src, path, 13, 15, interval=0.1, pyramid=pyramid,
+                      resume=True) as tiler:
+            tiler.run(1)
+
+    # drop some tiles, as if the run had been killed
+    conn = sqlite3.connect(resumed_mbtiles)
+    conn.execute('DELETE FROM tiles WHERE zoom_level = 15 AND tile_column = 5240;')
+    conn.execute('DELETE FROM tiles WHERE zoom_level = 13;')
+    conn.commit()
+    conn.close()
+
+    with RGBTiler(in_elev_src, resumed_mbtiles, 13, 15, interval=0.1, pyramid=pyramid,
+                  resume=True) as tiler:
+        tiler.run(2)
+
+    query = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3;'
+
+    full = sqlite3.connect(full_mbtiles).execute(query).fetchall()
+    resumed = sqlite3.connect(resumed_mbtiles).execute(query).fetchall()
+
+    assert full == resumed
+
+    with pytest.raises(ValueError):
+        with RGBTiler(in_elev_src, resumed_mbtiles, 13, 15, interval=1, pyramid=pyramid,
+                      resume=True) as tiler:
+            tiler.run(1)
+
+
+def test_RGBtiler_stats(tmpdir):
+    out_mbtiles = str(tmpdir.join('stats.mbtiles'))
+    seen = []
+
+    with RGBTiler(in_elev_src, out_mbtiles, 13, 15, metatile_size=2, stats=True,
+                  callback=lambda tile, timings: seen.append(tile)) as tiler:
+        tiler.run(2)
+
+    summary = tiler.stats.to_dict()
+
+    assert summary['tiles'] == len(seen) == 15
+    assert sorted(summary['zooms']) == ['13', '14', '15']
+    assert summary['stages']['warp'] > 0
+    assert summary['stages']['encode'] > 0
+    assert summary['write']['tiles'] == 15
+    assert summary['peak_rss']['max'] > 0
+    assert len(summary['slowest']) == 10
+
+    with RGBTiler(in_elev_src, out_mbtiles, 13, 14) as tiler:
+        tiler.run(1)
+
+    assert tiler.stats is None
+
+
+@pytest.mark.parametrize('tile_size', [256, 1024])
+def test_RGBtiler_tile_size(tmpdir, tile_size):
+    out_mbtiles = str(tmpdir.join('elev.mbtiles'))
+
+    with RGBTiler(in_elev_src, out_mbtiles, 14, 15, tile_size=tile_size, pyramid=True,
+                  metatile_size=2) as tiler:
+        tiler.run(2)
+
+    tiles = decoded_tiles(out_mbtiles, 0, 1)
+
+    assert len(tiles) > 0
+    assert all(data.shape == (tile_size, tile_size) for data in tiles.values())
+
+
+def test_RGBtiler_tile_size_fails():
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, tile_size=500)
+
+
+def test_count_jobs_and_chunksize():
+    bbox = list(mercantile.xy_bounds(654, 1583, 12))
+
+    for metatile_size in (1, 3):
+        jobs = list(_make_metatiles(bbox, 'EPSG:3857', 12, 15, metatile_size))
+        ranges = _zoom_ranges(bbox, 'EPSG:3857', 12, 15)
+        assert _count_jobs(ranges, metatile_size) == len(jobs)
+
+    assert _chunksize(10, 4) == 1
+    assert _chunksize(640, 4) == 10
+    assert _chunksize(10 ** 6, 4) == 16
+
+
+def test_throttle():
+    semaphore = threading.BoundedSemaphore(2)
+    jobs = _throttle(iter([[1], [2], [3]]), semaphore)
+
+    assert next(jobs) == [1]
+    assert next(jobs) == [2]
+    assert not semaphore.acquire(False)
+
+    semaphore.release()
+    assert next(jobs) == [3]
+
+    # a stopped throttle wakes up and ends
+    semaphore = threading.BoundedSemaphore(1)
+    stopped = threading.Event()
+    jobs = _throttle(iter([[1], [2], [3]]), semaphore, stopped)
+
+    assert next(jobs) == [1]
+
+    _stop_throttle(semaphore, stopped)
+    assert list(jobs) == []
+
+
+def test_RGBtiler_backpressure(tmpdir):
+    default_mbtiles = str(tmpdir.join('default.mbtiles'))
+    throttled_mbtiles = str(tmpdir.join('throttled.mbtiles'))
+
+    with RGBTiler(in_elev_src, default_mbtiles, 13, 15, interval=0.1) as tiler:
+        tiler.run(2)
+
+    with RGBTiler(in_elev_src, throttled_mbtiles, 13, 15, interval=0.1, batch_size=1,
+                  max_in_flight=1, chunksize=2, pyramid=True) as tiler:
+        tiler.run(2)
+
+    assert sorted(read_tiles(default_mbtiles)) == sorted(read_tiles(throttled_mbtiles))
+
+    for kwargs in ({'max_in_flight': 0}, {'chunksize': 0}):
+        with pytest.raises(ValueError):
+            RGBTiler(in_elev_src, throttled_mbtiles, 13, 15, **kwargs)
+
+
+@pytest.mark.parametrize('executor', ['processes', 'threads'])
+def test_RGBtiler_worker_error_throttled(tmpdir, executor):
+    outpath = str(tmpdir.join('error.mbtiles'))
+
+    # workers fail to encode, while submission is throttled to one job
+    with pytest.raises(ValueError):
+        with RGBTiler(in_elev_src, outpath, 14, 17, interval=0.000001, max_in_flight=1,
+                      executor=executor) as tiler:
+            tiler.run(2)
+
+    # the pool is torn down, not left with its task feeder blocked
+    assert not tiler.pool._task_handler.is_alive()
+
+    for worker in tiler.pool._pool:
+        worker.join(10)
+        assert not worker.is_alive()
+
+
+def test_RGBtiler_writer_error(tmpdir, monkeypatch):
+    def fail(self, rows):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(MBTilesWriter, 'write', fail)
+
+    with pytest.raises(IOError):
+        with RGBTiler(in_elev_src, str(tmpdir.join('fail.mbtiles')), 13, 15,
+                      batch_size=1) as tiler:
+            tiler.run(1)
+
+
+@given(st.integers(min_value=0, max_value=7), st.lists(
+    st.floats(min_value=0, max_value=1), min_size=4, max_size=4))
+def test_curve_range(z, fractions):
+    n = 2 ** z
+    x0, x1 = sorted(int(f * (n - 1)) for f in fractions[:2])
+    y0, y1 = sorted(int(f * (n - 1)) for f in fractions[2:])
+
+    tiles = list(itertools.product(range(x0, x1 + 1), range(y0, y1 + 1)))
+
+    hilbert = list(_curve_range(x0, y0, x1, y1, z, True))
+    assert hilbert == sorted(tiles, key=lambda t: _tile_id(z, t[0], t[1]))
+
+    zorder = list(_curve_range(x0, y0, x1, y1, z, False))
+    assert sorted(zorder) == tiles
+    assert zorder[0] == (x0, y0)
+    assert zorder[-1] == (x1, y1)
+
+
+@pytest.mark.parametrize('ordering', ['hilbert', 'zorder'])
+def test_make_metatiles_ordering(ordering):
+    bbox = list(mercantile.xy_bounds(654, 1583, 12))
+
+    columns = list(_make_metatiles(bbox, 'EPSG:3857', 12, 15, 2))
+    ordered = list(_make_metatiles(bbox, 'EPSG:3857', 12, 15, 2, ordering))
+
+    assert sorted(ordered) == sorted(columns)
+    assert ordered != columns
+
+
+def test_RGBtiler_ordering_fails():
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, ordering='random')
+
+
+def test_gdal_options():
+    assert _gdal_options(4) == ({}, 0)
+    assert _gdal_options(4, gdal_cachemax=256, warp_mem_limit=64) == (
+        {'GDAL_CACHEMAX': 256 * 1024 * 1024}, 64)
+
+    # a budget is split across workers
+    assert _gdal_options(16, memory_budget=8192) == ({'GDAL_CACHEMAX': 256 * 1024 * 1024}, 128)
+    assert _gdal_options(2, memory_budget=8192) == ({'GDAL_CACHEMAX': 2048 * 1024 * 1024}, 1024)
+
+    # explicit settings override their share
+    assert _gdal_options(2, gdal_cachemax=100, memory_budget=8192) == (
+        {'GDAL_CACHEMAX': 100 * 1024 * 1024}, 1024)
+
+
+def test_main_worker_env():
+    with RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, gdal_cachemax=123) as tiler:
+        global_args = tiler.global_args
+
+    global_args['env'], global_args['warp_mem_limit'] = _gdal_options(1, 123, 32)
+    global_args['overviews'] = _overview_levels(in_elev_src)
+
+    _main_worker(in_elev_src, _metatile_worker, global_args)
+
+    try:
+        assert rasterio.env.getenv()['GDAL_CACHEMAX'] == 123 * 1024 * 1024
+        assert len(_metatile_worker([[5240, 12663, 15]])) == 1
+    finally:
+        _close_worker()
+
+    assert not rasterio.env.hasenv() or 'GDAL_CACHEMAX' not in rasterio.env.getenv()
+
+
+def test_RGBtiler_gdal_options(tmpdir):
+    default_mbtiles = str(tmpdir.join('default.mbtiles'))
+    tuned_mbtiles = str(tmpdir.join('tuned.mbtiles'))
+
+    with RGBTiler(in_elev_src, default_mbtiles, 13, 15, interval=0.1) as tiler:
+        tiler.run(2)
+
+    with RGBTiler(in_elev_src, tuned_mbtiles, 13, 15, interval=0.1, warp_threads=2,
+                  memory_budget=64) as tiler:
+        tiler.run(2)
+
+    assert read_tiles(default_mbtiles) == read_tiles(tuned_mbtiles)
+
+    for kwargs in ({'gdal_cachemax': 0}, {'warp_threads': 0}, {'memory_budget': -1}):
+        with pytest.raises(ValueError):
+            RGBTiler(in_elev_src, tuned_mbtiles, 13, 15, **kwargs)
+
+
+def test_RGBtiler_png_encoders(tmpdir):
+    tiles = {}
+
+    for png_encoder, png_filter in (('gdal', 'sub'), ('zlib', 'sub'), ('zlib', 'adaptive')):
+        out_mbtiles = str(tmpdir.join('{0}-{1}.mbtiles'.format(png_encoder, png_filter)))
+
+        with RGBTiler(in_elev_src, out_mbtiles, 13, 14, interval=0.1, png_encoder=png_encoder,
+                      png_level=1, png_filter=png_filter) as tiler:
+            tiler.run(1)
+
+        conn = sqlite3.connect(out_mbtiles)
+        tiles[png_encoder, png_filter] = dict(
+            ((z, x, y), np.array(Image.open(BytesIO(bytes(data)))))
+            for z, x, y, data in conn.execute('SELECT * FROM tiles;'))
+        conn.close()
+
+    expected = tiles.pop(('gdal', 'sub'))
+    assert len(expected) > 0
+
+    for decoded in tiles.values():
+        assert sorted(decoded) == sorted(expected)
+        for tile in expected:
+            assert np.array_equal(decoded[tile], expected[tile])
+
+
+def test_RGBtiler_png_encoder_default():
+    # existing outputs keep their bytes: GDAL encodes unless zlib is asked for
+    tiler = RGBTiler(in_elev_src, 'out.mbtiles', 13, 15)
+    assert tiler.global_args['kwargs']['driver'] == 'PNG'
+
+
+def test_RGBtiler_png_encoder_fails():
+    for kwargs in ({'png_encoder': 'libpng'}, {'png_filter': 'best'}, {'png_level': 0}):
+        with pytest.raises(ValueError):
+            RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, **kwargs)
+
+
+def test_schedule():
+    assert _schedule(0.1, 2, 4) == {2: 0.1, 3: 0.1, 4: 0.1}
+    assert _schedule({'3': 4, 5: 0}, 1, 6) == {1: 4, 2: 4, 3: 4, 4: 4, 5: 0, 6: 0}
+    assert _error_budgets(0.5, 13, 15) == {13: 2, 14: 1, 15: 0.5}
+    assert _error_budgets({14: 1}, 13, 15) == {13: 1, 14: 1, 15: 1}
+
+    with pytest.raises(ValueError):
+        _schedule({'z10': 1}, 1, 6)
+
+
+def test_RGBtiler_precision_schedule(tmpdir):
+    out_mbtiles = str(tmpdir.join('schedule.mbtiles'))
+
+    with RGBTiler(in_elev_src, out_mbtiles, 13, 15, base_val=-10000, pyramid=True,
+                  interval={13: 1, 14: 0.1}, round_digits={'13': 4, '15': 0}) as tiler:
+        tiler.run(2)
+
+    params = json.loads(sqlite3.connect(out_mbtiles).execute(
+        "SELECT value FROM metadata WHERE name = 'rgbify';").fetchone()[0])
+
+    assert params['interval'] == {'13': 1, '14': 0.1}
+    assert params['round_digits'] == {'13': 4, '15': 0}
+
+    tiles = decoded_tiles(out_mbtiles, -10000, {13: 1, 14: 0.1, 15: 0.1})
+    means = dict((z, np.mean([data.mean() for (tz, _, _), data in tiles.items() if tz == z]))
+                 for z in (13, 14, 15))
+
+    # lower zooms are built from children decoded with their own interval
+    assert abs(means[13] - means[15]) < 50
+    assert abs(means[14] - means[15]) < 50
+
+    for (z, _, _), data in tiles.items():
+        if z <= 14:
+            # 4 rounded away digits of 1 m, or of 0.1 m
+            step = 16 * (1 if z == 13 else 0.1)
+            assert np.allclose((data + 10000) / step, np.rint((data + 10000) / step))
+
+
+def test_RGBtiler_max_error(tmpdir):
+    out_mbtiles = str(tmpdir.join('auto.mbtiles'))
+    full_mbtiles = str(tmpdir.join('full.mbtiles'))
+
+    with RGBTiler(in_elev_src, full_mbtiles, 13, 15, base_val=-10000, interval=0.1) as tiler:
+        tiler.run(1)
+
+    with RGBTiler(in_elev_src, out_mbtiles, 13, 15, base_val=-10000, interval=0.1,
+                  max_error=0.5, resume=True) as tiler:
+        tiler.run(2)
+
+    precision = tiler.precision
+
+    assert sorted(precision) == ['13', '14', '15']
+    assert precision['13']['round_digits'][0] > precision['15']['round_digits'][1]
+
+    for z, budget in ((13, 2), (14, 1), (15, 0.5)):
+        assert 0 < precision[str(z)]['max_error'] <= budget
+        assert precision[str(z)]['rmse'] <= precision[str(z)]['max_error']
+
+    # the measured error is that of the tiles against unrounded tiles
+    intervals = {13: 0.1, 14: 0.1, 15: 0.1}
+    full = decoded_tiles(full_mbtiles, -10000, intervals)
+    auto = decoded_tiles(out_mbtiles, -10000, intervals)
+
+    for tile, data in auto.items():
+        assert np.abs(data - full[tile]).max() <= precision[str(tile[0])]['max_error'] + 0.05 + 1e-6
+
+    # errors of resumed runs add to those recorded
+    conn = sqlite3.connect(out_mbtiles)
+    recorded = json.loads(conn.execute(
+        "SELECT value FROM metadata WHERE name = 'rgbify_precision';").fetchone()[0])
+    assert recorded == precision
+
+    conn.execute('DELETE FROM tiles WHERE zoom_level = 15;')
+    conn.commit()
+    conn.close()
+
+    with RGBTiler(in_elev_src, out_mbtiles, 13, 15, base_val=-10000, interval=0.1,
+                  max_error=0.5, resume=True) as tiler:
+        tiler.run(1)
+
+    assert tiler.precision['15']['pixels'] == 2 * precision['15']['pixels']
+    assert tiler.precision['13'] == precision['13']
+
+
+def test_RGBtiler_precision_fails():
+    for kwargs in ({'interval': {13: 0}}, {'max_error': -1}, {'round_digits': {'a': 1}}):
+        with pytest.raises(ValueError):
+            RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, **kwargs)
+
+
+@pytest.mark.parametrize('metatile_size', [1, 2])
+def test_shard_jobs(metatile_size):
+    bbox = [-122.6, 37.6, -122.3, 37.9]
+    ranges = list(_zoom_ranges(bbox, 'EPSG:4326', 8, 13))
+    jobs = list(_make_metatiles(bbox, 'EPSG:4326', 8, 13, metatile_size, 'hilbert'))
+
+    sharded = []
+    for index in range(1, 6):
+        bounds = _shard_bounds(ranges, metatile_size, (index, 5))
+        shard = list(_shard_jobs(iter(jobs), bounds))
+
+        assert len(shard) == sum(stop - start for start, stop in bounds.values())
+        sharded.append(shard)
+
+    # shards partition the jobs of each zoom into balanced runs
+    assert sorted(sum(sharded, [])) == sorted(jobs)
+
+    for z, _, _ in ranges:
+        sizes = [len([job for job in shard if job[0][2] == z]) for shard in sharded]
+        assert max(sizes) - min(sizes) <= 1
+
+
+def test_RGBtiler_shard_fails():
+    for kwargs in ({'shard': (0, 2)}, {'shard': (3, 2)}, {'shard': (1, 2), 'pyramid': True}):
+        with pytest.raises(ValueError):
+            RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, **kwargs)
+
+
+def _split_halves(tmpdir):
+    """
+    Write the left and right halves of elev.tif, overlapping by 8 pixels
+    """
+    paths = []
+
+    with rasterio.open(in_elev_src) as src:
+        half = src.width // 2
+
+        for i, (col, width) in enumerate([(0, half + 8), (half - 8, src.width - half + 8)]):
+            window = rasterio.windows.Window(col, 0, width, src.height)
+            profile = src.profile.copy()
+            profile.update(width=width, transform=src.window_transform(window))
+
+            path = str(tmpdir.join('half-{0}.tif'.format(i)))
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(src.read(1, window=window), 1)
+
+            paths.append(path)
+
+    return paths
+
+
+def test_RGBtiler_mosaic(tmpdir):
+    paths = _split_halves(tmpdir)
+
+    single = str(tmpdir.join('single.mbtiles'))
+    mosaic = str(tmpdir.join('mosaic.mbtiles'))
+
+    for inpath, outpath in ((in_elev_src, single), (paths, mosaic)):
+        with RGBTiler(inpath, outpath, 11, 13, interval=0.1, base_val=-10000) as tiler:
+            tiler.run(1)
+
+    intervals = collections.defaultdict(lambda: 0.1)
+    expected = decoded_tiles(single, -10000, intervals)
+    tiles = decoded_tiles(mosaic, -10000, intervals)
+
+    assert set(tiles) == set(expected)
+
+    # the halves are resampled separately up to their seam
+    for tile, data in tiles.items():
+        assert np.median(np.abs(data - expected[tile])) < 0.5
+
+
+def test_footprint_jobs(tmpdir):
+    mosaic = SourceIndex(_split_halves(tmpdir)[:1])
+    west, south, east, north = mosaic.bounds
+
+    inside = list(mercantile.tile(*mercantile.lnglat(west + 10, south + 10), zoom=13))
+    outside = list(mercantile.tile(*mercantile.lnglat(east + 5000, south + 10), zoom=13))
+
+    assert list(_footprint_jobs(iter([[inside, outside], [outside]]), mosaic)) == [[inside]]
+
+
+def test_RGBtiler_mosaic_shards(tmpdir):
+    # opposite corners of elev.tif, leaving most of their bounding box empty
+    paths = []
+
+    with rasterio.open(in_elev_src) as src:
+        for i, offset in enumerate([0, src.width - 64]):
+            window = rasterio.windows.Window(offset, offset, 64, 64)
+            profile = src.profile.copy()
+            profile.update(width=64, height=64, transform=src.window_transform(window))
+
+            path = str(tmpdir.join('corner-{0}.tif'.format(i)))
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(src.read(1, window=window), 1)
+
+            paths.append(path)
+
+    whole = str(tmpdir.join('whole.mbtiles'))
+
+    with RGBTiler(paths, whole, 17, 18, interval=0.1) as tiler:
+        tiler.run(1)
+
+    sharded = []
+    for index in range(1, 4):
+        outpath = str(tmpdir.join('shard-{0}.mbtiles'.format(index)))
+
+        with RGBTiler(paths, outpath, 17, 18, interval=0.1, shard=(index, 3)) as tiler:
+            tiler.run(1)
+
+        sharded.append(read_tiles(outpath))
+
+    assert sum(len(shard) for shard in sharded) == len(read_tiles(whole))
+    assert dict(kv for shard in sharded for kv in shard.items()) == read_tiles(whole)
+
+    # shards split the covered tiles, not the bounding box
+    for z in (17, 18):
+        sizes = [len([key for key in shard if key[0] == z]) for shard in sharded]
+        assert max(sizes) - min(sizes) <= 1
+
+
+def test_RGBtiler_mosaic_fails(tmpdir):
+    with pytest.raises(ValueError):
+        RGBTiler([], 'out.mbtiles', 13, 15)
+
+    with pytest.raises(ValueError):
+        RGBTiler(_split_halves(tmpdir), 'out.mbtiles', 13, 15, overviews='build')
+
+
+@pytest.mark.parametrize('executor,kwargs', [
+    ('threads', {}),
+    ('threads', {'pyramid': True, 'png_encoder': 'zlib'}),
+    ('executor', {'dedupe': True}),
+])
+def test_RGBtiler_executors(tmpdir, executor, kwargs):
+    expected = str(tmpdir.join('processes.mbtiles'))
+    threaded = str(tmpdir.join('threaded.mbtiles'))
+
+    with RGBTiler(in_elev_src, expected, 11, 14, interval=0.1, **kwargs) as tiler:
+        tiler.run(1)
+
+    pool = ThreadPoolExecutor(3) if executor == 'executor' else None
+
+    with RGBTiler(in_elev_src, threaded, 11, 14, interval=0.1,
+                  executor=pool or executor, **kwargs) as tiler:
+        tiler.run(3)
+
+    if pool is not None:
+        pool.shutdown()
+
+    if kwargs.get('dedupe'):
+        with sqlite3.connect(threaded) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM map;').fetchone()[0] == len(read_tiles(expected))
+    else:
+        assert read_tiles(threaded) == read_tiles(expected)
+
+
+def test_RGBtiler_threads_close(tmpdir, monkeypatch):
+    opened, closed = {}, set()
+    main_worker, close_worker = mbtiler._main_worker, mbtiler._close_worker
+
+    def _opening_worker(*args):
+        main_worker(*args)
+        opened[threading.current_thread().name] = mbtiler._worker.src
+
+    def _closing_worker():
+        if mbtiler._worker.gdal_env is not None:
+            closed.add(threading.current_thread().name)
+        close_worker()
+
+    monkeypatch.setattr(mbtiler, '_main_worker', _opening_worker)
+    monkeypatch.setattr(mbtiler, '_close_worker', _closing_worker)
+
+    with RGBTiler(in_elev_src, str(tmpdir.join('threaded.mbtiles')), 11, 13,
+                  interval=0.1, executor='threads') as tiler:
+        tiler.run(3)
+
+    # each worker thread closes its own datasets and leaves its GDAL environment
+    assert len(opened) == 3
+    assert all(src.closed for src in opened.values())
+    assert set(opened) <= closed
+
+
+def test_RGBtiler_executor_fails(tmpdir):
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, executor='fibers')
+
+    # worker errors are raised from the run
+    pool = ThreadPoolExecutor(2)
+    outpath = str(tmpdir.join('bad.mbtiles'))
+
+    with pytest.raises(ValueError):
+        with RGBTiler(in_elev_src, outpath, 13, 15, interval=0.00000001,
+                      executor=pool) as tiler:
+            tiler.run(2)
+
+    pool.shutdown()
+
+
+def _changed_source(path):
+    """
+    Write elev.tif raised by 100 in a block, and with nodata east of
+    column 300; return the EPSG:4326 extents of both changes
+    """
+    with rasterio.open(in_elev_src) as src:
+        profile = src.profile.copy()
+        profile.update(nodata=-9999)
+        data = src.read(1)
+
+        windows = [rasterio.windows.Window(100, 100, 40, 40),
+                   rasterio.windows.Window(300, 0, src.width - 300, src.height)]
+        extents = [
+            list(rasterio.warp.transform_bounds(
+                src.crs, 'EPSG:4326', *src.window_bounds(window)))
+            for window in windows
+        ]
+
+    data[100:140, 100:140] += 100
+    data[:, 300:] = -9999
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+    return extents
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'pyramid': True, 'dedupe': True, 'metatile_size': 2}])
+def test_RGBtiler_update(tmpdir, kwargs):
+    changed_src = str(tmpdir.join('changed.tif'))
+    extents = _changed_source(changed_src)
+
+    original = str(tmpdir.join('original.mbtiles'))
+    expected = str(tmpdir.join('expected.mbtiles'))
+    updated = str(tmpdir.join('updated.mbtiles'))
+
+    for inpath, outpath in ((in_elev_src, original), (in_elev_src, updated),
+                            (changed_src, expected)):
+        with RGBTiler(inpath, outpath, 13, 16, interval=0.1, base_val=-10000,
+                      **kwargs) as tiler:
+            tiler.run(1)
+
+    jobs = []
+
+    with RGBTiler(changed_src, updated, 13, 16, interval=0.1, base_val=-10000, update=extents,
+                  callback=lambda tile, _: jobs.append(tile), **kwargs) as tiler:
+        tiler.run(2)
+
+    assert read_tiles(updated) == read_tiles(expected)
+
+    # only tiles near the changes are made again, and the changed ones reported
+    before = dict(((x, y, z), data) for (z, x, y), data in read_tiles(original).items())
+    after = dict(((x, y, z), data) for (z, x, y), data in read_tiles(expected).items())
+    changed = sorted(
+        (tile for tile in set(before) | set(after) if before.get(tile) != after.get(tile)),
+        key=lambda tile: (tile[2], tile[0], tile[1]))
+
+    assert tiler.changed == changed
+    assert any(tile not in after for tile in changed)
+    assert len(jobs) < len(after)
+
+    if kwargs.get('dedupe'):
+        with sqlite3.connect(updated) as conn:
+            assert conn.execute(
+                'SELECT COUNT(*) FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);'
+            ).fetchone()[0] == 0
+
+
+def test_RGBtiler_update_fails(tmpdir):
+    extents = [[-122.44, 37.78, -122.43, 37.79]]
+
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, update=[[-122.43, 37.78, -122.44, 37.79]])
+
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.pmtiles', 13, 15, update=extents)
+
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, update=extents, resume=True)
+
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, update=extents, shard=(1, 2))
+
+    with pytest.raises(ValueError):
+        with RGBTiler(in_elev_src, str(tmpdir.join('missing.mbtiles')), 13, 15,
+                      update=extents) as tiler:
+            tiler.run(1)
+
+    # an update is refused with other parameters, and says so
+    outpath = str(tmpdir.join('update.mbtiles'))
+
+    with RGBTiler(in_elev_src, outpath, 13, 13, interval=0.1) as tiler:
+        tiler.run(1)
+
+    with pytest.raises(ValueError) as e:
+        with RGBTiler(in_elev_src, outpath, 13, 13, interval=1, update=extents) as tiler:
+            tiler.run(1)
+
+    assert str(e.value).startswith('Cannot update {0}: its tiles were made'.format(outpath))
+
+    with pytest.raises(ValueError) as e:
+        with RGBTiler(in_elev_src, outpath, 13, 13, interval=1, resume=True) as tiler:
+            tiler.run(1)
+
+    assert str(e.value).startswith('Cannot resume {0}'.format(outpath))
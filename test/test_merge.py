@@ -0,0 +1,119 @@
+import os
+import sqlite3
+
+import pytest
+
+from rio_rgbify.mbtiler import RGBTiler
+from rio_rgbify.merge import merge_mbtiles
+from rio_rgbify.writers import _read_params
+
+from tilesets import read_tiles
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+def _make_shards(tmpdir, count, **kwargs):
+    paths = []
+
+    for index in range(1, count + 1):
+        path = str(tmpdir.join('shard-{0}.mbtiles'.format(index)))
+
+        with RGBTiler(in_elev_src, path, 13, 15, interval=0.1, shard=(index, count),
+                      **kwargs) as tiler:
+            tiler.run(1)
+
+        paths.append(path)
+
+    return paths
+
+
+@pytest.mark.parametrize('dedupe', [False, True])
+def test_merge_mbtiles(tmpdir, dedupe):
+    full_mbtiles = str(tmpdir.join('full.mbtiles'))
+    merged_mbtiles = str(tmpdir.join('merged.mbtiles'))
+
+    with RGBTiler(in_elev_src, full_mbtiles, 13, 15, interval=0.1, dedupe=dedupe,
+                  max_error=0.5) as tiler:
+        tiler.run(1)
+
+    shards = _make_shards(tmpdir, 3, dedupe=dedupe, max_error=0.5)
+
+    # every shard has tiles of the highest zoom
+    assert all(max(z for z, _, _ in read_tiles(path)) == 15 for path in shards)
+
+    merge_mbtiles(shards[::-1], merged_mbtiles)
+
+    assert read_tiles(merged_mbtiles) == read_tiles(full_mbtiles)
+
+    conn = sqlite3.connect(merged_mbtiles)
+    assert _read_params(conn.cursor()) == _read_params(sqlite3.connect(full_mbtiles).cursor())
+
+    if dedupe:
+        images = conn.execute('SELECT COUNT(*) FROM images;').fetchone()[0]
+        assert images == len(set(read_tiles(full_mbtiles).values()))
+
+    precision = conn.execute(
+        "SELECT value FROM metadata WHERE name = 'rgbify_precision';").fetchone()
+    assert precision is not None
+
+
+def test_merge_pmtiles(tmpdir):
+    shards = _make_shards(tmpdir, 2)
+    out_pmtiles = str(tmpdir.join('merged.pmtiles'))
+
+    merge_mbtiles(shards, out_pmtiles)
+
+    with open(out_pmtiles, 'rb') as f:
+        assert f.read(7) == b'PMTiles'
+
+    assert not os.path.exists(out_pmtiles + '.staging')
+
+
+def test_merge_fails(tmpdir):
+    shards = _make_shards(tmpdir, 3)
+    out_mbtiles = str(tmpdir.join('merged.mbtiles'))
+
+    # missing and repeated shards
+    for paths in (shards[:2], shards + shards[:1], []):
+        with pytest.raises(ValueError):
+            merge_mbtiles(paths, out_mbtiles)
+
+    # shards of another run
+    other = str(tmpdir.join('other.mbtiles'))
+    with RGBTiler(in_elev_src, other, 13, 15, interval=1, shard=(3, 3)) as tiler:
+        tiler.run(1)
+
+    with pytest.raises(ValueError):
+        merge_mbtiles(shards[:2] + [other], out_mbtiles)
+
+    # shards that split the run differently
+    for kwargs in ({'ordering': 'columns'}, {'max_z': 14}, {'metatile_size': 2}):
+        other = str(tmpdir.join('split.mbtiles'))
+        options = dict({'max_z': 15}, **kwargs)
+        max_z = options.pop('max_z')
+
+        with RGBTiler(in_elev_src, other, 13, max_z, interval=0.1, shard=(3, 3),
+                      **options) as tiler:
+            tiler.run(1)
+
+        with pytest.raises(ValueError) as e:
+            merge_mbtiles(shards[:2] + [other], out_mbtiles)
+
+        assert 'splits the tiles of its run' in str(e.value)
+        assert not os.path.exists(out_mbtiles)
+
+        os.unlink(other)
+
+
+def test_merge_pmtiles_empty(tmpdir):
+    # shards of a tile far from the source have no tiles
+    shards = _make_shards(tmpdir, 2, bounding_tile=[1, 1, 1])
+    out_pmtiles = str(tmpdir.join('empty.pmtiles'))
+
+    assert all(not read_tiles(path) for path in shards)
+
+    merge_mbtiles(shards, out_pmtiles)
+
+    with open(out_pmtiles, 'rb') as f:
+        assert f.read(7) == b'PMTiles'
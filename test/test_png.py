@@ -0,0 +1,60 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from hypothesis import given, settings
+import hypothesis.strategies as st
+
+from rio_rgbify.png import PNG_FILTERS, encode_png
+
+
+def _read_png(contents):
+    return np.rollaxis(np.array(Image.open(BytesIO(contents))), 2, 0)
+
+
+@settings(deadline=None, max_examples=25)
+@given(
+    st.integers(min_value=1, max_value=64),
+    st.integers(min_value=1, max_value=64),
+    st.sampled_from(PNG_FILTERS),
+    st.integers(min_value=0, max_value=9),
+    st.integers(min_value=0, max_value=2 ** 31),
+)
+def test_encode_png_roundtrip(rows, cols, png_filter, level, seed):
+    data = np.random.RandomState(seed).randint(0, 256, (3, rows, cols)).astype(np.uint8)
+
+    contents = encode_png(data, level, png_filter)
+
+    assert contents[:8] == b'\x89PNG\r\n\x1a\n'
+    assert np.array_equal(_read_png(contents), data)
+
+
+def test_encode_png_filters():
+    # smooth terrain compresses better with a filter than without
+    data = np.zeros((3, 256, 256), dtype=np.uint8)
+    data[1] = np.indices((256, 256)).sum(axis=0) // 2
+    data[2] = np.indices((256, 256))[1]
+
+    sizes = dict((f, len(encode_png(data, 6, f))) for f in PNG_FILTERS)
+
+    assert sizes['sub'] < sizes['none']
+    assert sizes['adaptive'] <= sizes['none']
+
+    # a view of non-contiguous bands encodes the same
+    assert encode_png(data[:, ::-1][:, ::-1]) == encode_png(data)
+
+
+def test_encode_png_fails():
+    with pytest.raises(TypeError):
+        encode_png(np.zeros((3, 16, 16), dtype=np.float64))
+
+    with pytest.raises(TypeError):
+        encode_png(np.zeros((16, 16), dtype=np.uint8))
+
+    with pytest.raises(ValueError):
+        encode_png(np.zeros((3, 16, 16), dtype=np.uint8), png_filter='best')
+
+    with pytest.raises(ValueError):
+        encode_png(np.zeros((3, 16, 16), dtype=np.uint8), level=10)
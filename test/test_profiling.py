@@ -0,0 +1,90 @@
+import os
+import pstats
+
+import pytest
+
+from rio_rgbify.profiling import (
+    dump_profiles, merge_profiles, profiled, reset_profiles, sampled, worker_profile_path)
+from rio_rgbify.mbtiler import RGBTiler
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+def _profiled_here(job=None):
+    return 1
+
+
+def _paused_here(job=None):
+    return 2
+
+
+def _functions(path):
+    return set(name for _, _, name in pstats.Stats(path).stats)
+
+
+def test_profiled(tmpdir):
+    reset_profiles()
+
+    with profiled():
+        _profiled_here()
+
+        with profiled(False):
+            _paused_here()
+
+        with profiled(None):
+            sampled(0, _paused_here, None)
+            sampled(1, _profiled_here, None)
+
+    # outside of a profiled block, None leaves profiling off
+    with profiled(None):
+        _paused_here()
+
+    path = str(tmpdir.join('profile.prof'))
+    dump_profiles(path)
+
+    functions = _functions(path)
+    assert '_profiled_here' in functions
+    assert '_paused_here' not in functions
+
+
+def test_merge_profiles(tmpdir):
+    reset_profiles()
+
+    with profiled():
+        _profiled_here()
+
+    # as dumped by a worker process
+    dump_profiles(worker_profile_path(str(tmpdir), 1))
+    reset_profiles()
+
+    with profiled():
+        _paused_here()
+
+    path = str(tmpdir.join('merged.prof'))
+    merge_profiles(path, str(tmpdir))
+
+    assert set(['_profiled_here', '_paused_here']) <= _functions(path)
+
+    # nothing profiled writes no profile
+    reset_profiles()
+    empty = str(tmpdir.join('empty.prof'))
+
+    assert merge_profiles(empty, str(tmpdir.join('missing'))) is None
+    assert not os.path.exists(empty)
+
+
+@pytest.mark.parametrize('executor', ['processes', 'threads'])
+def test_RGBtiler_profile(tmpdir, executor):
+    path = str(tmpdir.join('run.prof'))
+
+    with RGBTiler(in_elev_src, str(tmpdir.join('out.mbtiles')), 12, 14, executor=executor,
+                  profile=path, profile_sample=0.5) as tiler:
+        tiler.run(2)
+
+    # worker jobs, and the parent's result and writer loops
+    functions = _functions(path)
+    assert set(['_metatile_worker', '_queue_results', '_write_batch']) <= functions
+
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 12, 14, profile=path, profile_sample=0)
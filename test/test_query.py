@@ -0,0 +1,134 @@
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio import transform
+from rasterio.warp import transform as transform_points
+
+from rio_rgbify.geotiff import encode_geotiff
+from rio_rgbify.mbtiler import RGBTiler
+from rio_rgbify.query import GeoTIFFElevation, MBTilesElevation, open_elevation
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+def _plane(path):
+    """
+    Write an EPSG:3857 DEM that rises linearly east and north, and
+    return a function of its elevation at EPSG:3857 coordinates
+    """
+    west, north, size, res = -13630000.0, 4553000.0, 512, 5.0
+    affine = transform.from_origin(west, north, res, res)
+    cols, rows = np.meshgrid(np.arange(size) + 0.5, np.arange(size) + 0.5)
+    xs, ys = affine * (cols, rows)
+
+    def elevation(x, y):
+        return 100 + 0.01 * (x - west) + 0.02 * (north - y)
+
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=1,
+                       dtype='float32', crs='EPSG:3857', transform=affine,
+                       tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(elevation(xs, ys).astype(np.float32), 1)
+
+    return elevation
+
+
+def _points(path, count, seed=0):
+    """
+    Random lon, lats within the central part of a source, and their
+    EPSG:3857 coordinates
+    """
+    with rasterio.open(path) as src:
+        w, s, e, n = src.bounds
+
+    rng = np.random.RandomState(seed)
+    xs = rng.uniform(w + 0.1 * (e - w), e - 0.1 * (e - w), count)
+    ys = rng.uniform(s + 0.1 * (n - s), n - 0.1 * (n - s), count)
+    lons, lats = transform_points('EPSG:3857', 'EPSG:4326', xs, ys)
+
+    return np.array(lons), np.array(lats), xs, ys
+
+
+def test_mbtiles_elevation(tmpdir):
+    src = str(tmpdir.join('plane.tif'))
+    elevation = _plane(src)
+    outpath = str(tmpdir.join('plane.mbtiles'))
+
+    with RGBTiler(src, outpath, 14, 16, interval={0: 0.1, 16: 0.01}, base_val=-1000,
+                  tile_size=256) as tiler:
+        tiler.run(1)
+
+    lons, lats, xs, ys = _points(src, 5000)
+
+    with open_elevation(outpath, cache_size=4) as query:
+        assert query.zoom == 16
+        assert query.interval == 0.01
+
+        values = query.sample(lons.reshape(50, 100), lats.reshape(50, 100))
+
+        assert values.shape == (50, 100)
+        assert np.abs(values.ravel() - elevation(xs, ys)).max() < 0.05
+
+        # points are grouped by tile, so each tile is decoded about once
+        assert query.misses <= 4 * 16
+
+        # outside of the tiles, and beyond the poles
+        assert np.isnan(query.sample([0.0, lons[0]], [0.0, 89.0])).all()
+
+    with MBTilesElevation(outpath, zoom=14) as query:
+        assert query.interval == 0.1
+        assert np.abs(query.sample(lons, lats) - elevation(xs, ys)).max() < 0.5
+
+
+def test_mbtiles_elevation_without_metadata(tmpdir):
+    outpath = str(tmpdir.join('elev.mbtiles'))
+
+    with RGBTiler(in_elev_src, outpath, 14, 14, interval=0.1, base_val=-1000) as tiler:
+        tiler.run(1)
+
+    with sqlite3.connect(outpath) as conn:
+        conn.execute("DELETE FROM metadata WHERE name = 'rgbify';")
+
+    with pytest.raises(ValueError):
+        MBTilesElevation(outpath)
+
+    lons, lats, _, _ = _points(in_elev_src, 100)
+
+    with MBTilesElevation(outpath, base_val=-1000, interval=0.1) as query:
+        assert query.tile_shape == (512, 512)
+
+        with rasterio.open(in_elev_src) as src:
+            xs, ys = transform_points('EPSG:4326', src.crs, lons, lats)
+            expected = np.array([value[0] for value in src.sample(zip(xs, ys))])
+
+        assert np.median(np.abs(query.sample(lons, lats) - expected)) < 1
+
+    with pytest.raises(ValueError):
+        MBTilesElevation(outpath, zoom=15, base_val=-1000, interval=0.1)
+
+
+def test_geotiff_elevation(tmpdir):
+    src = str(tmpdir.join('plane.tif'))
+    elevation = _plane(src)
+    rgb = str(tmpdir.join('rgb.tif'))
+
+    encode_geotiff(src, rgb, base_val=-1000, interval=0.01, threads=1)
+
+    lons, lats, xs, ys = _points(src, 2000)
+
+    with GeoTIFFElevation(rgb, base_val=-1000, interval=0.01) as query:
+        assert query.tile_shape == (256, 256)
+        assert np.abs(query.sample(lons, lats) - elevation(xs, ys)).max() < 0.02
+        assert query.misses == 4
+
+        assert np.isnan(query.sample([0.0], [0.0])).all()
+        assert query.sample([], []).shape == (0,)
+
+    with pytest.raises(ValueError):
+        GeoTIFFElevation(src)
+
+    with pytest.raises(ValueError):
+        open_elevation('elevation.png')
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from hypothesis import given, settings
+import hypothesis.strategies as st
+
+from rio_rgbify.sources import SourceIndex, SourceCache, _RTree
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+@settings(deadline=None, max_examples=50)
+@given(st.integers(min_value=1, max_value=2000), st.integers(min_value=0, max_value=2 ** 31))
+def test_rtree_query(count, seed):
+    rng = np.random.RandomState(seed)
+    mins = rng.uniform(0, 1000, (count, 2))
+    boxes = np.hstack([mins, mins + rng.uniform(0, 50, (count, 2))])
+
+    tree = _RTree(boxes)
+
+    for _ in range(10):
+        w, s = rng.uniform(-50, 1000, 2)
+        bounds = [w, s, w + rng.uniform(0, 200), s + rng.uniform(0, 200)]
+
+        overlaps_x = (boxes[:, 0] < bounds[2]) & (boxes[:, 2] > bounds[0])
+        overlaps_y = (boxes[:, 1] < bounds[3]) & (boxes[:, 3] > bounds[1])
+        expected = np.nonzero(overlaps_x & overlaps_y)[0]
+
+        assert tree.query(bounds) == list(expected)
+
+
+def _split(tmpdir, count):
+    paths = []
+
+    with rasterio.open(in_elev_src) as src:
+        step = src.width // count
+
+        for i in range(count):
+            window = Window(i * step, 0, step, src.height)
+            profile = src.profile.copy()
+            profile.update(width=step, transform=src.window_transform(window))
+
+            path = str(tmpdir.join('part-{0}.tif'.format(i)))
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(src.read(1, window=window), 1)
+
+            paths.append(path)
+
+    return paths
+
+
+def test_source_index(tmpdir):
+    paths = _split(tmpdir, 4)
+    index = SourceIndex(paths)
+
+    with rasterio.open(in_elev_src) as src:
+        bounds = src.bounds
+
+    assert len(index) == 4
+    assert np.allclose(index.bounds, list(bounds))
+
+    # the left edge of the third part, which only the second part touches
+    left = bounds.left + (bounds.right - bounds.left) / 2
+    assert index.query([left - 1, bounds.bottom, left + 1, bounds.top]) == [1, 2]
+    assert index.query([left - 1, bounds.bottom, left, bounds.top]) == [1]
+    assert not index.intersects([bounds.right, bounds.bottom, bounds.right + 10, bounds.top])
+
+    with pytest.raises(ValueError):
+        SourceIndex([])
+
+
+def test_source_cache(tmpdir):
+    paths = _split(tmpdir, 3)
+    cache = SourceCache(2)
+
+    first = cache.get(paths[0])
+    assert cache.get(paths[0]) is first
+
+    second = cache.get(paths[1])
+    cache.get(paths[0])
+
+    # the least recently used dataset is closed
+    cache.get(paths[2])
+    assert second.closed
+    assert not first.closed
+    assert len(cache.datasets) == 2
+
+    cache.close()
+    assert first.closed
+    assert not cache.datasets
@@ -0,0 +1,42 @@
+import json
+
+from rio_rgbify.stats import TilerStats, _stamp, STAGES
+
+
+def test_stats_summary():
+    stats = TilerStats(slowest=2)
+
+    for i in range(10):
+        stats.add([i, 0, 3], {'warp': i / 10., 'encode': 0.1, 'pid': 1, 'rss': 100 + i, 'sent': 0}, received=1 + i)
+
+    stats.add([0, 0, 4], {'read': 1, 'resample': 2, 'pid': 2, 'rss': 50, 'sent': 100}, received=99)
+    stats.add_write(11, 0.5)
+    stats.finish()
+
+    summary = stats.to_dict()
+
+    assert summary['tiles'] == 11
+    assert summary['zooms']['3']['tiles'] == 10
+    assert summary['zooms']['3']['seconds'] == 9
+    assert summary['zooms']['4']['tiles_per_sec'] is None
+    assert abs(summary['zooms']['3']['latency']['max'] - 1.0) < 1e-9
+    assert abs(summary['stages']['warp'] - 4.5) < 1e-9
+    assert summary['stages']['resample'] == 2
+    assert summary['write'] == {'seconds': 0.5, 'batches': 1, 'tiles': 11}
+    assert summary['peak_rss'] == {'max': 109, 'workers': {'1': 109, '2': 50}}
+    assert [s['tile'] for s in summary['slowest']] == [[0, 0, 4], [9, 0, 3]]
+
+    # ipc time is never negative
+    assert summary['ipc_seconds'] == sum(range(1, 11))
+
+    json.dumps(summary)
+
+
+def test_stamp():
+    results = [([0, 0, 0], b'', None, {'warp': 1}), ([0, 0, 0], b'', None, None)]
+
+    _stamp(results)
+
+    assert set(results[0][3]) == set(['warp', 'pid', 'rss', 'sent'])
+    assert results[1][3] is None
+    assert 'warp' in STAGES
@@ -0,0 +1,73 @@
+import os
+
+import mercantile
+import numpy as np
+import pytest
+import rasterio
+
+from rio_rgbify.mbtiler import RGBTiler
+from rio_rgbify.query import MBTilesElevation
+from rio_rgbify.untiler import decode_mbtiles
+
+from tilesets import read_tiles
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_decode_mbtiles(tmpdir, threads):
+    mbtiles = str(tmpdir.join('elev.mbtiles'))
+    outpath = str(tmpdir.join('decoded.tif'))
+
+    with RGBTiler(in_elev_src, mbtiles, 14, 16, interval=0.1, base_val=-10000,
+                  tile_size=256) as tiler:
+        tiler.run(1)
+
+    tiles = sorted((x, y) for _, x, y in read_tiles(mbtiles, 16))
+    (min_x, min_y), (max_x, max_y) = tiles[0], tiles[-1]
+
+    decode_mbtiles(mbtiles, outpath, threads=threads)
+
+    with rasterio.open(outpath) as decoded, MBTilesElevation(mbtiles) as query:
+        assert decoded.dtypes == ('float32',)
+        assert decoded.crs.to_epsg() == 3857
+        assert decoded.block_shapes == [(256, 256)]
+        assert decoded.width == (max_x - min_x + 1) * 256
+        assert decoded.height == (max_y - min_y + 1) * 256
+
+        west, _, _, north = mercantile.xy_bounds(min_x, min_y, 16)
+        assert np.allclose([decoded.bounds.left, decoded.bounds.top], [west, north])
+
+        # each tile decodes into its own block
+        for x, y in tiles:
+            window = rasterio.windows.Window((x - min_x) * 256, (y - min_y) * 256, 256, 256)
+            assert np.allclose(decoded.read(1, window=window), query._read_tile(x, y))
+
+
+def test_decode_mbtiles_bounds(tmpdir):
+    mbtiles = str(tmpdir.join('elev.mbtiles'))
+    outpath = str(tmpdir.join('decoded.tif'))
+
+    with RGBTiler(in_elev_src, mbtiles, 15, 15, interval=0.1, base_val=-10000) as tiler:
+        tiler.run(1)
+
+    _, x, y = min(read_tiles(mbtiles, 15))
+    west, south, east, north = mercantile.bounds(x, y, 15)
+
+    # a tile and the empty tile west of it
+    decode_mbtiles(mbtiles, outpath, bounds=[west - (east - west) / 2, south + 1e-4,
+                                             east - 1e-4, north - 1e-4])
+
+    with rasterio.open(outpath) as decoded:
+        assert (decoded.width, decoded.height) == (1024, 512)
+
+        data = decoded.read(1)
+        assert np.isnan(data[:, :512]).all()
+        assert not np.isnan(data[:, 512:]).any()
+
+    with pytest.raises(ValueError):
+        decode_mbtiles(mbtiles, outpath, zoom=12)
+
+    with pytest.raises(ValueError):
+        decode_mbtiles(mbtiles, outpath, threads=0)
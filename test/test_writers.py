@@ -0,0 +1,253 @@
+import os
+import io
+import json
+import zlib
+import struct
+import sqlite3
+
+import pytest
+
+from rio_rgbify.mbtiler import RGBTiler
+from rio_rgbify.writers import (
+    STAGING_SUFFIX,
+    _tile_id,
+    _build_directories,
+    _writer_for,
+)
+
+from tilesets import read_tiles
+
+
+in_elev_src = os.path.join(os.path.dirname(__file__), "fixtures", "elev.tif")
+
+
+def _read_varint(f):
+    value = shift = 0
+
+    while True:
+        byte = ord(f.read(1))
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return value
+
+
+def _read_directory(data):
+    f = io.BytesIO(zlib.decompress(data, 31))
+    n = _read_varint(f)
+
+    tile_ids = []
+    last = 0
+    for _ in range(n):
+        last += _read_varint(f)
+        tile_ids.append(last)
+
+    run_lengths = [_read_varint(f) for _ in range(n)]
+    lengths = [_read_varint(f) for _ in range(n)]
+
+    offsets = []
+    for i in range(n):
+        offset = _read_varint(f)
+        offsets.append(offsets[-1] + lengths[i - 1] if offset == 0 else offset - 1)
+
+    return list(zip(tile_ids, offsets, lengths, run_lengths))
+
+
+def _read_pmtiles(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    header = struct.unpack('<7sBQQQQQQQQQQQBBBBBBiiiiBii', data[:127])
+    assert header[:2] == (b'PMTiles', 3)
+
+    root_offset, root_length, meta_offset, meta_length = header[2:6]
+    leaf_offset, _, data_offset = header[6:9]
+
+    entries = _read_directory(data[root_offset:root_offset + root_length])
+    metadata = json.loads(zlib.decompress(data[meta_offset:meta_offset + meta_length], 31))
+
+    tiles = {}
+
+    while entries:
+        tile_id, offset, length, run_length = entries.pop(0)
+
+        if run_length == 0:
+            start = leaf_offset + offset
+            entries.extend(_read_directory(data[start:start + length]))
+            continue
+
+        for i in range(run_length):
+            start = data_offset + offset
+            tiles[tile_id + i] = data[start:start + length]
+
+    return header, metadata, tiles
+
+
+def test_tile_id():
+    # tiles of lower zooms come first, then the Hilbert curve of each zoom
+    assert _tile_id(0, 0, 0) == 0
+    assert [_tile_id(1, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]] == [1, 2, 3, 4]
+    assert _tile_id(2, 0, 0) == 5
+    assert _tile_id(12, 3423, 1763) == 19078479
+    assert _tile_id(20, 2 ** 20 - 1, 0) == (4 ** 21 - 1) // 3 - 1
+
+
+def test_writer_for():
+    assert _writer_for('out.pmtiles') == 'pmtiles'
+    assert _writer_for('out.PMTILES') == 'pmtiles'
+    assert _writer_for('out.mbtiles') == 'mbtiles'
+
+
+def test_build_directories():
+    entries = [(i * 7, i * 1000, 1000, 1) for i in range(5)]
+    root, leaves = _build_directories(entries, 16384)
+
+    assert leaves == b''
+    assert _read_directory(root) == entries
+
+    # ids and lengths that compress poorly need leaf directories
+    entries = [(i * 7919 % 65521 + i * 65521, i * 100000, (i * 7919) % 99991, 1)
+               for i in range(40000)]
+    root, leaves = _build_directories(entries, 2048)
+
+    assert len(root) <= 2048
+    assert len(leaves) > 0
+
+    read = []
+    for tile_id, offset, length, run_length in _read_directory(root):
+        assert run_length == 0
+        read.extend(_read_directory(leaves[offset:offset + length]))
+
+    assert read == entries
+
+
+@pytest.mark.parametrize('dedupe', [False, True])
+def test_RGBtiler_pmtiles(tmpdir, dedupe):
+    out_mbtiles = str(tmpdir.join('elev.mbtiles'))
+    out_pmtiles = str(tmpdir.join('elev.pmtiles'))
+
+    for path in (out_mbtiles, out_pmtiles):
+        with RGBTiler(in_elev_src, path, 13, 15, interval=0.1, dedupe=dedupe) as tiler:
+            tiler.run(2)
+
+    assert not os.path.exists(out_pmtiles + STAGING_SUFFIX)
+
+    header, metadata, tiles = _read_pmtiles(out_pmtiles)
+
+    assert tiles == dict(
+        (_tile_id(z, x, y), data) for (z, x, y), data in read_tiles(out_mbtiles).items())
+    assert header[16] == 2  # png
+    assert header[17:19] == (13, 15)
+    assert metadata['rgbify']['dedupe'] == dedupe
+
+    # clustered: tile data is in tile id order
+    offsets = []
+    data = open(out_pmtiles, 'rb').read()[header[8]:]
+    for tile_id in sorted(tiles):
+        offsets.append(data.index(tiles[tile_id]))
+    assert offsets == sorted(offsets)
+
+
+def test_RGBtiler_pmtiles_resume(tmpdir):
+    out_pmtiles = str(tmpdir.join('elev.pmtiles'))
+
+    with RGBTiler(in_elev_src, out_pmtiles, 13, 15, interval=0.1, resume=True) as tiler:
+        tiler.run(1)
+
+    _, _, full = _read_pmtiles(out_pmtiles)
+
+    # a finished archive cannot be resumed
+    with pytest.raises(ValueError):
+        with RGBTiler(in_elev_src, out_pmtiles, 13, 15, interval=0.1, resume=True) as tiler:
+            tiler.run(1)
+
+    # an interrupted run leaves its staging file
+    staged = str(tmpdir.join('staged.mbtiles'))
+    with RGBTiler(in_elev_src, staged, 13, 15, interval=0.1, writer='mbtiles') as tiler:
+        tiler.run(1)
+
+    conn = sqlite3.connect(staged)
+    conn.execute('DELETE FROM tiles WHERE zoom_level = 15;')
+    conn.commit()
+    conn.close()
+
+    os.unlink(out_pmtiles)
+    os.rename(staged, out_pmtiles + STAGING_SUFFIX)
+
+    with RGBTiler(in_elev_src, out_pmtiles, 13, 15, interval=0.1, resume=True) as tiler:
+        tiler.run(2)
+
+    _, _, resumed = _read_pmtiles(out_pmtiles)
+
+    assert resumed == full
+
+
+@pytest.mark.parametrize('pyramid', [False, True])
+def test_RGBtiler_directory(tmpdir, pyramid):
+    out_mbtiles = str(tmpdir.join('elev.mbtiles'))
+    out_dir = str(tmpdir.join('elev'))
+
+    with RGBTiler(in_elev_src, out_mbtiles, 13, 15, interval=0.1, pyramid=pyramid) as tiler:
+        tiler.run(1)
+
+    with RGBTiler(in_elev_src, out_dir, 13, 15, interval=0.1, pyramid=pyramid,
+                  dedupe=True, writer='directory') as tiler:
+        tiler.run(2)
+
+    conn = sqlite3.connect(out_mbtiles)
+    expected = conn.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles;')
+
+    count = 0
+    for z, x, row, data in expected:
+        path = os.path.join(out_dir, str(z), str(x), '{0}.png'.format(2 ** z - row - 1))
+        assert open(path, 'rb').read() == bytes(data)
+        count += 1
+
+    assert count == sum(len(files) for _, _, files in os.walk(out_dir)) - 1
+
+    with open(os.path.join(out_dir, 'metadata.json')) as f:
+        assert json.load(f)['rgbify']['pyramid'] == pyramid
+
+    # resuming rewrites missing tiles only
+    removed = os.path.join(out_dir, '15', '5240')
+    for name in os.listdir(removed):
+        os.unlink(os.path.join(removed, name))
+
+    with RGBTiler(in_elev_src, out_dir, 13, 15, interval=0.1, pyramid=pyramid,
+                  dedupe=True, writer='directory', resume=True) as tiler:
+        tiler.run(1)
+
+    assert len(os.listdir(removed)) > 0
+
+
+def test_RGBtiler_directory_not_empty(tmpdir):
+    tmpdir.join('keep.txt').write('not tiles')
+
+    with pytest.raises(ValueError):
+        with RGBTiler(in_elev_src, str(tmpdir), 13, 13, writer='directory') as tiler:
+            tiler.run(1)
+
+    assert tmpdir.join('keep.txt').check()
+
+
+def test_RGBtiler_writer_fails():
+    with pytest.raises(ValueError):
+        RGBTiler(in_elev_src, 'out.mbtiles', 13, 15, writer='zip')
+
+
+def test_RGBtiler_extra_metadata(tmpdir):
+    out_pmtiles = str(tmpdir.join('elev.pmtiles'))
+    out_dir = str(tmpdir.join('elev'))
+
+    for path in (out_pmtiles, out_dir):
+        with RGBTiler(in_elev_src, path, 13, 14, interval=0.1, max_error=1,
+                      writer=None if path == out_pmtiles else 'directory') as tiler:
+            tiler.run(1)
+
+    _, metadata, _ = _read_pmtiles(out_pmtiles)
+    assert sorted(metadata['rgbify_precision']) == ['13', '14']
+    assert metadata['rgbify']['max_error'] == 1
+
+    with open(os.path.join(out_dir, 'metadata.json')) as f:
+        assert json.load(f)['rgbify_precision'] == metadata['rgbify_precision']
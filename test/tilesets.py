@@ -0,0 +1,47 @@
+"""Readers of the tiles of MBTiles files, shared by the tests"""
+import sqlite3
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from rio_rgbify.encoders import _decode
+
+
+def read_tiles(path, zoom=None):
+    """
+    {(z, x, y): image} of the tiles of an mbtiles file, or of one zoom,
+    with y counted from the north as in XYZ tiles
+    """
+    query = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles'
+    args = ()
+
+    if zoom is not None:
+        query += ' WHERE zoom_level = ?'
+        args = (zoom,)
+
+    conn = sqlite3.connect(path)
+
+    try:
+        return dict(
+            ((z, x, 2 ** z - row - 1), bytes(data))
+            for z, x, row, data in conn.execute(query + ';', args))
+    finally:
+        conn.close()
+
+
+def decoded_tiles(path, base_val, interval):
+    """
+    {(z, x, y): elevations} of the tiles of an mbtiles file; `interval`
+    is one interval, or a {zoom: interval} dict
+    """
+    tiles = {}
+
+    for (z, x, y), data in read_tiles(path).items():
+        with Image.open(BytesIO(data)) as im:
+            rgb = np.rollaxis(np.asarray(im.convert('RGB')), 2, 0)
+
+        tiles[(z, x, y)] = _decode(
+            rgb, base_val, interval[z] if isinstance(interval, dict) else interval)
+
+    return tiles